@@ -1,11 +1,816 @@
 """A medium-faithful port of https://github.com/weinberg/SQLToy to Python"""
 
+import array
+import asyncio
+import bisect
+import collections
+import concurrent.futures
+import contextlib
+import copy
+import csv as csvlib
+import functools
+import heapq
+import io
+import itertools
+import json
+import math
+import multiprocessing
+import operator
+import os
+import pickle
+import random
+import re
+import threading
+import time
+import tracemalloc
+import types
+from collections.abc import Mapping
+
+try:
+    import numpy
+except ImportError:  # Only needed for NumpyTable
+    numpy = None
+
+
+class Expr:
+    """A predicate or value the engine can look inside. Build them with col()
+    and Python operators, e.g. (col("a") == 3) & col("b").IN([1, 2]); calling
+    one on a row evaluates it."""
+
+    def __eq__(self, other):
+        return Compare("==", self, _lift(other))
+
+    def __ne__(self, other):
+        return Compare("!=", self, _lift(other))
+
+    def __lt__(self, other):
+        return Compare("<", self, _lift(other))
+
+    def __le__(self, other):
+        return Compare("<=", self, _lift(other))
+
+    def __gt__(self, other):
+        return Compare(">", self, _lift(other))
+
+    def __ge__(self, other):
+        return Compare(">=", self, _lift(other))
+
+    def __and__(self, other):
+        return And(self, other)
+
+    def __or__(self, other):
+        return Or(self, other)
+
+    def __invert__(self):
+        return Not(self)
+
+    def __bool__(self):
+        raise TypeError("Combine expressions with & and | instead of and/or")
+
+    __hash__ = None
+
+    def IN(self, values):
+        return In(self, values)
+
+    def BETWEEN(self, low, high):
+        return Between(self, _lift(low), _lift(high))
+
+
+class Col(Expr):
+    def __init__(self, name):
+        self.name = name
+
+    def __call__(self, row):
+        return row[self.name]
+
+    def columns(self):
+        return {self.name}
+
+    def rename(self, names):
+        return Col(names.get(self.name, self.name))
+
+    def __repr__(self):
+        return f"col({self.name!r})"
+
+
+class Const(Expr):
+    def __init__(self, value):
+        self.value = value
+
+    def __call__(self, row):
+        return self.value
+
+    def columns(self):
+        return set()
+
+    def rename(self, names):
+        return self
+
+    def __repr__(self):
+        return repr(self.value)
+
+
+class Compare(Expr):
+    def __init__(self, op, left, right):
+        self.op = op
+        self.left = left
+        self.right = right
+        self._compare = _COMPARISONS[op]
+
+    def __call__(self, row):
+        return self._compare(self.left(row), self.right(row))
+
+    def columns(self):
+        return self.left.columns() | self.right.columns()
+
+    def rename(self, names):
+        return Compare(self.op, self.left.rename(names), self.right.rename(names))
+
+    def __repr__(self):
+        return f"({self.left!r} {self.op} {self.right!r})"
+
+
+class And(Expr):
+    def __init__(self, *terms):
+        self.terms = tuple(_flatten(And, terms))
+
+    def __call__(self, row):
+        return all(term(row) for term in self.terms)
+
+    def columns(self):
+        return set().union(*(term.columns() for term in self.terms))
+
+    def rename(self, names):
+        return And(*(term.rename(names) for term in self.terms))
+
+    def __repr__(self):
+        return "(" + " & ".join(map(repr, self.terms)) + ")"
+
+
+class Or(Expr):
+    def __init__(self, *terms):
+        self.terms = tuple(_flatten(Or, terms))
+
+    def __call__(self, row):
+        return any(term(row) for term in self.terms)
+
+    def columns(self):
+        return set().union(*(term.columns() for term in self.terms))
+
+    def rename(self, names):
+        return Or(*(term.rename(names) for term in self.terms))
+
+    def __repr__(self):
+        return "(" + " | ".join(map(repr, self.terms)) + ")"
+
+
+class Not(Expr):
+    def __init__(self, term):
+        self.term = term
+
+    def __call__(self, row):
+        return not self.term(row)
+
+    def columns(self):
+        return self.term.columns()
+
+    def rename(self, names):
+        return Not(self.term.rename(names))
+
+    def __repr__(self):
+        return f"~{self.term!r}"
+
+
+class In(Expr):
+    def __init__(self, expr, values):
+        self.expr = expr
+        self.values = tuple(values)
+
+    def __call__(self, row):
+        return self.expr(row) in self.values
+
+    def columns(self):
+        return self.expr.columns()
+
+    def rename(self, names):
+        return In(self.expr.rename(names), self.values)
+
+    def __repr__(self):
+        return f"{self.expr!r}.IN({list(self.values)!r})"
+
+
+class Between(Expr):
+    def __init__(self, expr, low, high):
+        self.expr = expr
+        self.low = low
+        self.high = high
+
+    def __call__(self, row):
+        return self.low(row) <= self.expr(row) <= self.high(row)
+
+    def columns(self):
+        return self.expr.columns() | self.low.columns() | self.high.columns()
+
+    def rename(self, names):
+        return Between(
+            self.expr.rename(names), self.low.rename(names), self.high.rename(names)
+        )
+
+    def __repr__(self):
+        return f"{self.expr!r}.BETWEEN({self.low!r}, {self.high!r})"
+
+
+def col(name):
+    return Col(name)
+
+
+def _all(terms):
+    return terms[0] if len(terms) == 1 else And(*terms)
+
+
+def _lift(value):
+    return value if isinstance(value, Expr) else Const(value)
+
+
+def _flatten(kind, terms):
+    for term in terms:
+        if isinstance(term, kind):
+            yield from term.terms
+        else:
+            yield term
+
+
+class HashIndex:
+    kind = "hash"
+    # Positions from here on are left out of lookups, see shared_copy
+    _limit = None
+    # Whether add() leaves what a shared_copy reads alone
+    _appends_in_place = True
+
+    def __init__(self, columns):
+        self.columns = columns
+        self._positions = {}
+        # Whether a shared_copy in use reads _positions (set by the table),
+        # and the keys whose lists only this index reads since it stopped
+        # sharing it (None: all)
+        self._shared = False
+        self._owned = None
+
+    def add(self, keys, start):
+        # Appended positions are past the limit of any shared copy, so the
+        # lists can take them in place
+        for position, key in enumerate(keys, start):
+            self._positions.setdefault(key, []).append(position)
+
+    def lookup(self, key):
+        found = self._positions.get(key, [])
+        if self._limit is not None:
+            found = found[: bisect.bisect_left(found, self._limit)]
+        return found
+
+    def shared_copy(self, limit):
+        """A read-only copy for a table of limit rows, sharing this index's
+        storage: positions added later don't show in it, and while it is in
+        use this index copies what it changes otherwise first."""
+        index = copy.copy(self)
+        index._limit = limit
+        return index
+
+    def _own(self, key):
+        """Make the positions of key safe to change in place."""
+        if self._shared:
+            self._positions = dict(self._positions)
+            self._shared = False
+            self._owned = set()
+        if self._owned is not None and key not in self._owned:
+            if key in self._positions:
+                self._positions[key] = self._positions[key][:]
+            self._owned.add(key)
+
+    def insert(self, key, position):
+        self._own(key)
+        bisect.insort(self._positions.setdefault(key, []), position)
+
+    def discard(self, key, position):
+        self._own(key)
+        positions = self._positions[key]
+        del positions[bisect.bisect_left(positions, position)]
+        if not positions:
+            del self._positions[key]
+
+    def delete(self, positions):
+        """Forget the rows at positions (sorted) and renumber those after."""
+        if not positions:
+            return
+        if self._shared or self._owned is not None:
+            # Rows appended after this can take positions a shared copy
+            # still reads, so no list can stay shared
+            self._positions = {key: found[:] for key, found in self._positions.items()}
+            self._shared = False
+            self._owned = None
+        removed = set(positions)
+        emptied = []
+        for key, found in self._positions.items():
+            # Positions are kept in order, so most lists can be left alone
+            if found[-1] >= positions[0]:
+                found[:] = _renumber(found, positions, removed)
+                if not found:
+                    emptied.append(key)
+        for key in emptied:
+            del self._positions[key]
+
+
+class SortedIndex:
+    kind = "sorted"
+    _appends_in_place = False
+
+    def __init__(self, columns):
+        self.columns = columns
+        self._keys = []
+        self._positions = []
+        # Keys involving None can't be ordered against the others
+        self._unordered = []
+        # Whether a shared_copy in use reads the lists (set by the table)
+        self._shared = False
+
+    def add(self, keys, start):
+        self._own()
+        entries = []
+        for position, key in enumerate(keys, start):
+            if key is None or (isinstance(key, tuple) and None in key):
+                self._unordered.append((key, position))
+            else:
+                entries.append((key, position))
+        if len(entries) > 16:
+            entries = sorted(itertools.chain(zip(self._keys, self._positions), entries))
+            self._keys = [key for key, _ in entries]
+            self._positions = [position for _, position in entries]
+            return
+        for key, position in entries:
+            i = bisect.bisect_right(self._keys, key)
+            self._keys.insert(i, key)
+            self._positions.insert(i, position)
+
+    def lookup(self, key):
+        if key is None or (isinstance(key, tuple) and None in key):
+            return [position for k, position in self._unordered if k == key]
+        try:
+            lo = bisect.bisect_left(self._keys, key)
+            hi = bisect.bisect_right(self._keys, key)
+        except TypeError:
+            # A key that can't be ordered against the others equals none
+            return []
+        return self._positions[lo:hi]
+
+    def shared_copy(self, limit):
+        """A read-only copy for a table of limit rows, sharing this index's
+        storage, which while it is in use this index copies before changing
+        it again."""
+        return copy.copy(self)
+
+    def _own(self):
+        if self._shared:
+            self._keys = self._keys[:]
+            self._positions = self._positions[:]
+            self._unordered = self._unordered[:]
+            self._shared = False
+
+    def insert(self, key, position):
+        self._own()
+        if key is None or (isinstance(key, tuple) and None in key):
+            self._unordered.append((key, position))
+            return
+        lo = bisect.bisect_left(self._keys, key)
+        hi = bisect.bisect_right(self._keys, key)
+        i = bisect.bisect_left(self._positions, position, lo, hi)
+        self._keys.insert(i, key)
+        self._positions.insert(i, position)
+
+    def discard(self, key, position):
+        self._own()
+        if key is None or (isinstance(key, tuple) and None in key):
+            self._unordered.remove((key, position))
+            return
+        lo = bisect.bisect_left(self._keys, key)
+        hi = bisect.bisect_right(self._keys, key)
+        i = bisect.bisect_left(self._positions, position, lo, hi)
+        del self._keys[i]
+        del self._positions[i]
+
+    def delete(self, positions):
+        """Forget the rows at positions (sorted) and renumber those after."""
+        removed = set(positions)
+        kept = [position not in removed for position in self._positions]
+        self._keys = list(itertools.compress(self._keys, kept))
+        self._positions = _renumber(self._positions, positions, removed)
+        unordered = [(key, p) for key, p in self._unordered if p not in removed]
+        keys = [key for key, _ in unordered]
+        found = _renumber([p for _, p in unordered], positions, removed)
+        self._unordered = list(zip(keys, found))
+        # All new lists
+        self._shared = False
+
+    def ordered_positions(self):
+        # Rows with None keys have no place in the order
+        return None if self._unordered else self._positions
+
+    def range(self, low=None, high=None, low_inclusive=True, high_inclusive=True):
+        lo, hi = 0, len(self._keys)
+        if low is not None:
+            side = bisect.bisect_left if low_inclusive else bisect.bisect_right
+            lo = side(self._keys, low)
+        if high is not None:
+            side = bisect.bisect_right if high_inclusive else bisect.bisect_left
+            hi = side(self._keys, high)
+        return self._positions[lo:hi]
+
+
+_INDEX_KINDS = {"hash": HashIndex, "sorted": SortedIndex}
+
+
+def _renumber(found, deleted, removed):
+    """found (positions) without those in deleted (sorted, and as the set
+    removed), shifted down to where they are once the deleted rows are gone."""
+    return [
+        position - bisect.bisect_left(deleted, position)
+        for position in found
+        if position not in removed
+    ]
+
+
+class Schema:
+    """Column names shared by every Record of a relation, so that rows only
+    need to carry their values."""
+
+    __slots__ = ("names", "positions", "_sorted")
+
+    def __init__(self, names):
+        # Like dict keys, a repeated name keeps its first place but the value
+        # that comes last.
+        self.positions = {name: i for i, name in enumerate(names)}
+        self.names = tuple(dict.fromkeys(names))
+        self._sorted = None
+
+    def colnames(self):
+        if self._sorted is None:
+            self._sorted = tuple(sorted(self.names))
+        return self._sorted
+
+    def __repr__(self):
+        return f"Schema({self.names!r})"
+
+
+class Record(Mapping):
+    """A read-only row that looks its values up through a shared Schema."""
+
+    __slots__ = ("schema", "_values")
+
+    def __init__(self, schema, values):
+        self.schema = schema
+        self._values = values
+
+    def __getitem__(self, key):
+        return self._values[self.schema.positions[key]]
+
+    def __contains__(self, key):
+        return key in self.schema.positions
+
+    def __iter__(self):
+        return iter(self.schema.names)
+
+    def __len__(self):
+        return len(self.schema.names)
+
+    def __eq__(self, other):
+        if (
+            isinstance(other, Record)
+            and other.schema is self.schema
+            and len(self._values) == len(self.schema.names)
+        ):
+            return self._values == other._values
+        return super().__eq__(other)
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+# Every write to any table takes the next number, so a (table name, version)
+# pair never describes two different contents, even across DROP/CREATE_TABLE.
+_versions = itertools.count()
+
+
+class _Prefix:
+    """The first length items of a list or array.array, which may go on
+    growing: how a committed copy of a table reads the storage it shares with
+    the table, which only appends to it in place."""
+
+    __slots__ = ("_items", "_length")
+
+    def __init__(self, items, length):
+        self._items = items
+        self._length = length
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        return itertools.islice(self._items, self._length)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self._items[slice(*index.indices(self._length))]
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError("index out of range")
+        return self._items[index]
+
+
+def _prefix(column, length):
+    if numpy is not None and isinstance(column, numpy.ndarray):
+        # A view, which copies nothing either
+        return column[:length]
+    return _Prefix(column, length)
+
 
 class Table:
     def __init__(self, name: str, rows: tuple[dict] = ()):
+        self._setup(name)
+        self.rows = rows
+
+    def _setup(self, name):
+        """Set up what every kind of table keeps besides its rows."""
         self.name = name
-        self.rows = tuple(rows)
         self._colnames = ()
+        self.indexes = {}
+        # Column the rows are known to be sorted on, if any
+        self.ordered_by = None
+        # Odd while a write is under way, see _writing
+        self._sequence = 0
+        # What snapshot() hands out, and what it shares with the table; see
+        # _publish
+        self._committed = None
+        self._shared = set()
+        # The parts an older committed copy in use still shares
+        self._taken = set()
+        self._snapshot = None
+        # From analyze(), see TableStatistics
+        self.statistics = None
+
+    @property
+    def rows(self):
+        # Rows live in a growable list; readers get an immutable snapshot
+        # that is only rebuilt after the table has been written to. It is
+        # tagged with the write sequence number so that one taken while a
+        # write was under way is never reused.
+        sequence = self._sequence
+        snapshot = self._snapshot
+        if snapshot is not None and snapshot[0] == sequence:
+            return snapshot[1]
+        rows = tuple(self._rows)
+        if sequence % 2 == 0:
+            self._snapshot = (sequence, rows)
+        return rows
+
+    @rows.setter
+    def rows(self, rows):
+        with self._writing():
+            self._rows = list(rows)
+            self._snapshot = None
+            self.ordered_by = None
+            self.version = next(_versions)
+            self._rebuild_indexes()
+            if self.statistics is not None:
+                self.analyze()
+
+    def extend(self, rows):
+        with self._writing():
+            start = len(self._rows)
+            try:
+                self._rows.extend(rows)
+            except BaseException:
+                # Rows from an iterator that failed partway are taken back
+                # out, in place: no committed copy reads that far
+                del self._rows[start:]
+                raise
+            self._snapshot = None
+            self.ordered_by = None
+            self.version = next(_versions)
+            self._update_indexes(start)
+            self._track_statistics(len(self) - start, start)
+
+    @contextlib.contextmanager
+    def _writing(self):
+        """Wrap every change to the table. Its sequence number is odd while
+        one is under way, and once it is done a published table publishes
+        its new contents."""
+        self._sequence += 1
+        try:
+            yield
+        finally:
+            self._sequence += 1
+            if self._committed is not None:
+                self._publish()
+
+    def _publish(self):
+        """Make a read-only copy of the table as it is now the one
+        snapshot() hands out, which later writes leave alone. Tables in a
+        Database are published as they are created, and then after every
+        write, so that readers never have to wait for one to finish.
+
+        The copy shares the table's storage, reading only as many rows as
+        there are now, so appends don't show in it. Once snapshot() has
+        handed the copy out, writes copy any other part they change in place
+        first (see _unshare), and only that part.
+        """
+        previous = self._committed
+        if previous is not None:
+            # Whatever it still shares, the new copy shares too
+            previous._changing = True
+            if previous._taken:
+                self._taken.update(self._shared)
+        committed = copy.copy(self)
+        committed._committed = None
+        # Set by snapshot(), and by the writes that change what it shares in
+        # place or make it out of date
+        committed._taken = False
+        committed._changing = False
+        committed.indexes = {
+            columns: index.shared_copy(len(self))
+            for columns, index in self.indexes.items()
+        }
+        self._share(committed)
+        self._shared.update(("index", columns) for columns in self.indexes)
+        self._committed = committed
+
+    def _share(self, committed):
+        committed._rows = _Prefix(self._rows, len(self._rows))
+        self._shared = {"rows", "statistics"}
+
+    def _unshare(self, part):
+        """Whether part of the table (see _share) has to be copied before
+        being changed in place: the committed copy shares it, and snapshot()
+        has handed that copy out. After that it isn't shared any more.
+
+        A copy no snapshot has taken is changed in place instead, and marked
+        so that snapshot() waits for the write before handing anything out.
+        """
+        committed = self._committed
+        if committed is None or part not in self._shared:
+            return False
+        if part not in self._taken and not committed._taken:
+            # Marked before looking again, while snapshot() marks the copy
+            # taken before looking at this: one of the two sees the other
+            committed._changing = True
+            if not committed._taken:
+                return False
+        self._shared.discard(part)
+        self._taken.discard(part)
+        return True
+
+    def _change_index(self, index):
+        """Get index ready to be changed other than by appending."""
+        if self._unshare(("index", index.columns)):
+            index._shared = True
+
+    def update(self, positions, values):
+        """Merge values into the rows at positions, which must be sorted and
+        distinct, keeping the indexes in step."""
+        with self._writing():
+            self._update(list(positions), values)
+
+    def _update(self, positions, values):
+        changed = [
+            index
+            for index in self.indexes.values()
+            if not values.keys().isdisjoint(index.columns)
+        ]
+        # Moving a few entries beats rebuilding, but not for most of the rows
+        rebuild = len(positions) * 8 > len(self)
+        if not rebuild:
+            for index in changed:
+                self._change_index(index)
+                for position in positions:
+                    index.discard(self._index_key(index.columns, position), position)
+        self._assign(positions, values)
+        for index in changed:
+            if rebuild:
+                self.create_index(index.columns, index.kind)
+                continue
+            for position in positions:
+                index.insert(self._index_key(index.columns, position), position)
+        if self.ordered_by in values:
+            self.ordered_by = None
+        self.version = next(_versions)
+        self._track_statistics(len(positions), None)
+
+    def delete(self, positions):
+        """Remove the rows at positions, which must be sorted and distinct.
+        The rows after them move up, and the indexes are renumbered."""
+        positions = list(positions)
+        with self._writing():
+            self._remove(positions)
+            for index in self.indexes.values():
+                self._change_index(index)
+                index.delete(positions)
+            self.version = next(_versions)
+            self._track_statistics(len(positions), None)
+
+    def _assign(self, positions, values):
+        if self._unshare("rows"):
+            self._rows = self._rows[:]
+        for position in positions:
+            self._rows[position] = {**self._rows[position], **values}
+        self._snapshot = None
+
+    def _remove(self, positions):
+        if len(positions) > 16:
+            deleted = set(positions)
+            self._rows = [row for i, row in enumerate(self._rows) if i not in deleted]
+        else:
+            if self._unshare("rows"):
+                self._rows = self._rows[:]
+            for position in reversed(positions):
+                del self._rows[position]
+        self._snapshot = None
+
+    def analyze(self):
+        """Collect TableStatistics about the rows, see Database.ANALYZE."""
+        self.statistics = TableStatistics(self)
+        return self.statistics
+
+    def _track_statistics(self, changed, start):
+        """Keep the statistics in step with a write that changed that many
+        rows, having appended the rows from start on if start isn't None."""
+        statistics = self.statistics
+        if statistics is None:
+            return
+        if statistics.stale(changed):
+            self.statistics = TableStatistics(self)
+            return
+        if self._unshare("statistics"):
+            self.statistics = statistics = statistics.copy()
+        if start is not None:
+            statistics.extend(self, start)
+        else:
+            statistics.changed += changed
+            statistics.row_count = len(self)
+
+    def _statistics_columns(self):
+        if not self._colnames and not self._rows:
+            return ()
+        return self.colnames()
+
+    def _column_values(self, column, start):
+        return [row.get(column) for row in self._rows[start:]]
+
+    def create_index(self, columns, kind="hash"):
+        if isinstance(columns, str):
+            columns = (columns,)
+        if kind not in _INDEX_KINDS:
+            raise ValueError(f"Unknown index kind {kind!r}")
+        index = _INDEX_KINDS[kind](tuple(columns))
+        index.add(self._index_keys(index.columns, 0), 0)
+        self.indexes[index.columns] = index
+        return index
+
+    def _rebuild_indexes(self):
+        for columns, index in self.indexes.items():
+            self.create_index(columns, index.kind)
+
+    def _update_indexes(self, start):
+        try:
+            for index in self.indexes.values():
+                if not index._appends_in_place:
+                    self._change_index(index)
+                index.add(self._index_keys(index.columns, start), start)
+        except Exception:
+            # Rows the indexes can't take (missing an indexed column, say)
+            # are taken back out, so that the write fails as a whole
+            self._remove(list(range(start, len(self))))
+            self._rebuild_indexes()
+            raise
+
+    def _index_keys(self, columns, start):
+        rows = self._rows[start:]
+        if len(columns) == 1:
+            (col,) = columns
+            return (row[col] for row in rows)
+        return (tuple(row[col] for col in columns) for row in rows)
+
+    def _index_key(self, columns, position):
+        row = self._row(position)
+        if len(columns) == 1:
+            return row[columns[0]]
+        return tuple(row[col] for col in columns)
+
+    def _row(self, position):
+        return self._rows[position]
+
+    def take(self, positions):
+        return Table(self.name, [self._rows[i] for i in positions])
 
     def set_colnames(self, colnames):
         self._colnames = tuple(sorted(colnames))
@@ -15,10 +820,23 @@ class Table:
             return self._colnames
         if not self.rows:
             raise ValueError("Need either rows or manually specified column names")
-        return tuple(sorted(self.rows[0].keys()))
+        first = self.rows[0]
+        if isinstance(first, Record):
+            return first.schema.colnames()
+        return tuple(sorted(first.keys()))
 
     def filter(self, pred):
-        return Table(self.name, [row for row in self.rows if pred(row)])
+        result = Table(self.name, [row for row in self.rows if pred(row)])
+        result.ordered_by = self.ordered_by
+        return result
+
+    def __iter__(self):
+        # Straight from the list, which .rows would copy after a write; rows
+        # appended meanwhile are left out, as they would be from .rows
+        return itertools.islice(self._rows, len(self._rows))
+
+    def __len__(self):
+        return len(self._rows)
 
     def __repr__(self):
         if not self.name:
@@ -26,158 +844,2450 @@ class Table:
         return f"Table({self.name!r}, {list(self.rows)!r})"
 
 
-class Database:
-    def __init__(self):
-        self.tables = {}
+class ColumnTable(Table):
+    """A Table stored as one sequence per column instead of one dict per row.
+    Columns holding only ints or only floats are packed into array.arrays;
+    columns passed in directly are used as given. Iterating (or reading .rows)
+    builds the row dicts on the fly."""
 
-    def CREATE_TABLE(self, name, colnames=()):
-        table = Table(name)
-        if colnames:
-            table.set_colnames(colnames)
-        self.tables[name] = table
-        return table
+    def __init__(self, name: str, rows=(), columns=None):
+        self._setup(name)
+        self.columns = {}
+        self.version = next(_versions)
+        if columns is not None:
+            self.columns = dict(columns)
+        else:
+            self.extend(rows)
+
+    def set_colnames(self, colnames):
+        for col in colnames:
+            self.columns.setdefault(col, [])
+
+    def colnames(self):
+        if not self.columns:
+            raise ValueError("Need either rows or manually specified column names")
+        return tuple(sorted(self.columns))
+
+    @property
+    def rows(self):
+        return tuple(self)
+
+    @rows.setter
+    def rows(self, rows):
+        with self._writing():
+            self.columns = {}
+            self._extend_columns(rows)
+            self.ordered_by = None
+            self.version = next(_versions)
+            self._rebuild_indexes()
+            if self.statistics is not None:
+                self.analyze()
+
+    def extend(self, rows):
+        with self._writing():
+            start = len(self)
+            self._extend_columns(rows)
+            self.ordered_by = None
+            self.version = next(_versions)
+            self._update_indexes(start)
+            self._track_statistics(len(self) - start, start)
+
+    def _share(self, committed):
+        committed.columns = {
+            col: _prefix(values, len(self)) for col, values in self.columns.items()
+        }
+        self._shared = {"statistics", *(("column", col) for col in self.columns)}
+
+    def _extend_columns(self, rows):
+        # Nothing changes until every row has been read
+        rows = iter(rows)
+        columns = self.columns
+        if not columns:
+            first = next(rows, None)
+            if first is None:
+                return
+            columns = {col: [] for col in first}
+            rows = itertools.chain((first,), rows)
+        new_values = {col: [] for col in columns}
+        for row in rows:
+            for col, values in new_values.items():
+                values.append(row[col])
+        for col, values in new_values.items():
+            columns[col] = self._extend_column(columns[col], values)
+        self.columns = columns
+
+    def _extend_column(self, column, values):
+        return _extend_column(column, values)
+
+    def update(self, positions, values):
+        unknown = values.keys() - self.columns.keys()
+        if unknown:
+            raise ValueError(f"No such columns: {sorted(unknown)!r}")
+        super().update(positions, values)
+
+    def _assign(self, positions, values):
+        for col, value in values.items():
+            column = self.columns[col]
+            if self._unshare(("column", col)):
+                column = copy.copy(column)
+            self.columns[col] = self._assign_column(column, positions, value)
+
+    def _assign_column(self, column, positions, value):
+        return _assign_column(column, positions, value)
+
+    def _remove(self, positions):
+        deleted = set(positions)
+        kept = [i for i in range(len(self)) if i not in deleted]
+        self.columns = self.take(kept).columns
+
+    def _statistics_columns(self):
+        return tuple(self.columns)
+
+    def _column_values(self, column, start):
+        return list(self._index_keys((column,), start))
+
+    def _index_keys(self, columns, start):
+        if not self.columns:
+            return ()
+        if len(columns) == 1:
+            return self.columns[columns[0]][start:]
+        return zip(*(self.columns[col][start:] for col in columns))
+
+    def _row(self, position):
+        return {col: values[position] for col, values in self.columns.items()}
+
+    def take(self, indices):
+        return ColumnTable(
+            self.name,
+            columns={
+                col: _like_column(values, map(values.__getitem__, indices))
+                for col, values in self.columns.items()
+            },
+        )
+
+    def filter(self, pred):
+        positions = None
+        if isinstance(pred, Expr):
+            positions = self._matching(pred, range(len(self)))
+        if positions is None:
+            positions = [i for i, row in enumerate(self) if pred(row)]
+        result = self.take(positions)
+        result.ordered_by = self.ordered_by
+        return result
+
+    def _matching(self, expr, positions):
+        """Those of positions (in order) holding rows that match expr, found
+        a column at a time rather than through row dicts, or None when that
+        needs the row path. Terms are checked in the order and on the rows
+        the row path would check them."""
+        match expr:
+            case And(terms=terms):
+                for term in terms:
+                    positions = self._matching(term, positions)
+                    if positions is None:
+                        return None
+                return positions
+            case Or(terms=terms):
+                matched = set()
+                rest = positions
+                for term in terms:
+                    found = self._matching(term, rest)
+                    if found is None:
+                        return None
+                    matched.update(found)
+                    rest = [position for position in rest if position not in matched]
+                return [position for position in positions if position in matched]
+            case Not(term=term):
+                found = self._matching(term, positions)
+                if found is None:
+                    return None
+                found = set(found)
+                return [position for position in positions if position not in found]
+            case Compare(op=op, left=Col(name=name), right=Const(value=value)):
+                if name not in self.columns:
+                    return None
+                compare = _COMPARISONS[op]
+                values = self._values(name)
+                if isinstance(positions, range) and positions == range(len(values)):
+                    return [i for i, v in enumerate(values) if compare(v, value)]
+                return [i for i in positions if compare(values[i], value)]
+        value = self._value_getter(expr)
+        if value is None:
+            return None
+        return [position for position in positions if value(position)]
+
+    def _value_getter(self, expr):
+        """Function giving expr's value for the row at a position, or None
+        when that needs the row dict."""
+        match expr:
+            case Col(name=name) if name in self.columns:
+                return self._values(name).__getitem__
+            case Const(value=value):
+                return lambda position: value
+            case Compare(op=op, left=left, right=right):
+                compare = _COMPARISONS[op]
+                left, right = self._value_getter(left), self._value_getter(right)
+                if left is None or right is None:
+                    return None
+                return lambda position: compare(left(position), right(position))
+            case In(expr=operand, values=values):
+                operand = self._value_getter(operand)
+                if operand is None:
+                    return None
+                return lambda position: operand(position) in values
+            case Between(expr=operand, low=low, high=high):
+                getters = [self._value_getter(e) for e in (low, operand, high)]
+                if None in getters:
+                    return None
+                low, operand, high = getters
+
+                def between(position):
+                    return low(position) <= operand(position) <= high(position)
+
+                return between
+        return None
+
+    def _values(self, col):
+        """The column's values as the row dicts hold them."""
+        return self.columns[col]
+
+    def __iter__(self):
+        names = tuple(self.columns)
+        for values in zip(*self.columns.values()):
+            yield dict(zip(names, values))
+
+    def __len__(self):
+        for values in self.columns.values():
+            return len(values)
+        return 0
+
+    def __getitem__(self, index: slice):
+        return ColumnTable(
+            self.name,
+            columns={col: values[index] for col, values in self.columns.items()},
+        )
+
+
+def _sum_fits(values):
+    """Whether no sum of the integers in the array values can overflow."""
+    largest = max(abs(int(values.max())), abs(int(values.min())))
+    return largest * len(values) <= numpy.iinfo(values.dtype).max
+
+
+class NumpyTable(ColumnTable):
+    """A ColumnTable whose columns of bools, ints or floats are NumPy arrays.
+    WHERE on Expr predicates, ORDER_BY a column, DISTINCT, GROUP_BY and
+    AGGREGATE over those columns run as array operations; lambdas and
+    columns of anything else take the ColumnTable path. Rows read from it
+    hold plain Python values. Needs NumPy."""
+
+    def __init__(self, name: str, rows=(), columns=None):
+        if numpy is None:
+            raise ImportError("NumpyTable needs numpy")
+        super().__init__(name, rows, columns)
+
+    def _extend_column(self, column, values):
+        if not values:
+            return column
+        if not len(column):
+            return _numpy_column(values)
+        if isinstance(column, numpy.ndarray):
+            new = _numpy_column(values)
+            if isinstance(new, numpy.ndarray) and new.dtype == column.dtype:
+                return numpy.concatenate((column, new))
+            column = column.tolist()
+        column.extend(values)
+        return column
+
+    def _assign_column(self, column, positions, value):
+        if isinstance(column, numpy.ndarray):
+            dtype = _NUMPY_TYPES.get(type(value))
+            if dtype is not None and column.dtype == dtype:
+                try:
+                    column[positions] = value
+                    return column
+                except OverflowError:
+                    pass
+            column = column.tolist()
+        return _assign_column(column, positions, value)
+
+    def _remove(self, positions):
+        kept = numpy.ones(len(self), dtype=bool)
+        kept[positions] = False
+        self.columns = self.take(numpy.flatnonzero(kept)).columns
+
+    def _index_keys(self, columns, start):
+        if not self.columns:
+            return ()
+        keys = [_python_column(self.columns[col][start:]) for col in columns]
+        return keys[0] if len(columns) == 1 else zip(*keys)
+
+    def _row(self, position):
+        return {
+            col: (
+                values[position].item()
+                if isinstance(values, numpy.ndarray)
+                else values[position]
+            )
+            for col, values in self.columns.items()
+        }
+
+    def take(self, indices):
+        if not isinstance(indices, numpy.ndarray):
+            indices = numpy.array(list(indices), dtype=numpy.intp)
+        return NumpyTable(
+            self.name,
+            columns={
+                col: _take_column(values, indices)
+                for col, values in self.columns.items()
+            },
+        )
+
+    def filter(self, pred):
+        mask = self._mask(pred)
+        if mask is None:
+            return super().filter(pred)
+        result = self.take(numpy.flatnonzero(mask))
+        result.ordered_by = self.ordered_by
+        return result
+
+    def __iter__(self):
+        names = tuple(self.columns)
+        columns = map(_python_column, self.columns.values())
+        for values in zip(*columns):
+            yield dict(zip(names, values))
+
+    def __getitem__(self, index: slice):
+        return NumpyTable(
+            self.name,
+            columns={col: values[index].copy() for col, values in self.columns.items()},
+        )
+
+    def _as_column_table(self):
+        """A ColumnTable of the same rows, for the operators to fall back on."""
+        columns = {col: _python_column(values) for col, values in self.columns.items()}
+        return ColumnTable(self.name, columns=columns)
+
+    def _order_by(self, rel, limit=None):
+        """ORDER_BY rel, or None unless rel is a column held in an array."""
+        column = self.columns.get(rel.name) if isinstance(rel, Col) else None
+        if not isinstance(column, numpy.ndarray):
+            return None
+        # A stable sort, so ties keep their input order as with sorted()
+        order = numpy.argsort(column, kind="stable")
+        if limit is not None:
+            order = order[: max(limit, 0)]
+        result = self.take(order)
+        result.ordered_by = rel.name
+        return result
+
+    def _distinct(self, columns):
+        """The DISTINCT rows, or None unless every column is held in an array."""
+        groups = self._groups(columns)
+        if groups is None:
+            return None
+        first, _ = groups
+        values = [_python_column(self.columns[col][first]) for col in columns]
+        return [dict(zip(columns, row)) for row in zip(*values)]
+
+    def _group_by(self, groupBys):
+        """GROUP_BY's rows, or None unless every column is held in an array."""
+        groups = self._groups(groupBys)
+        if groups is None:
+            return None
+        first, ids = groups
+        order = numpy.argsort(ids, kind="stable")
+        bounds = numpy.cumsum(numpy.bincount(ids, minlength=len(first)))[:-1]
+        keys = zip(*(_python_column(self.columns[col][first]) for col in groupBys))
+        return [
+            {"_groupRows": self.take(positions), **dict(zip(groupBys, key))}
+            for key, positions in zip(keys, numpy.split(order, bounds))
+        ]
+
+    def _aggregate(self, groupBys, aggregates):
+        """AGGREGATE's rows, or None unless every column but those counted is
+        held in an array."""
+        if not len(self):
+            return None
+        for agg_name, col in aggregates:
+            if agg_name != "COUNT" and not isinstance(
+                self.columns.get(col), numpy.ndarray
+            ):
+                return None
+        if groupBys:
+            groups = self._groups(groupBys)
+            if groups is None:
+                return None
+            first, ids = groups
+            order = numpy.argsort(ids, kind="stable")
+            counts = numpy.bincount(ids, minlength=len(first))
+            keys = [_python_column(self.columns[col][first]) for col in groupBys]
+        else:
+            order = slice(None)
+            counts = numpy.array([len(self)])
+            keys = []
+        starts = numpy.concatenate(([0], numpy.cumsum(counts)[:-1]))
+        results = []
+        for agg_name, col in aggregates:
+            if agg_name == "COUNT":
+                results.append(counts.tolist())
+                continue
+            values = self.columns[col][order]
+            if agg_name in ("SUM", "AVG"):
+                if values.dtype == numpy.bool_:
+                    values = values.astype(numpy.int64)
+                elif values.dtype.kind == "i" and not _sum_fits(values):
+                    return None
+                result = numpy.add.reduceat(values, starts)
+                if agg_name == "AVG":
+                    result = result / counts
+            else:
+                ufunc = numpy.maximum if agg_name == "MAX" else numpy.minimum
+                result = ufunc.reduceat(values, starts)
+            results.append(result.tolist())
+        names = [f"{agg_name}({col})" for agg_name, col in aggregates]
+        return [
+            {**dict(zip(groupBys, key)), **dict(zip(names, values))}
+            for key, values in zip(zip(*keys) if keys else [()], zip(*results))
+        ]
+
+    def _groups(self, columns):
+        """(position of the first row of each group, group number of every
+        row), numbering the groups in order of first appearance, or None
+        unless every column is held in an array."""
+        arrays = [self.columns.get(col) for col in columns]
+        if not arrays or not all(
+            isinstance(values, numpy.ndarray) for values in arrays
+        ):
+            return None
+        # lexsort is stable and sorts on its last key first
+        order = numpy.lexsort(arrays[::-1])
+        starts = numpy.ones(len(self), dtype=bool)
+        for values in arrays:
+            values = values[order]
+            starts[1:] &= values[1:] == values[:-1]
+        starts = ~starts
+        if len(self):
+            starts[0] = True
+        sorted_ids = numpy.cumsum(starts) - 1
+        first = order[starts]
+        renumber = numpy.empty(len(first), dtype=numpy.intp)
+        renumber[numpy.argsort(first)] = numpy.arange(len(first))
+        ids = numpy.empty(len(self), dtype=numpy.intp)
+        ids[order] = renumber[sorted_ids]
+        return numpy.sort(first), ids
+
+    def _values(self, col):
+        return _python_column(self.columns[col])
+
+    def _mask(self, expr):
+        """expr over every row as an array of bools, or None when that needs
+        the row path."""
+        result = self._vector(expr)
+        if isinstance(result, numpy.ndarray) and result.dtype == numpy.bool_:
+            return result
+        return None
+
+    def _vector(self, expr):
+        """expr over every row as an array, or a Python number for constants,
+        or None when that needs the row path."""
+        try:
+            match expr:
+                case Col(name=name):
+                    column = self.columns.get(name)
+                    return column if isinstance(column, numpy.ndarray) else None
+                case Const(value=value) if type(value) in (bool, int, float):
+                    return value
+                case Compare(op=op, left=left, right=right):
+                    left, right = self._vector(left), self._vector(right)
+                    if left is None or right is None:
+                        return None
+                    if not isinstance(left, numpy.ndarray) and not isinstance(
+                        right, numpy.ndarray
+                    ):
+                        return None
+                    return _COMPARISONS[op](left, right)
+                case And(terms=terms) | Or(terms=terms):
+                    masks = [self._mask(term) for term in terms]
+                    if any(mask is None for mask in masks):
+                        return None
+                    combine = operator.and_ if isinstance(expr, And) else operator.or_
+                    return functools.reduce(combine, masks)
+                case Not(term=term):
+                    mask = self._mask(term)
+                    return None if mask is None else ~mask
+                case In(expr=operand, values=values) if all(
+                    type(value) in (bool, int, float) for value in values
+                ):
+                    column = self._vector(operand)
+                    if not isinstance(column, numpy.ndarray):
+                        return None
+                    return numpy.isin(column, list(values))
+                case Between(expr=operand, low=low, high=high):
+                    return self._vector((low <= operand) & (operand <= high))
+        except OverflowError:
+            # Python ints too big for the array's dtype
+            return None
+        return None
+
+
+class QueryCache:
+    """The results of the last maxsize queries, keyed on their clauses and
+    the versions of the tables they read. Safe to use from several
+    threads."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            result = self._entries.get(key)
+            if result is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return result
+
+    def put(self, key, result):
+        with self._lock:
+            self._entries[key] = result
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, table_name):
+        """Forget the results of queries reading table_name."""
+        with self._lock:
+            for key in [k for k in self._entries if table_name in dict(k[0])]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# What the estimates fall back to without statistics to go on
+_DEFAULT_EQUALITY = 0.005
+_DEFAULT_SELECTIVITY = 1 / 3
+
+
+class TableStatistics:
+    """What ANALYZE learned about a stored table, for estimating how many
+    rows predicates over it and joins with it produce.
+
+    row_count follows the table. The ColumnStatistics in .columns take in
+    inserted rows as they come, and once the rows inserted, updated or
+    deleted since outnumber stale_rows plus stale_fraction of the table,
+    they are collected again. The most common values and histograms come
+    from a sample of sample_size rows. With columns, only those columns are
+    looked at.
+    """
+
+    sample_size = 30_000
+    stale_rows = 50
+    stale_fraction = 0.2
+
+    def __init__(self, table, columns=None):
+        if columns is None:
+            columns = table._statistics_columns()
+        self.row_count = len(table)
+        self.changed = 0
+        sample = None
+        if columns and self.row_count > self.sample_size:
+            rand = random.Random(0)
+            sample = sorted(rand.sample(range(self.row_count), self.sample_size))
+        self.columns = {}
+        for column in columns:
+            values = table._column_values(column, 0)
+            sampled = values if sample is None else [values[i] for i in sample]
+            self.columns[column] = ColumnStatistics(values, sampled)
+
+    def copy(self):
+        result = copy.copy(self)
+        result.columns = {
+            column: stats.copy() for column, stats in self.columns.items()
+        }
+        return result
+
+    def stale(self, changed):
+        """Whether changing that many more rows calls for collecting again."""
+        total = self.changed + changed
+        return total > self.stale_rows + self.stale_fraction * self.row_count
+
+    def extend(self, table, start):
+        """Take in table's rows from start on, which were just inserted."""
+        for column, stats in self.columns.items():
+            stats.extend(table._column_values(column, start))
+        self.changed += len(table) - start
+        self.row_count = len(table)
+
+    def selectivity(self, pred):
+        """Estimated fraction of the rows matching pred, an Expr or
+        (column, op, value) comparison over the table's columns."""
+        pred = _as_pred(pred)
+        match pred:
+            case And(terms=terms):
+                return math.prod(self.selectivity(term) for term in terms)
+            case Or(terms=terms):
+                return 1 - math.prod(1 - self.selectivity(term) for term in terms)
+            case Not(term=term):
+                return 1 - self.selectivity(term)
+            case In(expr=Col(name=name), values=values):
+                found = sum(self._equal(name, value) for value in set(values))
+                return min(found, 1.0)
+            case Between(expr=Col(name=name), low=Const(), high=Const()):
+                return self._range(name, pred.low.value, pred.high.value)
+        comparison = _column_comparison(pred)
+        if comparison is None:
+            return _DEFAULT_SELECTIVITY
+        column, op, value = comparison
+        if op == "==":
+            return self._equal(column, value)
+        if op == "!=":
+            return 1 - self._equal(column, value)
+        if op in ("<", "<="):
+            return self._range(column, None, value)
+        return self._range(column, value, None)
+
+    def join_selectivity(self, column, other, other_column):
+        """Estimated fraction of the pairs of rows from this table and the
+        table other describes where column equals other_column. A column
+        without statistics is taken to hold a different value in every row."""
+        distinct, present = self._distinct(column)
+        other_distinct, other_present = other._distinct(other_column)
+        # Every value of the side with fewer distinct values finds its
+        # matches on the other side
+        return present * other_present / max(distinct, other_distinct, 1)
+
+    def _distinct(self, column):
+        """(Estimated number of distinct values, fraction of the rows not
+        None) of column."""
+        stats = self.columns.get(column)
+        if stats is None:
+            return self.row_count, 1.0
+        return stats.ndv, 1 - stats.null_fraction
+
+    def _equal(self, column, value):
+        stats = self.columns.get(column)
+        if stats is None:
+            return _DEFAULT_EQUALITY
+        if value is None:
+            return stats.null_fraction
+        try:
+            if value in stats.mcv:
+                return stats.mcv[value]
+        except TypeError:
+            # Unhashable, so not among the most common values
+            pass
+        # The other values share what the most common ones leave evenly
+        others = stats.ndv - len(stats.mcv)
+        if others <= 0:
+            return 0.0
+        return stats.rest_fraction / others
+
+    def _range(self, column, low, high):
+        """Estimated fraction of the rows with low <= column <= high, either
+        bound None meaning there is none."""
+        stats = self.columns.get(column)
+        if stats is None or stats.min is None:
+            return _DEFAULT_SELECTIVITY
+        try:
+            found = sum(
+                fraction
+                for value, fraction in stats.mcv.items()
+                if value is not None
+                and (low is None or low <= value)
+                and (high is None or value <= high)
+            )
+            if stats.histogram:
+                below_high = 1.0 if high is None else stats.fraction_below(high)
+                below_low = 0.0 if low is None else stats.fraction_below(low)
+                found += max(below_high - below_low, 0.0) * stats.rest_fraction
+        except TypeError:
+            # Bounds that don't compare with the column's values
+            return _DEFAULT_SELECTIVITY
+        return min(found, 1.0)
+
+    def __repr__(self):
+        return f"TableStatistics(row_count={self.row_count}, columns={self.columns!r})"
+
+
+class ColumnStatistics:
+    """What ANALYZE learned about one column: how many values it has seen and
+    how many of those were None, about how many distinct values there are,
+    the smallest and largest (None if the values don't compare), the most
+    common values with the fraction of rows holding each, and a histogram:
+    bounds splitting the other values into buckets of about equal size."""
+
+    mcv_size = 10
+    buckets = 20
+
+    def __init__(self, values, sample):
+        self.count = 0
+        self.null_count = 0
+        self.min = self.max = None
+        self.sketch = _HyperLogLog()
+        self._comparable = True
+        self.extend(values)
+        self._summarize(sample)
+
+    def copy(self):
+        result = copy.copy(self)
+        result.sketch = self.sketch.copy()
+        return result
+
+    @property
+    def ndv(self):
+        """Estimated number of distinct values, None aside."""
+        return min(self.sketch.estimate(), self.count - self.null_count)
+
+    @property
+    def null_fraction(self):
+        return self.null_count / self.count if self.count else 0.0
+
+    @property
+    def rest_fraction(self):
+        """Fraction of the rows neither None nor one of the most common
+        values, which the histogram describes."""
+        return max(1 - self.null_fraction - sum(self.mcv.values()), 0.0)
+
+    def extend(self, values):
+        present = [value for value in values if value is not None]
+        self.count += len(values)
+        self.null_count += len(values) - len(present)
+        if not present:
+            return
+        self.sketch.update(present)
+        if not self._comparable:
+            return
+        try:
+            low, high = min(present), max(present)
+            if self.min is not None:
+                low, high = min(low, self.min), max(high, self.max)
+        except TypeError:
+            self._comparable = False
+            low = high = None
+        self.min, self.max = low, high
+
+    def fraction_below(self, value):
+        """Estimated fraction of the histogram's values below value."""
+        bounds = self.histogram
+        if value <= bounds[0]:
+            return 0.0
+        if value >= bounds[-1]:
+            return 1.0
+        i = bisect.bisect_right(bounds, value) - 1
+        low, high = bounds[i], bounds[i + 1]
+        within = 0.5
+        if all(isinstance(v, (int, float)) for v in (low, high, value)):
+            within = (value - low) / (high - low)
+        return (i + within) / (len(bounds) - 1)
+
+    def _summarize(self, sample):
+        self.mcv = {}
+        self.histogram = None
+        present = [value for value in sample if value is not None]
+        try:
+            counts = collections.Counter(present)
+        except TypeError:
+            return
+        if len(counts) <= self.mcv_size and len(counts) < len(present):
+            # Few enough values to keep them all
+            threshold = 0
+        else:
+            # Values no more common than average are left to the histogram
+            threshold = max(len(present) / max(len(counts), 1), 1)
+        for value, count in counts.most_common(self.mcv_size):
+            if count > threshold:
+                self.mcv[value] = count / len(sample)
+        if not self._comparable:
+            return
+        rest = sorted(value for value in present if value not in self.mcv)
+        if len(rest) < 2:
+            return
+        buckets = min(self.buckets, len(rest) - 1)
+        self.histogram = [
+            rest[(len(rest) - 1) * i // buckets] for i in range(buckets + 1)
+        ]
+
+    def __repr__(self):
+        return (
+            f"ColumnStatistics(ndv={self.ndv}, null_fraction={self.null_fraction:.3f}, "
+            f"min={self.min!r}, max={self.max!r})"
+        )
+
+
+class _HyperLogLog:
+    """Estimates how many distinct values it has been given to within about
+    1.6%, in 2**precision bytes however many there are (Flajolet et al.,
+    "HyperLogLog: the analysis of a near-optimal cardinality estimation
+    algorithm")."""
+
+    def __init__(self, precision=12):
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+    def copy(self):
+        result = copy.copy(self)
+        result.registers = bytearray(self.registers)
+        return result
+
+    def update(self, values):
+        try:
+            distinct = set(values)
+        except TypeError:
+            distinct = set(map(repr, values))
+        width = 64 - self.precision
+        low_bits = (1 << width) - 1
+        registers = self.registers
+        mask = (1 << 64) - 1
+        for value in distinct:
+            # hash() of an int is the int itself, so mix its bits (SplitMix64)
+            x = hash(value) & mask
+            x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & mask
+            x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & mask
+            x ^= x >> 31
+            i = x >> width
+            rank = width - (x & low_bits).bit_length() + 1
+            if rank > registers[i]:
+                registers[i] = rank
+
+    def estimate(self):
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        raw = alpha * m * m / sum(2.0**-r for r in self.registers)
+        zeros = self.registers.count(0)
+        if raw <= 2.5 * m and zeros:
+            # Few values: count the registers still empty instead
+            return round(m * math.log(m / zeros))
+        return round(raw)
+
+
+class Stream:
+    """A lazily evaluated Table. Rows are pulled from the upstream operators on
+    demand and can only be iterated over once."""
+
+    def __init__(self, name: str, rows, colnames=(), ordered_by=None, source=None):
+        self.name = name
+        self._rows = iter(rows)
+        self._colnames = tuple(colnames)
+        self.ordered_by = ordered_by
+        # The stored Table the rows all come from as they are, if any, which
+        # a join can read in key order through its indexes instead
+        self.source = source
+
+    def _peek(self):
+        first = next(self._rows, None)
+        if first is not None:
+            self._rows = itertools.chain((first,), self._rows)
+            if not self._colnames:
+                self._colnames = tuple(sorted(first.keys()))
+        return first
+
+    def colnames(self):
+        if not self._colnames and self._peek() is None:
+            raise ValueError("Need either rows or manually specified column names")
+        return self._colnames
+
+    def filter(self, pred):
+        return Stream(
+            self.name, (row for row in self if pred(row)), ordered_by=self.ordered_by
+        )
+
+    def __iter__(self):
+        if self._colnames:
+            return self._rows
+        return self._iter_capturing_colnames()
+
+    def _iter_capturing_colnames(self):
+        # Capture the column names before the first row is handed out so that
+        # operators can ask for them mid-iteration without losing a row.
+        if self._peek() is not None:
+            yield from self._rows
+
+    def __repr__(self):
+        if not self.name:
+            return "Stream(...)"
+        return f"Stream({self.name!r}, ...)"
+
+
+def _writes(method):
+    """Make a Database method a write, so that writers take turns."""
+
+    @functools.wraps(method)
+    def write(self, *args, **kwargs):
+        with self._write_lock:
+            return method(self, *args, **kwargs)
+
+    return write
+
+
+class Database:
+    """With a path, the database is kept in that directory: every
+    CREATE_TABLE, INSERT_INTO, in-place UPDATE and DELETE, DROP_TABLE,
+    CREATE_INDEX and DROP_INDEX is appended to a write-ahead log, and
+    CHECKPOINT writes a snapshot of all tables so that reopening only has to
+    replay the log written since.
+
+    With workers > 1, WHERE, SELECT, GROUP_BY and AGGREGATE over tables of at
+    least parallel_min_rows rows split the rows across that many processes
+    and combine their partial results. The processes are forked for each
+    operator so that they share its table and predicate, and so this only
+    happens while no other thread is running.
+
+    With cache_size, query() keeps that many results in a QueryCache (see
+    .cache) and reuses them until a table they read is written to. Queries
+    calling functions (lambdas in where, order_by, ...) aren't cached, since
+    their results can change without any table changing.
+
+    Writes from several threads take turns, while query() reads a snapshot()
+    of the tables without locking and so never waits for them.
+    """
+
+    parallel_min_rows = 100_000
+
+    def __init__(self, path=None, workers=None, cache_size=None):
+        self.tables = {}
+        self.path = path
+        self.workers = workers
+        self.cache = QueryCache(cache_size) if cache_size else None
+        self._log = None
+        self._write_lock = threading.RLock()
+        if path is not None:
+            self._open()
+
+    @_writes
+    def CREATE_TABLE(self, name, colnames=(), columnar=False):
+        if columnar == "numpy":
+            table = NumpyTable(name)
+        else:
+            table = ColumnTable(name) if columnar else Table(name)
+        if colnames:
+            table.set_colnames(colnames)
+        table._publish()
+        self.tables[name] = table
+        self._invalidate(name)
+        self._write_log("CREATE_TABLE", name, tuple(colnames), columnar)
+        return table
+
+    @_writes
+    def DROP_TABLE(self, name):
+        del self.tables[name]
+        self._invalidate(name)
+        self._write_log("DROP_TABLE", name)
+
+    @_writes
+    def CREATE_INDEX(self, table_name, columns, kind="hash"):
+        table = self.tables[table_name]
+        index = table.create_index(columns, kind)
+        table._publish()
+        self._write_log("CREATE_INDEX", table_name, index.columns, kind)
+        return index
+
+    @_writes
+    def DROP_INDEX(self, table_name, columns):
+        if isinstance(columns, str):
+            columns = (columns,)
+        table = self.tables[table_name]
+        del table.indexes[tuple(columns)]
+        table._publish()
+        self._write_log("DROP_INDEX", table_name, tuple(columns))
+
+    @_writes
+    def ANALYZE(self, table_name=None):
+        """Collect TableStatistics about the named table, or every table,
+        which then stay roughly current as it is written to (see .statistics
+        on the table). They are kept in memory only, so analyze again after
+        reopening a database."""
+        names = list(self.tables) if table_name is None else [table_name]
+        for name in names:
+            self.tables[name].analyze()
+            self.tables[name]._publish()
+        if table_name is not None:
+            return self.tables[table_name].statistics
+
+    def execute(self, sql):
+        """Run a SELECT statement (see parse) and return its result."""
+        return query(self, **_parse_cached(sql).clauses)
+
+    async def aexecute(self, sql, **kwargs):
+        """execute() for asyncio code; kwargs are passed on to aquery()."""
+        return await aquery(self, **kwargs, **_parse_cached(sql).clauses)
+
+    @_writes
+    def CHECKPOINT(self):
+        """Snapshot every table and start a new, empty log."""
+        if self.path is None:
+            raise ValueError("Only a database opened with a path can checkpoint")
+        generation = self._generation + 1
+        # Start the new log before the snapshot refers to it: if we crash
+        # before the snapshot is in place, the old snapshot and both logs are
+        # replayed instead.
+        log = open(self._log_path(generation), "ab")
+        state = {
+            "generation": generation,
+            "tables": [_table_state(table) for table in self.tables.values()],
+        }
+        snapshot_path = os.path.join(self.path, "snapshot")
+        with open(snapshot_path + ".tmp", "wb") as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(snapshot_path + ".tmp", snapshot_path)
+        self._log.close()
+        os.remove(self._log_path(self._generation))
+        self._log, self._generation = log, generation
+
+    def snapshot(self, names=None):
+        """A read-only Database holding the named tables, or every table, as
+        the last write to each left them. Writes still under way or made
+        afterwards don't show in it, and the old versions it holds are freed
+        with it. Taking one only waits for a write that is changing in place
+        what the last one left, which it does when no snapshot has taken that
+        (see Table._unshare)."""
+        tables = dict(self.tables)
+        if names is not None:
+            tables = {name: tables[name] for name in names if name in tables}
+        snapshot = copy.copy(self)
+        snapshot.tables = {name: self._take(table) for name, table in tables.items()}
+        snapshot._log = None
+        return snapshot
+
+    def _take(self, table):
+        """The committed copy of table, marked as handed out."""
+        committed = table._committed
+        if committed is None:
+            # The tables of a snapshot are committed copies already
+            return table
+        committed._taken = True
+        if committed._changing:
+            # It may be out of date, or being changed: wait for the write
+            with self._write_lock:
+                committed = table._committed
+                committed._taken = True
+        return committed
+
+    def close(self):
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+
+    def _open(self):
+        os.makedirs(self.path, exist_ok=True)
+        self._generation = 0
+        snapshot_path = os.path.join(self.path, "snapshot")
+        if os.path.exists(snapshot_path) and os.path.getsize(snapshot_path):
+            with open(snapshot_path, "rb") as f:
+                state = pickle.load(f)
+            self._generation = state["generation"]
+            for table_state in state["tables"]:
+                table = _table_from_state(table_state)
+                table._publish()
+                self.tables[table.name] = table
+        generations = sorted(
+            int(name[len("log.") :])
+            for name in os.listdir(self.path)
+            if name.startswith("log.")
+        )
+        for generation in generations:
+            if generation < self._generation:
+                # Already part of the snapshot
+                os.remove(self._log_path(generation))
+                continue
+            for op, *args in _read_log(self._log_path(generation)):
+                getattr(self, op)(*args)
+            self._generation = generation
+        self._log = open(self._log_path(self._generation), "ab")
+
+    def _log_path(self, generation):
+        return os.path.join(self.path, f"log.{generation}")
+
+    def _write_log(self, op, *args):
+        if self._log is None:
+            return
+        pickle.dump((op, *args), self._log, protocol=pickle.HIGHEST_PROTOCOL)
+        self._log.flush()
+        os.fsync(self._log.fileno())
+
+    def FROM(self, first_table, *rest):
+        match rest:
+            case ():
+                return self.tables[first_table]
+            case _:
+                return _materialize(self._stream_from(first_table, *rest))
+
+    def _stream_from(self, first_table, *rest):
+        tables = [self.tables[name] for name in (first_table, *rest)]
+        if not rest:
+            return Stream(tables[0].name, tables[0], tables[0]._colnames)
+        return Stream("", self._cross_product(tables))
+
+    def _cross_product(self, tables):
+        # Same rows and key order as CROSS_JOIN(a, CROSS_JOIN(b, ...)) without
+        # materializing the inner products.
+        if not all(len(table) for table in tables):
+            return
+        first, *rest = tables
+        first_cols = _mangled_colnames(first)
+        rest_cols = sorted(
+            (name, i, k)
+            for i, table in enumerate(rest)
+            for name, k in _mangled_colnames(table)
+        )
+        schema = Schema([c[0] for c in first_cols + rest_cols])
+        first_values = _values_getter([k for _, k in first_cols])
+        rest_keys = [(i, k) for _, i, k in rest_cols]
+        for x in first:
+            x_values = first_values(x)
+            for ys in itertools.product(*rest):
+                yield Record(schema, x_values + tuple(ys[i][k] for i, k in rest_keys))
+
+    def SELECT(self, table, columns, aliases=None):
+        if aliases is None:
+            aliases = {}
+        if isinstance(table, ColumnTable):
+            return type(table)(
+                table.name,
+                columns={
+                    aliases.get(col, col): copy.copy(table.columns[col])
+                    for col in columns
+                },
+            )
+        schema = Schema([aliases.get(col, col) for col in columns])
+        values = _values_getter(columns)
+        if self._parallel(table):
+            parts = _run_partitions(
+                self.workers,
+                len(table),
+                lambda start, stop: [values(table._row(i)) for i in range(start, stop)],
+            )
+            rows = (Record(schema, row) for part in parts for row in part)
+            return Table(table.name, rows)
+        return _like(table, table.name, (Record(schema, values(row)) for row in table))
+
+    def WHERE(self, table, pred):
+        pred = _as_pred(pred)
+        result = _index_scan(table, pred)
+        if result is not None:
+            return result
+        if self._parallel(table):
+            parts = _run_partitions(
+                self.workers,
+                len(table),
+                lambda start, stop: [
+                    i for i in range(start, stop) if pred(table._row(i))
+                ],
+            )
+            result = table.take(list(itertools.chain.from_iterable(parts)))
+            result.ordered_by = table.ordered_by
+            return result
+        return table.filter(pred)
+
+    @_writes
+    def INSERT_INTO(self, table_name, rows):
+        # rows can be any iterable, including a generator streaming a bulk load
+        table = self.tables[table_name]
+        self._invalidate(table_name)
+        if self._log is None:
+            table.extend(rows)
+            return
+        rows = [dict(row) for row in rows]
+        table.extend(rows)
+        self._write_log("INSERT_INTO", table_name, rows)
+
+    def UPDATE(self, table, set, pred=lambda _: True):
+        """Given a table, return a copy of it where the rows matching pred
+        have the values in set. Given the name of a table, update its matching
+        rows in place instead, finding them through its indexes if it can,
+        and return how many there were."""
+        pred = _as_pred(pred)
+        if isinstance(table, str):
+            return self._update_in_place(table, set, pred)
+        result = _like(
+            table, table.name, ({**row, **set} if pred(row) else row for row in table)
+        )
+        if isinstance(table, Table):
+            for columns, index in table.indexes.items():
+                result.create_index(columns, index.kind)
+        return result
+
+    @_writes
+    def DELETE(self, table_name, pred=lambda _: True):
+        """Delete the rows of the named table matching pred, finding them
+        through its indexes if it can, and return how many there were."""
+        positions = _matching_positions(self.tables[table_name], _as_pred(pred))
+        if positions:
+            self._delete_rows(table_name, positions)
+        return len(positions)
+
+    @_writes
+    def _update_in_place(self, table_name, set, pred):
+        positions = _matching_positions(self.tables[table_name], pred)
+        if positions:
+            self._update_rows(table_name, positions, set)
+        return len(positions)
+
+    # UPDATE and DELETE are logged as these, by position, because their
+    # predicates need not pickle.
+
+    def _update_rows(self, table_name, positions, values):
+        self.tables[table_name].update(positions, values)
+        self._invalidate(table_name)
+        self._write_log("_update_rows", table_name, positions, dict(values))
+
+    def _delete_rows(self, table_name, positions):
+        self.tables[table_name].delete(positions)
+        self._invalidate(table_name)
+        self._write_log("_delete_rows", table_name, positions)
+
+    def CROSS_JOIN(self, a, b):
+        return _like(a, "", self._cross_join(a, _materialize(b)))
+
+    def _cross_join(self, a, b):
+        if _is_empty(a) or _is_empty(b):
+            return
+        schema, a_values, b_values = _join_schema(a, b)
+        b_rows = [b_values(y) for y in b.rows]
+        for x in a:
+            x_values = a_values(x)
+            for y_values in b_rows:
+                yield Record(schema, x_values + y_values)
+
+    def INNER_JOIN(self, a, b, pred):
+        on, residual = _equi_join_key(a, b, pred)
+        if on is not None:
+            return _like(a, "", self._equi_join(a, b, on, False, residual))
+        return self.CROSS_JOIN(a, b).filter(pred)
+
+    JOIN = INNER_JOIN
+
+    def LEFT_JOIN(self, a, b, pred):
+        # Unlike the other joins, unnamed tables still get a "." prefix here
+        prefixes = (f"{a.name}.", f"{b.name}.")
+        on, residual = _equi_join_key(a, b, pred, prefixes)
+        if on is not None:
+            return _like(a, "", self._equi_join(a, b, on, True, residual, prefixes))
+        rows = self._nested_loop_left_join(a, _materialize(b), pred, prefixes)
+        return _like(a, "", rows)
+
+    def _nested_loop_left_join(self, a, b, pred, prefixes):
+        empty_b_values = (None,) * len(b.colnames())
+        if _is_empty(a):
+            return
+        schema, a_values, b_values = _join_schema(a, b, *prefixes)
+        b_rows = [b_values(b_row) for b_row in b.rows]
+        for a_row in a:
+            added = False
+            x_values = a_values(a_row)
+            for y_values in b_rows:
+                row = Record(schema, x_values + y_values)
+                if pred(row):
+                    yield row
+                    added = True
+            if not added:
+                yield Record(schema, x_values + empty_b_values)
+
+    def _equi_join(self, a, b, on, outer, residual=None, prefixes=(None, None)):
+        if _is_empty(a) or (_is_empty(b) and not outer):
+            return
+        a_key, b_key = _resolve_join_key(a, b, on, prefixes)
+        schema, a_values, b_values = _join_schema(a, b, *prefixes)
+        empty_b_values = (None,) * len(b.colnames())
+        b_in_key_order = _in_key_order(b, b_key)
+        a_in_key_order = None if b_in_key_order is None else _in_key_order(a, a_key)
+        if a_in_key_order is not None:
+            # Then the rows come in key order rather than in a's
+            matches = _merge_matches(a_in_key_order, a_key, b, b_in_key_order, b_key)
+        else:
+            matches = _hash_matches(a, a_key, b, b_key)
+        for a_row, b_rows in matches:
+            x_values = a_values(a_row)
+            added = False
+            for b_row in b_rows:
+                row = Record(schema, x_values + b_values(b_row))
+                if residual is None or residual(row):
+                    yield row
+                    added = True
+            if outer and not added:
+                yield Record(schema, x_values + empty_b_values)
+
+    def RIGHT_JOIN(self, a, b, pred):
+        return self.LEFT_JOIN(b, a, pred)
+
+    def LIMIT(self, table, limit):
+        if isinstance(table, Stream) and limit is not None and limit < 0:
+            # islice takes no negative bounds, so slice the rows as Tables do
+            result = Stream(table.name, list(table)[:limit])
+        elif isinstance(table, Stream):
+            result = Stream(table.name, itertools.islice(table, limit))
+        elif isinstance(table, ColumnTable):
+            result = table[:limit]
+        else:
+            result = Table(table.name, table.rows[:limit])
+        result.ordered_by = table.ordered_by
+        return result
+
+    def ORDER_BY(self, table, rel, limit=None):
+        # Differs from JS version by passing the whole row to the comparator
+        if isinstance(table, NumpyTable):
+            result = table._order_by(rel, limit)
+            if result is not None:
+                return result
+        if limit is not None:
+            # Only the first limit rows are wanted: keep a heap of that size
+            # instead of sorting everything. Ties keep their input order, same
+            # as sorted().
+            rows = heapq.nsmallest(limit, table, key=rel)
+        else:
+            rows = sorted(table, key=rel)
+        result = _like(table, table.name, rows)
+        if isinstance(rel, Col):
+            result.ordered_by = rel.name
+        return result
+
+    def HAVING(self, table, pred):
+        return table.filter(_as_pred(pred))
+
+    def OFFSET(self, table, offset):
+        if isinstance(table, Stream) and offset is not None and offset < 0:
+            result = Stream(table.name, list(table)[offset:])
+        elif isinstance(table, Stream):
+            result = Stream(table.name, itertools.islice(table, offset, None))
+        elif isinstance(table, ColumnTable):
+            result = table[offset:]
+        else:
+            result = Table(table.name, table.rows[offset:])
+        result.ordered_by = table.ordered_by
+        return result
+
+    def DISTINCT(self, table, columns):
+        if isinstance(table, NumpyTable):
+            rows = table._distinct(columns)
+            if rows is not None:
+                return Table(table.name, rows)
+            table = table._as_column_table()
+        return _like(table, table.name, self._distinct(table, columns))
+
+    def _distinct(self, table, columns):
+        seen = set()
+        for row in table:
+            view = tuple((col, row[col]) for col in columns)
+            if view not in seen:
+                seen.add(view)
+                yield dict(view)
+
+    def GROUP_BY(self, table, groupBys):
+        if isinstance(table, NumpyTable):
+            rows = table._group_by(groupBys)
+            if rows is not None:
+                return Table(table.name, rows)
+            table = table._as_column_table()
+        if self._parallel(table):
+            return self._parallel_group_by(table, groupBys)
+        if isinstance(table, ColumnTable):
+            return self._group_by_columns(table, groupBys)
+        groupRows = {}
+        for row in table:
+            key = tuple(row[col] for col in groupBys)
+            if key not in groupRows:
+                groupRows[key] = []
+            groupRows[key].append(row)
+        resultRows = []
+        for group in groupRows.values():
+            resultRow = {"_groupRows": group}
+            for col in groupBys:
+                resultRow[col] = group[0][col]
+            resultRows.append(resultRow)
+        return _like(table, table.name, resultRows)
+
+    def _group_by_columns(self, table, groupBys):
+        # Each group's _groupRows is a ColumnTable so that aggregates can keep
+        # reading its columns directly.
+        groups = {}
+        for i, key in enumerate(zip(*(table.columns[col] for col in groupBys))):
+            groups.setdefault(key, []).append(i)
+        return Table(
+            table.name,
+            [
+                {"_groupRows": table.take(indices), **dict(zip(groupBys, key))}
+                for key, indices in groups.items()
+            ],
+        )
+
+    def _parallel_group_by(self, table, groupBys):
+        group_key = _values_getter(groupBys)
+
+        def group_positions(start, stop):
+            groups = {}
+            for i in range(start, stop):
+                groups.setdefault(group_key(table._row(i)), []).append(i)
+            return groups
+
+        groups = {}
+        for part in _run_partitions(self.workers, len(table), group_positions):
+            for key, positions in part.items():
+                groups.setdefault(key, []).extend(positions)
+        if isinstance(table, ColumnTable):
+            group_rows = table.take
+        else:
+            group_rows = lambda positions: [table._row(i) for i in positions]
+        return Table(
+            table.name,
+            [
+                {"_groupRows": group_rows(positions), **dict(zip(groupBys, key))}
+                for key, positions in groups.items()
+            ],
+        )
+
+    def _aggregate(self, table, col, agg_name, agg):
+        col_name = f"{agg_name}({col})"
+        if isinstance(table, NumpyTable):
+            table = table._as_column_table()
+        if isinstance(table, ColumnTable):
+            return Table(table.name, [{col_name: agg(table)}])
+        table = _materialize(table)
+        grouped = table.rows and "_groupRows" in table.rows[0]
+        if not grouped:
+            return Table(table.name, [{col_name: agg(table.rows)}])
+        rows = []
+        for row in table.rows:
+            new_row = {}
+            for key, value in row.items():
+                if key == "_groupRows":
+                    new_row[col_name] = agg(value)
+                else:
+                    new_row[key] = value
+            rows.append(new_row)
+        return Table(table.name, rows)
+
+    def COUNT(self, table, col):
+        return self._aggregate(table, col, "COUNT", len)
+
+    def MAX(self, table, col):
+        return self._aggregate(table, col, "MAX", lambda rows: max(_values(rows, col)))
+
+    def SUM(self, table, col):
+        return self._aggregate(table, col, "SUM", lambda rows: sum(_values(rows, col)))
+
+    def MIN(self, table, col):
+        return self._aggregate(table, col, "MIN", lambda rows: min(_values(rows, col)))
+
+    def AVG(self, table, col):
+        return self._aggregate(
+            table, col, "AVG", lambda rows: sum(_values(rows, col)) / len(rows)
+        )
+
+    def AGGREGATE(self, table, groupBys, aggregates):
+        """GROUP_BY followed by any number of aggregates, computed in a single
+        pass with one accumulator per group and aggregate.
+
+        aggregates is a list of (function, column) pairs such as
+        [("COUNT", "id"), ("MAX", "score")]. Each output row holds the group
+        columns followed by one "FUNCTION(column)" value per aggregate. Without
+        groupBys the whole table is one group.
+        """
+        aggregates = [(agg_name.upper(), col) for agg_name, col in aggregates]
+        for agg_name, _ in aggregates:
+            if agg_name not in _ACCUMULATORS:
+                raise ValueError(f"Unknown aggregate {agg_name!r}")
+        if isinstance(table, NumpyTable):
+            rows = table._aggregate(groupBys, aggregates)
+            if rows is not None:
+                return Table(table.name, rows)
+            table = table._as_column_table()
+        if self._parallel(table):
+            # Each process accumulates its share of the rows, then the partial
+            # states of every group are merged in row order.
+            parts = _run_partitions(
+                self.workers,
+                len(table),
+                lambda start, stop: _accumulate(
+                    _slice(table, start, stop), groupBys, aggregates
+                ),
+            )
+            groups = parts[0]
+            for part in parts[1:]:
+                for key, states in part.items():
+                    merged = groups.setdefault(key, states)
+                    if merged is not states:
+                        for state, other in zip(merged, states):
+                            state.merge(other)
+        else:
+            groups = _accumulate(table, groupBys, aggregates)
+        names = [f"{agg_name}({col})" for agg_name, col in aggregates]
+        rows = (
+            {
+                **dict(zip(groupBys, key)),
+                **{name: state.result() for name, state in zip(names, states)},
+            }
+            for key, states in groups.items()
+        )
+        return _like(table, table.name, rows)
+
+    def _invalidate(self, table_name):
+        if self.cache is not None:
+            self.cache.invalidate(table_name)
+
+    def _parallel(self, table):
+        return (
+            self.workers is not None
+            and self.workers > 1
+            and isinstance(table, Table)
+            and not isinstance(table, NumpyTable)
+            and len(table) >= self.parallel_min_rows
+            and "fork" in multiprocessing.get_all_start_methods()
+            # Forking while other threads run can leave a lock they hold
+            # locked forever in the children
+            and threading.active_count() == 1
+        )
+
+    def __repr__(self):
+        return f"Database({list(self.tables.keys())!r})"
+
+
+def _like(table, name, rows):
+    """Wrap rows in the same kind of table as the operator's input: operators
+    over a Stream stay lazy, operators over a Table materialize."""
+    if isinstance(table, Stream):
+        return Stream(name, rows)
+    return Table(name, rows)
+
+
+def _materialize(table):
+    """Return a row-backed Table that can be scanned repeatedly."""
+    if type(table) is Table:
+        return table
+    result = Table(table.name, table)
+    if isinstance(table, Stream):
+        result._colnames = table._colnames
+    elif table.columns:
+        result.set_colnames(table.columns)
+    return result
+
+
+def _table_state(table):
+    """Everything needed to rebuild table, stored column by column so that
+    columns of numbers pickle as packed arrays."""
+    indexes = [(columns, index.kind) for columns, index in table.indexes.items()]
+    if isinstance(table, NumpyTable):
+        return (table.name, "numpy", dict(table.columns), indexes)
+    if isinstance(table, ColumnTable):
+        return (table.name, "columns", dict(table.columns), indexes)
+    rows = table.rows
+    keys = list(rows[0]) if rows else []
+    if all(len(row) == len(keys) and all(k in row for k in keys) for row in rows):
+        columns = {k: _pack_column([row[k] for row in rows]) for k in keys}
+        return (table.name, "rows", (table._colnames, columns), indexes)
+    # Rows with differing columns are kept as they are
+    rows = [dict(row) for row in rows]
+    return (table.name, "dicts", (table._colnames, rows), indexes)
+
+
+def _table_from_state(state):
+    name, kind, data, indexes = state
+    if kind == "columns":
+        table = ColumnTable(name, columns=data)
+    elif kind == "numpy":
+        table = NumpyTable(name, columns=data)
+    else:
+        colnames, rows = data
+        if kind == "rows":
+            keys = list(rows)
+            rows = [dict(zip(keys, values)) for values in zip(*rows.values())]
+        table = Table(name, rows)
+        table._colnames = colnames
+    for columns, kind in indexes:
+        table.create_index(columns, kind)
+    return table
+
+
+def _read_log(path):
+    """The operations in the log at path. A record left half-written by a
+    crash ends the log and is cut off so that new records follow the last
+    complete one."""
+    with open(path, "r+b") as f:
+        while True:
+            position = f.tell()
+            try:
+                record = pickle.load(f)
+            except (EOFError, pickle.UnpicklingError):
+                f.truncate(position)
+                return
+            yield record
+
+
+def _is_empty(table):
+    if isinstance(table, Stream):
+        return table._peek() is None
+    return not len(table)
+
+
+def _values(rows, col):
+    if isinstance(rows, NumpyTable):
+        return _python_column(rows.columns[col])
+    if isinstance(rows, ColumnTable):
+        return rows.columns[col]
+    return (row[col] for row in rows)
+
+
+def _accumulate(table, groupBys, aggregates):
+    """{group key: accumulator per aggregate} over the rows of table."""
+    new_states = lambda: [_ACCUMULATORS[agg_name]() for agg_name, _ in aggregates]
+    groups = {}
+    inputs = _aggregate_inputs(table, groupBys, aggregates)
+    if not groupBys:
+        groups[()] = states = new_states()
+        if isinstance(table, ColumnTable):
+            # Whole columns at a time
+            for state, (agg_name, col) in zip(states, aggregates):
+                state.extend(table if agg_name == "COUNT" else table.columns[col])
+            inputs = ()
+    for key, values in inputs:
+        states = groups.get(key)
+        if states is None:
+            groups[key] = states = new_states()
+        for state, value in zip(states, values):
+            state.add(value)
+    return groups
+
+
+def _slice(table, start, stop):
+    if isinstance(table, ColumnTable):
+        return table[start:stop]
+    return Table(table.name, table.rows[start:stop])
+
+
+# The task of the running _run_partitions call. Worker processes are forked
+# after it is set and inherit it, so it doesn't need to be picklable (and can
+# be a lambda closing over unpicklable predicates); only the partition bounds
+# and the results travel between processes.
+_partition_task = None
+
+
+def _run_partitions(workers, size, task):
+    """[task(start, stop) for each of workers slices of range(size)], run in
+    a pool of forked processes."""
+    global _partition_task
+    if not size:
+        return [task(0, 0)]
+    step = -(-size // workers)
+    bounds = [(start, min(start + step, size)) for start in range(0, size, step)]
+    _partition_task = task
+    try:
+        with concurrent.futures.ProcessPoolExecutor(
+            len(bounds), mp_context=multiprocessing.get_context("fork")
+        ) as pool:
+            return list(pool.map(_run_partition, bounds))
+    finally:
+        _partition_task = None
+
+
+def _run_partition(bounds):
+    return _partition_task(*bounds)
+
+
+def _aggregate_inputs(table, groupBys, aggregates):
+    """(group key, aggregated values) for every row of table."""
+    if isinstance(table, ColumnTable):
+        keys = zip(*(table.columns[col] for col in groupBys))
+        columns = [
+            itertools.repeat(None) if agg_name == "COUNT" else table.columns[col]
+            for agg_name, col in aggregates
+        ]
+        return zip(keys, zip(*columns) if columns else itertools.repeat(()))
+    getters = [
+        (lambda row: None) if agg_name == "COUNT" else operator.itemgetter(col)
+        for agg_name, col in aggregates
+    ]
+    return (
+        (tuple(row[col] for col in groupBys), [get(row) for get in getters])
+        for row in table
+    )
+
+
+class _Count:
+    __slots__ = ("count",)
+
+    def __init__(self):
+        self.count = 0
+
+    def add(self, value):
+        self.count += 1
+
+    def extend(self, values):
+        self.count += len(values)
+
+    def merge(self, other):
+        self.count += other.count
+
+    def result(self):
+        return self.count
+
+
+class _Sum:
+    __slots__ = ("total",)
+
+    def __init__(self):
+        self.total = 0
+
+    def add(self, value):
+        self.total += value
+
+    def extend(self, values):
+        self.total += sum(values)
+
+    def merge(self, other):
+        self.total += other.total
+
+    def result(self):
+        return self.total
+
+
+class _Max:
+    __slots__ = ("value", "empty")
+
+    def __init__(self):
+        self.value = None
+        self.empty = True
+
+    def add(self, value):
+        if self.empty or value > self.value:
+            self.value = value
+            self.empty = False
+
+    def extend(self, values):
+        if len(values):
+            self.add(max(values))
+
+    def merge(self, other):
+        if not other.empty:
+            self.add(other.value)
+
+    def result(self):
+        return self.value
+
+
+class _Min(_Max):
+    __slots__ = ()
+
+    def add(self, value):
+        if self.empty or value < self.value:
+            self.value = value
+            self.empty = False
+
+    def extend(self, values):
+        if len(values):
+            self.add(min(values))
+
+
+class _Avg:
+    __slots__ = ("total", "count")
+
+    def __init__(self):
+        self.total = 0
+        self.count = 0
+
+    def add(self, value):
+        self.total += value
+        self.count += 1
+
+    def extend(self, values):
+        self.total += sum(values)
+        self.count += len(values)
+
+    def merge(self, other):
+        self.total += other.total
+        self.count += other.count
+
+    def result(self):
+        return self.total / self.count if self.count else None
+
+
+_ACCUMULATORS = {"COUNT": _Count, "SUM": _Sum, "MAX": _Max, "MIN": _Min, "AVG": _Avg}
+
+
+_ARRAY_TYPES = {"q": int, "d": float}
+
+if numpy is not None:
+    _NUMPY_TYPES = {bool: numpy.bool_, int: numpy.int64, float: numpy.float64}
+
+
+def _pack_column(values):
+    values = list(values)
+    for typecode, type_ in _ARRAY_TYPES.items():
+        if values and all(type(value) is type_ for value in values):
+            try:
+                return array.array(typecode, values)
+            except OverflowError:
+                break
+    return values
+
+
+def _numpy_column(values):
+    """values as a NumPy array if they are all bools, all ints or all floats,
+    else as a list."""
+    values = list(values)
+    for type_, dtype in _NUMPY_TYPES.items():
+        if values and all(type(value) is type_ for value in values):
+            try:
+                return numpy.array(values, dtype=dtype)
+            except OverflowError:
+                break
+    return values
+
+
+def _python_column(column):
+    """column's values as Python objects rather than NumPy scalars."""
+    if isinstance(column, numpy.ndarray):
+        return column.tolist()
+    return column
+
+
+def _take_column(column, positions):
+    if isinstance(column, numpy.ndarray):
+        return column[positions]
+    return [column[i] for i in positions.tolist()]
+
+
+def _assign_column(column, positions, value):
+    if isinstance(column, array.array):
+        if type(value) is _ARRAY_TYPES[column.typecode]:
+            try:
+                for position in positions:
+                    column[position] = value
+                return column
+            except OverflowError:
+                pass
+        column = list(column)
+    for position in positions:
+        column[position] = value
+    return column
+
+
+def _like_column(column, values):
+    if isinstance(column, array.array):
+        return array.array(column.typecode, values)
+    return list(values)
+
+
+def _extend_column(column, values):
+    if not column:
+        return _pack_column(values)
+    if isinstance(column, array.array):
+        type_ = _ARRAY_TYPES[column.typecode]
+        if all(type(value) is type_ for value in values):
+            try:
+                column.extend(array.array(column.typecode, values))
+                return column
+            except OverflowError:
+                pass
+        column = list(column)
+    column.extend(values)
+    return column
+
+
+_COMPARISONS = {
+    "==": operator.eq,
+    "!=": operator.ne,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+}
+
+
+_FLIPPED = {"==": "==", "!=": "!=", "<": ">", "<=": ">=", ">": "<", ">=": "<="}
+
+
+def _is_comparison(pred):
+    return isinstance(pred, tuple) and len(pred) == 3 and pred[1] in _COMPARISONS
+
+
+def _as_pred(pred):
+    """Turn a (column, op, value) comparison into the equivalent Expr."""
+    if not _is_comparison(pred):
+        return pred
+    column, op, value = pred
+    return Compare(op, Col(column), Const(value))
+
+
+def _column_comparison(pred):
+    """(column, op, value) if pred compares a column against a constant."""
+    if not isinstance(pred, Compare):
+        return None
+    left, op, right = pred.left, pred.op, pred.right
+    if isinstance(left, Const) and isinstance(right, Col):
+        left, op, right = right, _FLIPPED[op], left
+    if isinstance(left, Col) and isinstance(right, Const):
+        return left.name, op, right.value
+    return None
+
+
+def _conjuncts(pred):
+    return pred.terms if isinstance(pred, And) else (pred,)
+
+
+def _index_lookup(table, pred):
+    """Positions of the rows that may match pred found through table's
+    indexes, or None if no index can narrow it down. The result can be a
+    superset of the matching rows."""
+    if not isinstance(table, Table) or not table.indexes:
+        return None
+    pred = _as_pred(pred)
+    if isinstance(pred, And):
+        equal = {}
+        for term in pred.terms:
+            comparison = _column_comparison(term)
+            if comparison is not None and comparison[1] == "==":
+                equal.setdefault(comparison[0], comparison[2])
+        for columns, index in table.indexes.items():
+            if len(columns) > 1 and all(column in equal for column in columns):
+                return index.lookup(tuple(equal[column] for column in columns))
+        lookups = (_index_lookup(table, term) for term in pred.terms)
+        return next((found for found in lookups if found is not None), None)
+    if isinstance(pred, Or):
+        found = [_index_lookup(table, term) for term in pred.terms]
+        if any(positions is None for positions in found):
+            return None
+        return sorted(set(itertools.chain.from_iterable(found)))
+    if isinstance(pred, In) and isinstance(pred.expr, Col):
+        index = table.indexes.get((pred.expr.name,))
+        if index is None:
+            return None
+        found = map(index.lookup, pred.values)
+        return sorted(set(itertools.chain.from_iterable(found)))
+    if isinstance(pred, Between) and isinstance(pred.expr, Col):
+        index = table.indexes.get((pred.expr.name,))
+        if not isinstance(index, SortedIndex):
+            return None
+        if not isinstance(pred.low, Const) or not isinstance(pred.high, Const):
+            return None
+        if pred.low.value is None or pred.high.value is None:
+            return None
+        return _index_range(index, pred.low.value, pred.high.value)
+    comparison = _column_comparison(pred)
+    if comparison is None:
+        return None
+    column, op, value = comparison
+    index = table.indexes.get((column,))
+    if index is None or op == "!=":
+        return None
+    if op == "==":
+        return index.lookup(value)
+    if not isinstance(index, SortedIndex) or value is None:
+        return None
+    if op in ("<", "<="):
+        return _index_range(index, high=value, high_inclusive=op == "<=")
+    return _index_range(index, low=value, low_inclusive=op == ">=")
+
+
+def _index_range(index, *args, **kwargs):
+    """index.range(), or None if the bounds can't be ordered against the
+    keys, leaving the comparisons to a scan."""
+    try:
+        return index.range(*args, **kwargs)
+    except TypeError:
+        return None
+
+
+def _matching_positions(table, pred):
+    """Sorted positions of the rows of a stored table matching pred."""
+    positions = _index_lookup(table, pred)
+    if positions is not None:
+        return [i for i in sorted(set(positions)) if pred(table._row(i))]
+    if isinstance(table, NumpyTable):
+        mask = table._mask(pred)
+        if mask is not None:
+            return numpy.flatnonzero(mask).tolist()
+    return [i for i, row in enumerate(table) if pred(row)]
+
+
+def _index_scan(table, pred):
+    positions = _index_lookup(table, pred)
+    if positions is None:
+        return None
+    # Indexes may return a superset of the matches, so re-check them
+    return table.take(sorted(positions)).filter(pred)
+
+
+def _is_join_key(pred):
+    return isinstance(pred, tuple) and len(pred) == 2 and all(
+        isinstance(key, str) for key in pred
+    )
+
+
+def _hash_matches(a, a_key, b, b_key):
+    """(a row, matching b rows) for every row of a, in a's order."""
+    index = b.indexes.get((b_key,)) if isinstance(b, Table) else None
+    if index is not None:
+        return (
+            (a_row, [b._row(i) for i in index.lookup(a_row[a_key])]) for a_row in a
+        )
+    buckets = {}
+    if isinstance(a, Table) and isinstance(b, Table) and len(a) < len(b):
+        # Build on the smaller left side, bucketing matches per left row so
+        # the output stays in the same left-major order as a nested loop.
+        for i, a_row in enumerate(a):
+            buckets.setdefault(a_row[a_key], []).append(i)
+        by_a_row = {}
+        for b_row in b:
+            for i in buckets.get(b_row[b_key], ()):
+                by_a_row.setdefault(i, []).append(b_row)
+        return zip(a, (by_a_row.get(i, ()) for i in range(len(a))))
+    for b_row in b:
+        buckets.setdefault(b_row[b_key], []).append(b_row)
+    return ((a_row, buckets.get(a_row[a_key], ())) for a_row in a)
+
+
+def _in_key_order(table, key):
+    """table's rows sorted by key (ties in table order), if that is available
+    without sorting, else None."""
+    if table.ordered_by == key:
+        return iter(table)
+    if isinstance(table, Stream) and table.source is not None:
+        table = table.source
+    if isinstance(table, Table):
+        index = table.indexes.get((key,))
+        if isinstance(index, SortedIndex):
+            positions = index.ordered_positions()
+            if positions is not None:
+                return map(table._row, positions)
+    return None
+
+
+def _merge_matches(a_rows, a_key, b, b_rows, b_key):
+    """Like _hash_matches for inputs that are both sorted on their keys,
+    a_rows and b_rows being a's and b's rows in key order.
+
+    Walks both sides once, only buffering the b rows of the current key so
+    that a run of equal keys on the left can be matched against all of them.
+    Keys that don't compare with b's (None, say) are looked up in buckets of
+    b's rows instead, built the first time one turns up.
+    """
+    b_rows = iter(b_rows)
+    b_row = next(b_rows, None)
+    run, run_key, have_run = [], None, False
+    buckets = None
+    for a_row in a_rows:
+        key = a_row[a_key]
+        if not have_run or key != run_key:
+            try:
+                while b_row is not None and b_row[b_key] < key:
+                    b_row = next(b_rows, None)
+            except TypeError:
+                if buckets is None:
+                    buckets = {}
+                    for row in b:
+                        buckets.setdefault(row[b_key], []).append(row)
+                yield a_row, buckets.get(key, ())
+                continue
+            run = []
+            while b_row is not None and b_row[b_key] == key:
+                run.append(b_row)
+                b_row = next(b_rows, None)
+            run_key, have_run = key, True
+        yield a_row, run
+
+
+def _equi_join_key(a, b, pred, prefixes=(None, None)):
+    """Find an equality between a column of a and a column of b in pred.
+
+    Returns the pair of column names and the rest of the predicate that still
+    has to be checked on joined rows, or (None, None) if there is none.
+    Columns are named with prefixes (see _join_schema), by default the
+    tables' names.
+    """
+    if _is_join_key(pred):
+        return pred, None
+    if not isinstance(pred, Expr) or _is_empty(a) or _is_empty(b):
+        return None, None
+    terms = _conjuncts(pred)
+    for i, term in enumerate(terms):
+        if (
+            isinstance(term, Compare)
+            and term.op == "=="
+            and isinstance(term.left, Col)
+            and isinstance(term.right, Col)
+        ):
+            on = (term.left.name, term.right.name)
+            try:
+                _resolve_join_key(a, b, on, prefixes)
+            except ValueError:
+                continue
+            rest = terms[:i] + terms[i + 1 :]
+            return on, _all(rest) if rest else None
+    return None, None
+
+
+def _mangled_colnames(table):
+    prefix = f"{table.name}." if table.name else ""
+    return [(f"{prefix}{k}", k) for k in table.colnames()]
+
+
+def _values_getter(keys):
+    """Function reading the values of keys from a row, as a tuple."""
+    match keys:
+        case []:
+            return lambda row: ()
+        case [key]:
+            return lambda row: (row[key],)
+        case _:
+            return operator.itemgetter(*keys)
+
+
+def _join_schema(a, b, a_prefix=None, b_prefix=None):
+    """Schema of the rows joining a and b, and the functions reading the
+    values of a row of each side in that schema's order."""
+    a_names, a_keys = _prefixed_colnames(a, a_prefix)
+    b_names, b_keys = _prefixed_colnames(b, b_prefix)
+    return Schema(a_names + b_names), _values_getter(a_keys), _values_getter(b_keys)
+
+
+def _prefixed_colnames(table, prefix):
+    if prefix is None:
+        cols = _mangled_colnames(table)
+    else:
+        cols = [(f"{prefix}{k}", k) for k in table.colnames()]
+    return [name for name, _ in cols], [k for _, k in cols]
+
+
+def _unmangle(table, key, prefix=None):
+    for name, k in zip(*_prefixed_colnames(table, prefix)):
+        if name == key:
+            return k
+    return None
+
+
+def _resolve_join_key(a, b, on, prefixes=(None, None)):
+    left, right = on
+    a_prefix, b_prefix = prefixes
+    a_key, b_key = _unmangle(a, left, a_prefix), _unmangle(b, right, b_prefix)
+    if a_key is None or b_key is None:
+        a_key, b_key = _unmangle(a, right, a_prefix), _unmangle(b, left, b_prefix)
+    if a_key is None or b_key is None:
+        raise ValueError(f"Join key {on!r} does not match columns of both tables")
+    return a_key, b_key
+
+
+def _is_column_equality(pred):
+    return (
+        isinstance(pred, Compare)
+        and pred.op == "=="
+        and isinstance(pred.left, Col)
+        and isinstance(pred.right, Col)
+    )
+
+
+def _owners(pred, table_names):
+    """The tables whose columns pred reads, going by the "table." prefixes of
+    its column names, or None if some column can't be attributed."""
+    owners = set()
+    for column in pred.columns():
+        owner = next((t for t in table_names if column.startswith(f"{t}.")), None)
+        if owner is None:
+            return None
+        owners.add(owner)
+    return owners
+
+
+def _scan(db, table_name, preds):
+    table = db.tables[table_name]
+    if not preds:
+        return table
+    pred = _all(preds)
+    found = _index_scan(table, pred)
+    if found is not None:
+        return found
+    if db._parallel(table) or isinstance(table, NumpyTable):
+        return db.WHERE(table, pred)
+    return Stream(table.name, table, table._colnames, table.ordered_by).filter(pred)
+
+
+def _plan_from(db, from_, join, where):
+    """Plan the joined input of a query, applying the where clauses as early
+    as possible.
+
+    Conjuncts that only read one table are applied to that table before it is
+    joined (through its indexes if it has any), and conjuncts reading several
+    are checked by the join that brings in the last of them, so that
+    equalities between two tables become hash join conditions instead of
+    filters over their cartesian product. Clauses from the first one that
+    isn't an Expr on are left to run after the joins, in order. The tables,
+    including those of join clauses whose predicates are Exprs, are joined
+    in the order _join_order picks; other join clauses follow in the order
+    given.
+    Returns the PlanNode producing the joined Stream and the clauses that
+    still have to be applied to it.
+    """
+    names = _read_tables(from_, join)
+    if len(set(names)) != len(names):
+        # Columns can't be told apart by table name, so nothing is pushed
+        result = _from_node(from_)
+        for table_name, pred in join:
+            result = _join_node(result, _scan_node(table_name, (), False), pred)
+        return result, list(where)
+    join_preds = [_join_pred(pred) for _, pred in join]
+    if all(
+        isinstance(pred, Expr) and _owners(pred, names) is not None
+        for pred in join_preds
+    ):
+        # Inner joins, so their conditions can go wherever the where
+        # clauses' do
+        tables, clauses, join = names, [*join_preds, *where], ()
+    else:
+        tables, clauses = list(from_), where
+    pushed = {name: [] for name in names}
+    conditions = []
+    remaining = []
+    # Clauses after one that isn't an Expr stay behind it, as it may guard
+    # them (checking for None, say)
+    opaque = False
+    for clause in clauses:
+        clause = _as_pred(clause)
+        opaque = opaque or not isinstance(clause, Expr)
+        if opaque:
+            remaining.append(clause)
+            continue
+        for term in _conjuncts(clause):
+            # A lone table's rows aren't prefixed with its name
+            owners = _owners(term, names) if len(names) > 1 else set(names)
+            if owners is None or not owners:
+                remaining.append(term)
+            elif len(owners) == 1:
+                (owner,) = owners
+                if len(names) > 1:
+                    prefix = f"{owner}."
+                    term = term.rename(
+                        {c: c.removeprefix(prefix) for c in term.columns()}
+                    )
+                pushed[owner].append(term)
+            elif owners <= set(tables):
+                conditions.append((term, owners))
+            else:
+                remaining.append(term)
+    scans = {name: _scan_node(name, pushed[name], stream=False) for name in names}
+    if len(tables) > 1 and not conditions and not any(pushed[n] for n in tables):
+        result = _from_node(tables)
+    else:
+        order = _join_order(db, tables, pushed, conditions)
+        # The first table is read as a Stream so that the joins stay lazy
+        result = _scan_node(order[0], pushed[order[0]], stream=True)
+        joined = {order[0]}
+        for name in order[1:]:
+            joined.add(name)
+            on = [
+                term
+                for term, owners in conditions
+                if name in owners and owners <= joined
+            ]
+            if on:
+                result = _join_node(result, scans[name], _all(on))
+            else:
+                result = PlanNode(
+                    "CROSS_JOIN",
+                    (result, scans[name]),
+                    (),
+                    lambda db, a, b: db.CROSS_JOIN(a, b),
+                )
+    for table_name, pred in join:
+        result = _join_node(result, scans[table_name], pred)
+    return result, remaining
+
+
+def _read_tables(from_, join):
+    """Names of the tables a query with these clauses reads."""
+    return [*(from_ or ()), *(table_name for table_name, _ in join)]
+
+
+def _join_pred(pred):
+    """A join clause's predicate as an Expr, if it can be one."""
+    if _is_join_key(pred):
+        return Col(pred[0]) == Col(pred[1])
+    return _as_pred(pred)
 
-    def DROP_TABLE(self, name):
-        del self.tables[name]
 
-    def FROM(self, first_table, *rest):
-        match rest:
-            case ():
-                return self.tables[first_table]
-            case _:
-                return self.CROSS_JOIN(self.tables[first_table], self.FROM(*rest))
+# Up to this many tables _join_order tries every order, beyond it it builds
+# one greedily
+_EXHAUSTIVE_JOIN_LIMIT = 8
 
-    def SELECT(self, table, columns, aliases=None):
-        if aliases is None:
-            aliases = {}
-        return Table(
-            table.name,
-            [
-                {aliases.get(col, col): row[col] for col in columns}
-                for row in table.rows
-            ],
+
+def _join_order(db, names, pushed, conditions):
+    """The order to join the tables called names in, left to right.
+
+    It is the one with the least estimated work: the rows of every
+    intermediate result, plus the rows of every table but the first, which
+    the hash joins build their tables from. Sizes come from the tables'
+    statistics (see Database.ANALYZE) if they have any, else from their
+    lengths and default selectivities. Up to _EXHAUSTIVE_JOIN_LIMIT tables,
+    dynamic programming over the sets of tables joined so far finds the
+    cheapest order; beyond that, a greedy search starts from the cheapest
+    pair and adds the cheapest table next. Ties keep the order given.
+    """
+    statistics = {}
+    rows = []
+    for name in names:
+        table = db.tables[name]
+        stats = table.statistics
+        if stats is None:
+            stats = TableStatistics(table, ())
+        statistics[name] = stats
+        estimate = stats.row_count
+        if pushed[name]:
+            estimate *= stats.selectivity(_all(pushed[name]))
+        rows.append(estimate)
+    position = {name: i for i, name in enumerate(names)}
+    selectivities = [
+        (
+            sum(1 << position[owner] for owner in owners),
+            _condition_selectivity(term, statistics),
         )
+        for term, owners in conditions
+    ]
 
-    def WHERE(self, table, pred):
-        return table.filter(pred)
+    def size(members):
+        """Estimated rows of joining the tables in the bitmask members."""
+        estimate = math.prod(rows[i] for i in range(len(names)) if members >> i & 1)
+        for owners, selectivity in selectivities:
+            if members & owners == owners:
+                estimate *= selectivity
+        return estimate
 
-    def INSERT_INTO(self, table_name, rows):
-        table = self.tables[table_name]
-        table.rows = (*table.rows, *rows)
+    n = len(names)
+    if n <= _EXHAUSTIVE_JOIN_LIMIT:
+        # The cheapest (cost, order) for joining each set of tables
+        best = {1 << i: (0, (i,)) for i in range(n)}
+        for k in range(2, n + 1):
+            for members in itertools.combinations(range(n), k):
+                joined = sum(1 << i for i in members)
+                rows_out = size(joined)
+                best[joined] = min(
+                    (cost + rows_out + rows[i], order + (i,))
+                    for i in members
+                    for cost, order in (best[joined & ~(1 << i)],)
+                )
+        order = best[(1 << n) - 1][1]
+    else:
+        _, order = min(
+            (size(1 << i | 1 << j) + rows[j], (i, j))
+            for i in range(n)
+            for j in range(n)
+            if i != j
+        )
+        joined = sum(1 << i for i in order)
+        while len(order) < n:
+            _, i = min(
+                (size(joined | 1 << i) + rows[i], i)
+                for i in range(n)
+                if not joined >> i & 1
+            )
+            order += (i,)
+            joined |= 1 << i
+    return [names[i] for i in order]
 
-    def UPDATE(self, table, set, pred=lambda _: True):
-        return Table(
-            table.name, [{**row, **set} if pred(row) else row for row in table.rows]
+
+def _condition_selectivity(term, statistics):
+    """Estimated fraction of the combinations of rows of the tables whose
+    statistics are given, by name, that the join condition term keeps."""
+    if _is_column_equality(term):
+        (a, a_column), (b, b_column) = (
+            _split_column(col.name, statistics) for col in (term.left, term.right)
         )
+        if a != b:
+            return statistics[a].join_selectivity(
+                a_column, statistics[b], b_column
+            )
+    return _DEFAULT_SELECTIVITY
 
-    def CROSS_JOIN(self, a, b):
-        rows = []
-        a_prefix = f"{a.name}." if a.name else ""
-        b_prefix = f"{b.name}." if b.name else ""
-        for x in a.rows:
-            for y in b.rows:
-                rows.append(
-                    {
-                        **{f"{a_prefix}{k}": x[k] for k in a.colnames()},
-                        **{f"{b_prefix}{k}": y[k] for k in b.colnames()},
-                    }
-                )
-        return Table("", rows)
 
-    def INNER_JOIN(self, a, b, pred):
-        return self.CROSS_JOIN(a, b).filter(pred)
+def _split_column(column, table_names):
+    """(table, column name in that table) for a "table.column" name."""
+    for table_name in table_names:
+        if column.startswith(f"{table_name}."):
+            return table_name, column.removeprefix(f"{table_name}.")
+    return None, column
 
-    JOIN = INNER_JOIN
 
-    def LEFT_JOIN(self, a, b, pred):
-        rows = []
-        empty_b_row = {f"{b.name}.{k}": None for k in b.colnames()}
-        for a_row in a.rows:
-            added = False
-            mangled_a_row = {f"{a.name}.{k}": a_row[k] for k in a.colnames()}
-            for b_row in b.rows:
-                row = {
-                    **mangled_a_row,
-                    **{f"{b.name}.{k}": b_row[k] for k in b.colnames()},
-                }
-                if pred(row):
-                    rows.append(row)
-                    added = True
-            if not added:
-                rows.append({**mangled_a_row, **empty_b_row})
-        return Table("", rows)
+class PlanNode:
+    """One step of a query plan: the operator op applied to the results of
+    inputs.
 
-    def RIGHT_JOIN(self, a, b, pred):
-        return self.LEFT_JOIN(b, a, pred)
+    args describe the step; run(db, *input results) performs it. After
+    explain(..., analyze=True), stats holds the step's "rows_in", "rows_out",
+    "seconds" (not counting the time spent in its inputs) and "peak_bytes".
+    """
 
-    def LIMIT(self, table, limit):
-        return Table(table.name, table.rows[:limit])
+    def __init__(self, op, inputs, args, run):
+        self.op = op
+        self.inputs = list(inputs)
+        self.args = list(args)
+        self.run = run
+        self.stats = None
 
-    def ORDER_BY(self, table, rel):
-        # Differs from JS version by passing the whole row to the comparator
-        return Table(table.name, sorted(table.rows, key=rel))
+    def walk(self):
+        """This node and every node below it, inputs first."""
+        for node in self.inputs:
+            yield from node.walk()
+        yield self
 
-    def HAVING(self, table, pred):
-        return table.filter(pred)
+    def __str__(self):
+        return "\n".join(self._lines(0))
 
-    def OFFSET(self, table, offset):
-        return Table(table.name, table.rows[offset:])
+    def _lines(self, depth):
+        line = "  " * depth + " ".join([self.op, *map(_describe, self.args)])
+        if self.stats is not None:
+            stats = self.stats
+            line += (
+                f"  (rows in={stats['rows_in']} out={stats['rows_out']}, "
+                f"{stats['seconds'] * 1000:.3f} ms, peak {stats['peak_bytes']} B)"
+            )
+        yield line
+        for node in self.inputs:
+            yield from node._lines(depth + 1)
 
-    def DISTINCT(self, table, columns):
-        seen = set()
-        rows = []
-        for row in table.rows:
-            view = tuple((col, row[col]) for col in columns)
-            if view not in seen:
-                seen.add(view)
-                rows.append(dict(view))
-        return Table(table.name, rows)
+    def __repr__(self):
+        return f"PlanNode({self.op!r}, {self.args!r})"
 
-    def GROUP_BY(self, table, groupBys):
-        groupRows = {}
-        for row in table.rows:
-            key = tuple(row[col] for col in groupBys)
-            if key not in groupRows:
-                groupRows[key] = []
-            groupRows[key].append(row.copy())
-        resultRows = []
-        for group in groupRows.values():
-            resultRow = {"_groupRows": group}
-            for col in groupBys:
-                resultRow[col] = group[0][col]
-            resultRows.append(resultRow)
-        return Table(table.name, resultRows)
 
-    def _aggregate(self, table, col, agg_name, agg):
-        grouped = table.rows and "_groupRows" in table.rows[0]
-        col_name = f"{agg_name}({col})"
-        if not grouped:
-            return Table(table.name, [{col_name: agg(table.rows)}])
-        rows = []
-        for row in table.rows:
-            new_row = {}
-            for key, value in row.items():
-                if key == "_groupRows":
-                    new_row[col_name] = agg(value)
-                else:
-                    new_row[key] = value
-            rows.append(new_row)
-        return Table(table.name, rows)
+def _describe(arg):
+    if isinstance(arg, str):
+        return arg
+    if isinstance(arg, types.FunctionType):
+        return arg.__name__
+    return repr(arg)
 
-    def COUNT(self, table, col):
-        return self._aggregate(table, col, "COUNT", len)
 
-    def MAX(self, table, col):
-        return self._aggregate(table, col, "MAX", lambda rows: max(row[col] for row in rows))
+def _step(node, op, args, run):
+    return PlanNode(op, (node,), args, run)
 
-    def SUM(self, table, col):
-        return self._aggregate(table, col, "SUM", lambda rows: sum(row[col] for row in rows))
 
-    def __repr__(self):
-        return f"Database({list(self.tables.keys())!r})"
+def _from_node(from_):
+    return PlanNode("FROM", (), from_, lambda db: db._stream_from(*from_))
 
 
-def query(
+def _scan_node(name, preds, stream):
+    def run(db):
+        result = _scan(db, name, preds)
+        if not stream:
+            return result
+        source = result if isinstance(result, Table) else None
+        return Stream(result.name, result, result._colnames, result.ordered_by, source)
+
+    return PlanNode("SCAN", (), (name, *preds), run)
+
+
+def _join_node(a, b, pred):
+    return PlanNode("JOIN", (a, b), (pred,), lambda db, a, b: db.JOIN(a, b, pred))
+
+
+def _plan(
     db,
     select=(),
     select_as=None,
@@ -186,35 +3296,955 @@ def query(
     join=(),
     where=(),
     group_by=(),
+    aggregate=(),
     having=None,
     order_by=None,
     offset=None,
     limit=None,
-) -> Table:
+    lazy=False,
+    compiled=False,
+):
+    """The PlanNode tree query() runs for these arguments."""
     if from_ is None:
         raise ValueError("Need a FROM clause")
-    result = db.FROM(*from_)
-    for j in join:
-        table_name, pred = j
-        result = db.JOIN(result, db.tables[table_name], pred)
+    if (
+        compiled
+        and not lazy
+        and len(from_) == 1
+        and not (join or group_by or aggregate or distinct)
+        and having is None
+        and order_by is None
+        and (offset or 0) >= 0
+        and (limit or 0) >= 0
+    ):
+        return PlanNode(
+            "COMPILED",
+            (),
+            (from_[0], *where),
+            lambda db: _fused_scan(
+                db, from_[0], select, select_as, where, offset, limit
+            ),
+        )
+    result, where = _plan_from(db, from_, join, where)
     for w in where:
-        result = db.WHERE(result, w)
-    if group_by:
-        result = db.GROUP_BY(result, group_by)
-    if having:
-        result = db.HAVING(result, having)
+        result = _step(result, "WHERE", (w,), lambda db, t, w=w: db.WHERE(t, w))
+    if (aggregate or group_by) and not lazy and db.workers:
+        # Parallel aggregation needs a table it can split
+        result = _step(result, "MATERIALIZE", (), lambda db, t: _materialize(t))
+    if aggregate:
+        result = _step(
+            result,
+            "AGGREGATE",
+            (group_by, aggregate),
+            lambda db, t: db.AGGREGATE(t, group_by, aggregate),
+        )
+    elif group_by:
+        result = _step(
+            result, "GROUP_BY", (group_by,), lambda db, t: db.GROUP_BY(t, group_by)
+        )
+    if having is not None:
+        result = _step(
+            result, "HAVING", (having,), lambda db, t: db.HAVING(t, having)
+        )
     if select:
-        result = db.SELECT(result, select, select_as or {})
-    if order_by:
-        result = db.ORDER_BY(result, order_by)
+        result = _step(
+            result,
+            "SELECT",
+            (select, select_as or {}),
+            lambda db, t: db.SELECT(t, select, select_as or {}),
+        )
+    if distinct:
+
+        def run_distinct(db, table):
+            if _is_empty(table):
+                return table
+            columns = table.colnames() if distinct is True else distinct
+            return db.DISTINCT(table, columns)
+
+        result = _step(result, "DISTINCT", (distinct,), run_distinct)
+    if order_by is not None:
+        # Negative bounds count from the end, which a heap can't find
+        bounded = limit and limit > 0 and (offset or 0) >= 0
+        top = (offset or 0) + limit if bounded else None
+        result = _step(
+            result,
+            "ORDER_BY",
+            (order_by,) if top is None else (order_by, f"top {top}"),
+            lambda db, t: db.ORDER_BY(t, order_by, top),
+        )
     if offset:
-        result = db.OFFSET(result, offset)
+        result = _step(
+            result, "OFFSET", (offset,), lambda db, t: db.OFFSET(t, offset)
+        )
     if limit:
-        result = db.LIMIT(result, limit)
+        result = _step(result, "LIMIT", (limit,), lambda db, t: db.LIMIT(t, limit))
+    return result
+
+
+def _execute(db, node, profiler=None):
+    inputs = [_execute(db, child, profiler) for child in node.inputs]
+    if profiler is None:
+        return node.run(db, *inputs)
+    return profiler.run(db, node, inputs)
+
+
+class _Profiler:
+    """Fills in the stats of the PlanNodes it runs.
+
+    Rows flow through Streams on demand, so a node's work happens both when
+    it is run and whenever rows are pulled from its output; both are
+    measured. Time spent inside a nested measurement (an input producing
+    rows) is taken off the enclosing one, and peak memory is tracked per
+    measurement with tracemalloc, which has to be tracing.
+    """
+
+    def __init__(self):
+        # [seconds spent in nested measurements, highest peak seen, memory
+        # in use at the start] of each measurement in progress
+        self._frames = []
+
+    def run(self, db, node, inputs):
+        node.stats = {"rows_in": 0, "rows_out": 0, "seconds": 0.0, "peak_bytes": 0}
+        result = self._measure(node.stats, node.run, db, *inputs)
+        if isinstance(result, Stream):
+            return Stream(
+                result.name,
+                self._count(node.stats, result),
+                result._colnames,
+                ordered_by=result.ordered_by,
+            )
+        node.stats["rows_out"] = len(result)
+        return result
+
+    def _count(self, stats, rows):
+        rows = iter(rows)
+        while True:
+            row = self._measure(stats, next, rows, None)
+            if row is None:
+                return
+            stats["rows_out"] += 1
+            yield row
+
+    def _measure(self, stats, fn, *args):
+        current, peak = tracemalloc.get_traced_memory()
+        if self._frames:
+            self._frames[-1][1] = max(self._frames[-1][1], peak)
+        tracemalloc.reset_peak()
+        frame = [0.0, 0, current]
+        self._frames.append(frame)
+        start = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            elapsed = time.perf_counter() - start
+            self._frames.pop()
+            peak = max(frame[1], tracemalloc.get_traced_memory()[1])
+            stats["seconds"] += elapsed - frame[0]
+            stats["peak_bytes"] = max(stats["peak_bytes"], peak - frame[2])
+            if self._frames:
+                self._frames[-1][0] += elapsed
+                self._frames[-1][1] = max(self._frames[-1][1], peak)
+
+
+def explain(db, analyze=False, hook=None, **query_kwargs):
+    """The plan query(db, **query_kwargs) would run, as a tree of PlanNodes;
+    print it to see the operators.
+
+    With analyze the query is run as well and every node's stats are filled
+    in (see PlanNode). hook, if given, is then called with each node, inputs
+    first, e.g. to export the stats.
+    """
+    db = db.snapshot(
+        _read_tables(query_kwargs.get("from_"), query_kwargs.get("join", ()))
+    )
+    plan = _plan(db, **query_kwargs)
+    if not analyze:
+        return plan
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    try:
+        _materialize(_execute(db, plan, _Profiler()))
+    finally:
+        if not tracing:
+            tracemalloc.stop()
+    for node in plan.walk():
+        node.stats["rows_in"] = sum(n.stats["rows_out"] for n in node.inputs)
+        if hook is not None:
+            hook(node)
+    return plan
+
+
+def query(
+    db,
+    select=(),
+    select_as=None,
+    distinct=None,
+    from_=None,
+    join=(),
+    where=(),
+    group_by=(),
+    aggregate=(),
+    having=None,
+    order_by=None,
+    offset=None,
+    limit=None,
+    lazy=False,
+    compiled=False,
+) -> Table | Stream:
+    """With compiled, queries that only scan, filter, project and slice one
+    table run as a single generated loop (see _fused_source) instead of a
+    chain of operators.
+
+    The query reads a snapshot() of db, so writes made while it runs (or,
+    with lazy, while its result is consumed) don't show in its result."""
+    db = db.snapshot(_read_tables(from_, join))
+    cache_key = None
+    if db.cache is not None and not lazy and from_ is not None:
+        clauses = (select, select_as, distinct, from_, join, where, group_by)
+        clauses += (aggregate, having, order_by, offset, limit)
+        cache_key = _cache_key(db, from_, join, clauses)
+        if cache_key is not None:
+            cached = db.cache.get(cache_key)
+            if cached is not None:
+                return _copy(cached)
+    plan = _plan(
+        db,
+        select,
+        select_as,
+        distinct,
+        from_,
+        join,
+        where,
+        group_by,
+        aggregate,
+        having,
+        order_by,
+        offset,
+        limit,
+        lazy,
+        compiled,
+    )
+    result = _execute(db, plan)
+    if lazy:
+        return result
+    result = _materialize(result)
+    if cache_key is not None:
+        # Hand out copies so that writes to a result don't reach the cache
+        db.cache.put(cache_key, _copy(result))
+    return result
+
+
+def _copy(table):
+    result = Table(table.name, table.rows)
+    result._colnames = table._colnames
+    return result
+
+
+async def aquery(db, batch_size=1000, executor=None, timeout=None, **query_kwargs):
+    """query() for asyncio code, letting other tasks run while it works.
+
+    By default the query runs on the event loop a batch of batch_size rows
+    at a time, letting other tasks run after each: rows are pulled through
+    the lazy plan query(lazy=True) would run, so that a LIMIT stops it
+    early, and the inputs operators need all of (the tables joined in,
+    GROUP_BY, AGGREGATE, ORDER_BY) are read that way before they do their
+    own work in one go. NumpyTables are scanned whole, as their operators
+    are vectorized. With executor (a concurrent.futures.Executor) the query
+    runs there instead.
+
+    Cancelling the task awaiting it, or timeout seconds passing, stops the
+    query after its current batch.
+    """
+    if query_kwargs.get("lazy"):
+        raise ValueError("aquery() returns a materialized Table")
+    db = db.snapshot(
+        _read_tables(query_kwargs.get("from_"), query_kwargs.get("join", ()))
+    )
+    plan = _plan(db, **{**query_kwargs, "lazy": True})
+    if executor is None:
+        run = _arun(db, plan, batch_size)
+    else:
+        run = _run_in_executor(executor, db, plan, batch_size)
+    return _materialize(await asyncio.wait_for(run, timeout))
+
+
+# Operators that pass the rows of their first input on as they are pulled
+_STREAMING_OPS = frozenset(
+    {"WHERE", "SELECT", "HAVING", "DISTINCT", "OFFSET", "LIMIT", "JOIN", "CROSS_JOIN"}
+)
+
+
+async def _arun(db, node, batch_size):
+    """node's result as a materialized table, computed batch by batch."""
+    return await _apull(await _astream(db, node, batch_size), batch_size)
+
+
+async def _astream(db, node, batch_size):
+    """node's result, lazy where the plan is: the inputs operators read
+    whole are pulled batch by batch first, while the rest stay Streams."""
+    inputs = []
+    for i, child in enumerate(node.inputs):
+        result = await _astream(db, child, batch_size)
+        if i > 0 or node.op not in _STREAMING_OPS:
+            result = await _apull(result, batch_size)
+        inputs.append(result)
+    return node.run(db, *inputs)
+
+
+async def _apull(table, batch_size):
+    """table, pulled batch_size rows at a time if it is a Stream, letting
+    other tasks run in between."""
+    if not isinstance(table, Stream):
+        return table
+    rows = []
+    while batch := list(itertools.islice(table, batch_size)):
+        rows.extend(batch)
+        await asyncio.sleep(0)
+    result = Table(table.name, rows)
+    result._colnames = table._colnames
+    result.ordered_by = table.ordered_by
+    return result
+
+
+async def _run_in_executor(executor, db, plan, batch_size):
+    stop = threading.Event()
+    loop = asyncio.get_running_loop()
+    try:
+        return await loop.run_in_executor(
+            executor, _run_until, stop, db, plan, batch_size
+        )
+    finally:
+        # Only has an effect if the query was cancelled or timed out
+        stop.set()
+
+
+def _run_until(stop, db, plan, batch_size):
+    return _materialize(_execute(db, plan, _Stopper(stop, batch_size)))
+
+
+class _Stopper:
+    """Runs PlanNodes so that the rows flowing out of each are checked for
+    stop being set every batch_size rows, and the query abandoned if so."""
+
+    def __init__(self, stop, batch_size):
+        self.stop = stop
+        self.batch_size = batch_size
+
+    def run(self, db, node, inputs):
+        result = node.run(db, *inputs)
+        if isinstance(result, Stream):
+            return Stream(
+                result.name,
+                self._check(result),
+                result._colnames,
+                ordered_by=result.ordered_by,
+            )
+        return result
+
+    def _check(self, rows):
+        for i, row in enumerate(rows):
+            if i % self.batch_size == 0 and self.stop.is_set():
+                raise concurrent.futures.CancelledError
+            yield row
+
+
+def _fused_scan(db, table_name, select, select_as, where, offset, limit):
+    table = db.tables[table_name]
+    preds = [_as_pred(w) for w in where]
+    constants = []
+    source = _fused_source(preds, select, select_as or {}, offset, limit, constants)
+    run = _compile_fused(source, len(constants))(*constants)
+    rows = table
+    exprs = [pred for pred in preds if isinstance(pred, Expr)]
+    if exprs:
+        positions = _index_lookup(table, _all(exprs))
+        if positions is not None:
+            rows = map(table._row, sorted(positions))
+    result = Table(table.name, run(rows))
+    if not select:
+        result._colnames = table._colnames
     return result
 
 
+def _fused_source(preds, select, aliases, offset, limit, constants):
+    """Source of a function running WHERE, OFFSET, SELECT and LIMIT over rows
+    in one loop, with Expr predicates and column reads written out inline.
+
+    Values that vary between queries of the same shape (literals, non-Expr
+    predicates, offset and limit) become parameters _c0, _c1, ... appended to
+    constants, so that such queries share their compiled code.
+    """
+
+    def constant(value):
+        constants.append(value)
+        return f"_c{len(constants) - 1}"
+
+    lines = ["def _query(rows):", "    result = []", "    append = result.append"]
+    if offset:
+        lines.append(f"    skip = {constant(offset)}")
+    lines.append("    for row in rows:")
+    for pred in preds:
+        lines.append(f"        if not {_expr_source(pred, constant)}:")
+        lines.append("            continue")
+    if offset:
+        lines += ["        if skip:", "            skip -= 1", "            continue"]
+    if select:
+        schema = constant(Schema([aliases.get(col, col) for col in select]))
+        values = "".join(f"row[{col!r}], " for col in select)
+        lines.append(f"        append(Record({schema}, ({values})))")
+    else:
+        lines.append("        append(row)")
+    if limit:
+        lines.append(f"        if len(result) >= {constant(limit)}:")
+        lines.append("            break")
+    lines.append("    return result")
+    return "\n".join(lines)
+
+
+def _expr_source(expr, constant):
+    match expr:
+        case Col():
+            return f"row[{expr.name!r}]"
+        case Const():
+            return constant(expr.value)
+        case Compare():
+            left = _expr_source(expr.left, constant)
+            return f"({left} {expr.op} {_expr_source(expr.right, constant)})"
+        case And() | Or():
+            joiner = " and " if isinstance(expr, And) else " or "
+            terms = (_expr_source(term, constant) for term in expr.terms)
+            return "(" + joiner.join(terms) + ")"
+        case Not():
+            return f"(not {_expr_source(expr.term, constant)})"
+        case In():
+            return f"({_expr_source(expr.expr, constant)} in {constant(expr.values)})"
+        case Between():
+            low = _expr_source(expr.low, constant)
+            high = _expr_source(expr.high, constant)
+            return f"({low} <= {_expr_source(expr.expr, constant)} <= {high})"
+        case _:
+            return f"{constant(expr)}(row)"
+
+
+@functools.lru_cache(maxsize=256)
+def _compile_fused(source, count):
+    """Compile source, returning a function that takes its count constants
+    and returns the generated _query."""
+    params = ", ".join(f"_c{i}" for i in range(count))
+    body = "".join(f"    {line}\n" for line in source.splitlines())
+    namespace = {"Record": Record}
+    exec(f"def _bind({params}):\n{body}    return _query\n", namespace)
+    return namespace["_bind"]
+
+
+def _cache_key(db, from_, join, clauses):
+    """Key for a query's cached result, or None if it can't be cached."""
+    names = [*from_, *(table_name for table_name, _ in join)]
+    if not all(name in db.tables for name in names):
+        return None
+    versions = tuple((name, db.tables[name].version) for name in sorted(set(names)))
+    try:
+        return versions, _shape(clauses)
+    except TypeError:
+        return None
+
+
+def _shape(value):
+    """A hashable stand-in for a query clause. Functions (and any other
+    callables but Exprs and SortKeys) raise TypeError, like anything else
+    unhashable: what they return can change with the globals and objects
+    they read, which the key can't capture."""
+    if isinstance(value, Expr):
+        return ("expr", repr(value))
+    if isinstance(value, SortKey):
+        return value
+    if callable(value):
+        raise TypeError(f"Can't key a query on {value!r}")
+    if isinstance(value, (list, tuple)):
+        return (type(value).__name__, tuple(_shape(item) for item in value))
+    if isinstance(value, dict):
+        return ("dict", tuple((k, _shape(v)) for k, v in value.items()))
+    hash(value)
+    return value
+
+
+class Plan:
+    """A parsed SELECT statement: the query() arguments it runs with."""
+
+    def __init__(self, **clauses):
+        self.clauses = clauses
+
+    def __repr__(self):
+        clauses = ", ".join(f"{k}={v!r}" for k, v in self.clauses.items())
+        return f"Plan({clauses})"
+
+
+class SortKey:
+    """ORDER BY key over several columns, each either ascending or
+    descending."""
+
+    def __init__(self, terms):
+        # (column, descending) pairs
+        self.terms = tuple(terms)
+
+    def __call__(self, row):
+        return tuple(
+            _Descending(row[col]) if descending else row[col]
+            for col, descending in self.terms
+        )
+
+    def __eq__(self, other):
+        return isinstance(other, SortKey) and self.terms == other.terms
+
+    def __hash__(self):
+        return hash(self.terms)
+
+    def __repr__(self):
+        return f"SortKey({list(self.terms)!r})"
+
+
+class _Descending:
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+
+def parse(sql):
+    """Parse a SELECT statement into a Plan for query(). Supported:
+
+        SELECT [DISTINCT] * | item [AS alias], ...
+        FROM table, ...
+        [[INNER] JOIN table ON condition] ...
+        [WHERE condition]
+        [GROUP BY column, ...]
+        [HAVING condition]
+        [ORDER BY column [ASC | DESC], ...]
+        [LIMIT n] [OFFSET n]
+
+    where an item is a column or COUNT/SUM/MAX/MIN/AVG(column or *), and
+    conditions combine comparisons (= <> != < <= > >=), IN (...), BETWEEN,
+    IS [NOT] NULL, NOT, AND, OR and parentheses. Columns of a single table
+    may be written with or without the table name; with several tables they
+    are table.column. Raises ValueError for anything else.
+    """
+    return _Parser(sql).statement()
+
+
+_parse_cached = functools.lru_cache(maxsize=256)(parse)
+
+
+_TOKENS = re.compile(
+    r"""\s*(?:
+        (?P<number>-?(?:\d+\.\d*|\.\d+|\d+))
+      | (?P<string>'(?:[^']|'')*')
+      | (?P<name>[A-Za-z_]\w*(?:\.[A-Za-z_]\w*)?)
+      | (?P<quoted>"(?:[^"]|"")*")
+      | (?P<op><=|>=|<>|!=|[=<>(),*])
+    )""",
+    re.VERBOSE,
+)
+
+_SQL_COMPARISONS = {"=": "==", "<>": "!=", "!=": "!=", "<": "<", "<=": "<="}
+_SQL_COMPARISONS.update({">": ">", ">=": ">="})
+
+
+class _Parser:
+    def __init__(self, sql):
+        self.sql = sql
+        self.tokens = []
+        position = 0
+        sql = sql.strip().removesuffix(";").rstrip()
+        while position < len(sql):
+            match = _TOKENS.match(sql, position)
+            if match is None:
+                raise ValueError(f"Unexpected character at {position} in {self.sql!r}")
+            kind = match.lastgroup
+            text = match.group(kind)
+            at = match.start(kind)
+            if kind == "quoted":
+                # Still a name, but never a keyword
+                text = text[1:-1].replace('""', '"')
+            self.tokens.append((kind, text, at))
+            position = match.end()
+        self.position = 0
+        self.aggregates = []
+
+    # Tokens
+
+    def peek(self, *keywords):
+        """Whether the next token is one of keywords (any token if none)."""
+        if self.position >= len(self.tokens):
+            return False
+        kind, text, _ = self.tokens[self.position]
+        if not keywords:
+            return True
+        return text.upper() in keywords and kind in ("name", "op")
+
+    def accept(self, *keywords):
+        if self.peek(*keywords):
+            self.position += 1
+            return True
+        return False
+
+    def expect(self, keyword):
+        if not self.accept(keyword):
+            self.error(keyword)
+
+    def error(self, expected):
+        if self.position < len(self.tokens):
+            _, text, at = self.tokens[self.position]
+            found = f"{text!r} at {at}"
+        else:
+            found = "end of statement"
+        raise ValueError(f"Expected {expected}, found {found} in {self.sql!r}")
+
+    def name(self):
+        if self.peek():
+            kind, text, _ = self.tokens[self.position]
+            keyword = kind == "name" and text.upper() in _SQL_KEYWORDS
+            if kind == "quoted" or (kind == "name" and not keyword):
+                self.position += 1
+                return text
+        self.error("a name")
+
+    def integer(self):
+        if self.peek() and self.tokens[self.position][0] == "number":
+            text = self.tokens[self.position][1]
+            if text.isdigit():
+                self.position += 1
+                return int(text)
+        self.error("an integer")
+
+    # Statement
+
+    def statement(self):
+        self.expect("SELECT")
+        distinct = self.accept("DISTINCT")
+        items = None if self.accept("*") else self.comma_list(self.select_item)
+        self.expect("FROM")
+        from_ = self.comma_list(self.name)
+        join = []
+        while self.peek("JOIN", "INNER"):
+            self.accept("INNER")
+            self.expect("JOIN")
+            table = self.name()
+            self.expect("ON")
+            join.append((table, self.condition()))
+        where = self.condition() if self.accept("WHERE") else None
+        group_by = []
+        if self.accept("GROUP"):
+            self.expect("BY")
+            group_by = self.comma_list(self.name)
+        having = self.condition() if self.accept("HAVING") else None
+        order_by = []
+        if self.accept("ORDER"):
+            self.expect("BY")
+            order_by = self.comma_list(self.order_item)
+        limit = self.integer() if self.accept("LIMIT") else None
+        offset = self.integer() if self.accept("OFFSET") else None
+        if self.peek():
+            self.error("end of statement")
+
+        tables = [*from_, *(table for table, _ in join)]
+        # Rows of a lone table aren't prefixed with its name
+        prefix = f"{tables[0]}." if len(tables) == 1 else ""
+
+        def column(name):
+            func, paren, arg = name.partition("(")
+            if paren:
+                return f"{func}({arg.removeprefix(prefix)}"
+            return name.removeprefix(prefix)
+
+        rename = lambda expr: expr.rename({c: column(c) for c in expr.columns()})
+        clauses = {"from_": from_}
+        aliases = {}
+        if items is not None:
+            select = [column(name) for name, _ in items]
+            clauses["select"] = select
+            aliases = {col: alias for col, (_, alias) in zip(select, items) if alias}
+            if aliases:
+                clauses["select_as"] = aliases
+            if distinct:
+                clauses["distinct"] = [aliases.get(col, col) for col in select]
+        elif distinct:
+            clauses["distinct"] = True
+        if join:
+            clauses["join"] = [(table, rename(on)) for table, on in join]
+        if where is not None:
+            clauses["where"] = [rename(where)]
+        if group_by:
+            clauses["group_by"] = [column(name) for name in group_by]
+        if self.aggregates:
+            clauses["aggregate"] = [
+                (func, arg if arg == "*" else column(arg))
+                for func, arg in self.aggregates
+            ]
+        if having is not None:
+            clauses["having"] = rename(having)
+        if order_by:
+            # Ordering happens after the projection, so by the aliased names
+            terms = [
+                (aliases.get(column(name), column(name)), descending)
+                for name, descending in order_by
+            ]
+            if len(terms) == 1 and not terms[0][1]:
+                clauses["order_by"] = Col(terms[0][0])
+            else:
+                clauses["order_by"] = SortKey(terms)
+        if limit is not None:
+            clauses["limit"] = limit
+        if offset is not None:
+            clauses["offset"] = offset
+        return Plan(**clauses)
+
+    def comma_list(self, item):
+        items = [item()]
+        while self.accept(","):
+            items.append(item())
+        return items
+
+    def select_item(self):
+        name = self.aggregate() or self.name()
+        return name, self.name() if self.accept("AS") else None
+
+    def order_item(self):
+        name = self.aggregate() or self.name()
+        if self.accept("DESC"):
+            return name, True
+        self.accept("ASC")
+        return name, False
+
+    def aggregate(self):
+        """The output column of an aggregate call, if one comes next."""
+        if not (
+            self.peek(*_ACCUMULATORS)
+            and self.position + 1 < len(self.tokens)
+            and self.tokens[self.position + 1][1] == "("
+        ):
+            return None
+        func = self.tokens[self.position][1].upper()
+        self.position += 2
+        arg = "*" if self.accept("*") else self.name()
+        self.expect(")")
+        if (func, arg) not in self.aggregates:
+            self.aggregates.append((func, arg))
+        return f"{func}({arg})"
+
+    # Conditions
+
+    def condition(self):
+        terms = [self.conjunction()]
+        while self.accept("OR"):
+            terms.append(self.conjunction())
+        return terms[0] if len(terms) == 1 else Or(*terms)
+
+    def conjunction(self):
+        terms = [self.negation()]
+        while self.accept("AND"):
+            terms.append(self.negation())
+        return _all(terms)
+
+    def negation(self):
+        if self.accept("NOT"):
+            return Not(self.negation())
+        return self.predicate()
+
+    def predicate(self):
+        left = self.operand()
+        if self.accept("IS"):
+            op = "!=" if self.accept("NOT") else "=="
+            self.expect("NULL")
+            return Compare(op, left, Const(None))
+        negated = self.accept("NOT")
+        if self.accept("IN"):
+            self.expect("(")
+            values = self.comma_list(self.literal)
+            self.expect(")")
+            result = In(left, [value.value for value in values])
+        elif self.accept("BETWEEN"):
+            low = self.operand()
+            self.expect("AND")
+            result = Between(left, low, self.operand())
+        elif negated:
+            self.error("IN or BETWEEN")
+        elif self.peek(*_SQL_COMPARISONS):
+            op = _SQL_COMPARISONS[self.tokens[self.position][1]]
+            self.position += 1
+            return Compare(op, left, self.operand())
+        else:
+            return left
+        return Not(result) if negated else result
+
+    def operand(self):
+        if self.accept("("):
+            result = self.condition()
+            self.expect(")")
+            return result
+        if self.peek() and self.tokens[self.position][0] in ("number", "string"):
+            return self.literal()
+        if self.peek("NULL", "TRUE", "FALSE"):
+            return self.literal()
+        return Col(self.aggregate() or self.name())
+
+    def literal(self):
+        if self.peek():
+            kind, text, _ = self.tokens[self.position]
+            value = _SQL_CONSTANTS.get(text.upper(), self) if kind == "name" else self
+            if kind == "number":
+                value = float(text) if "." in text else int(text)
+            elif kind == "string":
+                value = text[1:-1].replace("''", "'")
+            if value is not self:
+                self.position += 1
+                return Const(value)
+        self.error("a value")
+
+
+_SQL_CONSTANTS = {"NULL": None, "TRUE": True, "FALSE": False}
+
+_SQL_KEYWORDS = {
+    *("SELECT", "DISTINCT", "FROM", "INNER", "JOIN", "ON", "WHERE", "GROUP"),
+    *("BY", "HAVING", "ORDER", "ASC", "DESC", "LIMIT", "OFFSET", "AS", "AND"),
+    *("OR", "NOT", "IN", "BETWEEN", "IS", "NULL", "TRUE", "FALSE"),
+}
+
+
 def csv(table):
-    print(",".join(table.colnames()))
+    colnames = table.colnames()
+    print(",".join(colnames))
     for row in table.rows:
-        print(",".join(str(val) for val in row.values()))
+        print(",".join(str(row[col]) for col in colnames))
+
+
+def load_csv(db, table_name, file, batch_size=10_000, columnar=False):
+    """Stream a CSV file with a header line into table_name, batch_size rows
+    at a time, creating the table if it does not exist. Empty fields, and
+    those missing at the end of a short record, become None; a record longer
+    than the header raises ValueError. Each column gets one type, the
+    narrowest of int, float and str that holds its fields, with numbers
+    written with leading zeros (zip codes, say) kept as strings. The type is
+    inferred from the first batch and widened if a later batch needs it,
+    which leaves the rows already loaded as they were. Returns the number of
+    rows loaded."""
+    reader = csvlib.reader(file)
+    colnames = next(reader, None)
+    if colnames is None:
+        return 0
+    rows = _typed_rows(colnames, reader, batch_size)
+    return _load(db, table_name, colnames, rows, batch_size, columnar)
+
+
+def load_jsonl(db, table_name, file, batch_size=10_000, columnar=False):
+    """Like load_csv for a file holding one JSON object per line."""
+    rows = (json.loads(line) for line in file if line.strip())
+    first = next(rows, None)
+    if first is None:
+        return 0
+    rows = itertools.chain((first,), rows)
+    return _load(db, table_name, list(first), rows, batch_size, columnar)
+
+
+def write_csv(table, file, batch_size=10_000):
+    """Write a Table or Stream to file as CSV with a header line, in colnames()
+    order and batch_size rows per write. None is written as an empty field."""
+    colnames = table.colnames()
+    buffer = io.StringIO()
+    writer = csvlib.writer(buffer)
+    writer.writerow(colnames)
+    values = _values_getter(list(colnames))
+    for batch in _batches(table, batch_size):
+        writer.writerows(map(values, batch))
+        _flush(buffer, file)
+    _flush(buffer, file)
+
+
+def write_jsonl(table, file, batch_size=10_000):
+    """Like write_csv, writing one JSON object per row."""
+    for batch in _batches(table, batch_size):
+        file.write("".join(json.dumps(dict(row)) + "\n" for row in batch))
+
+
+def _load(db, table_name, colnames, rows, batch_size, columnar):
+    if table_name not in db.tables:
+        db.CREATE_TABLE(table_name, colnames, columnar=columnar)
+    count = 0
+    for batch in _batches(rows, batch_size):
+        db.INSERT_INTO(table_name, batch)
+        count += len(batch)
+    return count
+
+
+def _typed_rows(colnames, reader, batch_size):
+    """The CSV records from reader as dicts, typed column by column (see
+    load_csv)."""
+    types = [None] * len(colnames)
+    for batch in _batches(reader, batch_size):
+        # Blank lines hold no record
+        batch = [values for values in batch if values]
+        for values in batch:
+            if len(values) > len(colnames):
+                raise ValueError(
+                    f"CSV record {values!r} has more fields than the header "
+                    f"{colnames!r}"
+                )
+            for i, text in enumerate(values):
+                if text and types[i] is not str:
+                    type_ = _csv_type(text)
+                    if types[i] is None or _CSV_TYPES[type_] > _CSV_TYPES[types[i]]:
+                        types[i] = type_
+        for values in batch:
+            # Fields missing at the end of a record are empty
+            yield {
+                name: None if text == "" else type_(text)
+                for name, type_, text in itertools.zip_longest(
+                    colnames, types, values, fillvalue=""
+                )
+            }
+
+
+# The types load_csv gives columns, narrowest first
+_CSV_TYPES = {int: 0, float: 1, str: 2}
+
+
+def _csv_type(text):
+    """The narrowest of _CSV_TYPES holding the non-empty field text."""
+    digits = text.lstrip("+-")
+    if len(digits) > 1 and digits[0] == "0" and digits[1].isdigit():
+        # A number would lose the leading zeros
+        return str
+    if "_" in text:
+        # Python reads 12_34 as a number, but it isn't one in a CSV file
+        return str
+    try:
+        int(text)
+        return int
+    except ValueError:
+        pass
+    # float() would also take words like "nan" and "infinity"
+    if any(c.isdigit() for c in text):
+        try:
+            float(text)
+            return float
+        except ValueError:
+            pass
+    return str
+
+
+def _batches(rows, size):
+    rows = iter(rows)
+    return iter(lambda: list(itertools.islice(rows, size)), [])
+
+
+def _flush(buffer, file):
+    if buffer.tell():
+        file.write(buffer.getvalue())
+        buffer.seek(0)
+        buffer.truncate()
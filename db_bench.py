@@ -0,0 +1,279 @@
+"""Benchmarks for the db operators and for whole queries.
+
+    python db_bench.py --rows 1000 100000 --output new.json
+    python db_bench.py --rows 100000 --columnar numpy --only WHERE AGGREGATE
+    python db_bench.py --compare old.json new.json
+
+Each benchmark runs on synthetic tables (see generate_rows) and reports the
+best wall time over --repeat runs and the peak memory allocated during one
+more run, traced separately so that tracing doesn't skew the timings.
+"""
+
+import argparse
+import bisect
+import itertools
+import json
+import math
+import random
+import sys
+import time
+import tracemalloc
+
+from db import Database, col, query
+
+
+def generate_rows(n, cardinality=100, skew=0.0, seed=0):
+    """n rows of {"id", "key", "value", "score", "name"}.
+
+    key takes cardinality distinct values; with skew > 0 their frequencies
+    follow a Zipf distribution with that exponent, so key 0 is the most
+    common. value is uniform in [0, n), score a float and name a string with
+    cardinality distinct values.
+    """
+    rand = random.Random(seed)
+    weights = [1 / (k + 1) ** skew for k in range(cardinality)]
+    cum_weights = list(itertools.accumulate(weights))
+    total = cum_weights[-1]
+    rows = []
+    for i in range(n):
+        key = bisect.bisect_left(cum_weights, rand.random() * total)
+        key = min(key, cardinality - 1)
+        rows.append(
+            {
+                "id": i,
+                "key": key,
+                "value": rand.randrange(n),
+                "score": rand.random() * 100,
+                "name": f"name{rand.randrange(cardinality)}",
+            }
+        )
+    return rows
+
+
+def make_database(rows, cardinality=100, columnar=False):
+    """A Database with a "facts" table of rows (from generate_rows) and a
+    "keys" table with one row per key, for joins. columnar is passed on to
+    CREATE_TABLE for the facts."""
+    db = Database()
+    db.CREATE_TABLE("facts", columnar=columnar)
+    db.INSERT_INTO("facts", rows)
+    db.CREATE_TABLE("keys")
+    db.INSERT_INTO("keys", [{"key": k, "label": f"k{k}"} for k in range(cardinality)])
+    return db
+
+
+# name -> function(db, rows) doing the measured work. Each gets a fresh
+# database from make_database.
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    def register(fn):
+        BENCHMARKS[name] = fn
+        return fn
+
+    return register
+
+
+@benchmark("INSERT_INTO")
+def bench_insert_into(db, rows):
+    db.CREATE_TABLE("copy")
+    db.INSERT_INTO("copy", rows)
+
+
+@benchmark("WHERE")
+def bench_where(db, rows):
+    db.WHERE(db.tables["facts"], col("key") == 1)
+
+
+@benchmark("SELECT")
+def bench_select(db, rows):
+    db.SELECT(db.tables["facts"], ["id", "score"], {"score": "s"})
+
+
+@benchmark("CROSS_JOIN")
+def bench_cross_join(db, rows):
+    # Both sides sqrt(n) rows, so the output has about n rows
+    side = math.isqrt(len(rows)) or 1
+    facts = db.tables["facts"]
+    db.CROSS_JOIN(facts.take(range(side)), facts.take(range(side)))
+
+
+@benchmark("JOIN")
+def bench_join(db, rows):
+    db.JOIN(db.tables["facts"], db.tables["keys"], col("facts.key") == col("keys.key"))
+
+
+@benchmark("LEFT_JOIN")
+def bench_left_join(db, rows):
+    pred = col("facts.key") == col("keys.key")
+    db.LEFT_JOIN(db.tables["facts"], db.tables["keys"], pred)
+
+
+@benchmark("GROUP_BY")
+def bench_group_by(db, rows):
+    db.GROUP_BY(db.tables["facts"], ["key"])
+
+
+@benchmark("AGGREGATE")
+def bench_aggregate(db, rows):
+    aggregates = [("COUNT", "id"), ("SUM", "value"), ("MAX", "score")]
+    db.AGGREGATE(db.tables["facts"], ["key"], aggregates)
+
+
+@benchmark("DISTINCT")
+def bench_distinct(db, rows):
+    db.DISTINCT(db.tables["facts"], ["key", "name"])
+
+
+@benchmark("ORDER_BY")
+def bench_order_by(db, rows):
+    db.ORDER_BY(db.tables["facts"], col("score"))
+
+
+@benchmark("ORDER_BY+LIMIT")
+def bench_order_by_limit(db, rows):
+    db.ORDER_BY(db.tables["facts"], col("score"), 10)
+
+
+@benchmark("query:filter-project")
+def bench_query_filter_project(db, rows):
+    query(
+        db,
+        from_=["facts"],
+        where=[(col("key") < 10) & (col("score") > 50)],
+        select=["id", "name"],
+    )
+
+
+@benchmark("query:join-aggregate")
+def bench_query_join_aggregate(db, rows):
+    query(
+        db,
+        from_=["facts", "keys"],
+        where=[col("facts.key") == col("keys.key")],
+        group_by=["keys.label"],
+        aggregate=[("COUNT", "facts.id"), ("AVG", "facts.score")],
+    )
+
+
+@benchmark("query:top-k")
+def bench_query_top_k(db, rows):
+    query(db, from_=["facts"], order_by=col("value"), offset=5, limit=20)
+
+
+def measure(fn, repeat=3):
+    """(best wall time in seconds over repeat runs, peak bytes allocated in a
+    separate traced run) of calling fn."""
+    best = math.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return best, peak
+
+
+def run(
+    sizes, names=None, repeat=3, cardinality=100, skew=0.0, seed=0, columnar=False
+):
+    """Results of the benchmarks called names (all by default) at each size,
+    as a list of {"name", "rows", "seconds", "peak_bytes"} dicts."""
+    results = []
+    for n in sizes:
+        rows = generate_rows(n, cardinality, skew, seed)
+        for name in names or BENCHMARKS:
+            fn = BENCHMARKS[name]
+            db = make_database(rows, cardinality, columnar)
+            seconds, peak = measure(lambda: fn(db, rows), repeat)
+            results.append(
+                {"name": name, "rows": n, "seconds": seconds, "peak_bytes": peak}
+            )
+    return results
+
+
+def compare(old, new, threshold=0.1):
+    """Lines comparing two runs' results, measurement by measurement.
+    Returns (lines, regressions) where regressions counts the measurements
+    that got worse by more than threshold (a fraction)."""
+    old = {(r["name"], r["rows"]): r for r in old}
+    lines = []
+    regressions = 0
+    for result in new:
+        before = old.get((result["name"], result["rows"]))
+        if before is None:
+            continue
+        changes = []
+        for metric in ("seconds", "peak_bytes"):
+            change = _relative_change(before[metric], result[metric])
+            flag = ""
+            if change > threshold:
+                flag = " REGRESSION"
+                regressions += 1
+            changes.append(f"{metric} {change:+.1%}{flag}")
+        lines.append(f"{result['name']} @ {result['rows']}: " + ", ".join(changes))
+    return lines, regressions
+
+
+def _relative_change(before, after):
+    if before == 0:
+        return 0.0 if after == 0 else math.inf
+    return (after - before) / before
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument("--only", nargs="+", choices=sorted(BENCHMARKS))
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--cardinality", type=int, default=100)
+    parser.add_argument("--skew", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--columnar",
+        choices=["array", "numpy"],
+        help="store the facts table column by column, in array.arrays or NumPy",
+    )
+    parser.add_argument("--output", help="write results to this JSON file")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"))
+    parser.add_argument("--threshold", type=float, default=0.1)
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        runs = []
+        for path in args.compare:
+            with open(path) as f:
+                runs.append(json.load(f))
+        lines, regressions = compare(*runs, threshold=args.threshold)
+        print("\n".join(lines))
+        return 1 if regressions else 0
+
+    columnar = {None: False, "array": True, "numpy": "numpy"}[args.columnar]
+    results = run(
+        args.rows,
+        args.only,
+        args.repeat,
+        args.cardinality,
+        args.skew,
+        args.seed,
+        columnar,
+    )
+    for result in results:
+        print(
+            f"{result['name']:<24} {result['rows']:>10} rows "
+            f"{result['seconds'] * 1000:>10.2f} ms "
+            f"{result['peak_bytes'] / 2**20:>8.2f} MiB"
+        )
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,5 +1,44 @@
+import array
+import asyncio
+import concurrent.futures
+import contextlib
+import heapq
+import io
+import itertools
+import os
+import tempfile
+import threading
+import time
 import unittest
-from db import Database, Table, query
+from unittest import mock
+
+import db as db_module
+import db_bench
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from db import (
+    ColumnTable,
+    Database,
+    HashIndex,
+    NumpyTable,
+    Record,
+    Stream,
+    Table,
+    aquery,
+    col,
+    csv,
+    explain,
+    load_csv,
+    load_jsonl,
+    parse,
+    query,
+    write_csv,
+    write_jsonl,
+)
 
 __import__("sys").modules["unittest.util"]._MAX_LENGTH = 999999999
 
@@ -80,6 +119,50 @@ class DatabaseTests(unittest.TestCase):
         self.assertIn(rows[1], table.rows)
         self.assertIn(new_row, table.rows)
 
+    def test_insert_into_accepts_iterator(self):
+        db = Database()
+        table = db.CREATE_TABLE("numbers")
+        db.INSERT_INTO("numbers", ({"n": n} for n in range(3)))
+        db.INSERT_INTO("numbers", iter([{"n": 3}]))
+        self.assertEqual(table.rows, ({"n": 0}, {"n": 1}, {"n": 2}, {"n": 3}))
+        self.assertEqual(len(table), 4)
+
+    def test_insert_into_from_failing_iterator_inserts_nothing(self):
+        def rows():
+            yield {"n": 1}
+            raise RuntimeError("source failed")
+
+        for columnar in (False, True):
+            with self.subTest(columnar=columnar):
+                db = Database()
+                table = db.CREATE_TABLE("numbers", columnar=columnar)
+                db.INSERT_INTO("numbers", [{"n": 0}])
+                db.CREATE_INDEX("numbers", "n")
+                with self.assertRaises(RuntimeError):
+                    db.INSERT_INTO("numbers", rows())
+                self.assertEqual(table.rows, ({"n": 0},))
+                self.assertEqual(db.snapshot().tables["numbers"].rows, ({"n": 0},))
+                db.INSERT_INTO("numbers", [{"n": 1}])
+                self.assertEqual(table.indexes[("n",)].lookup(1), [1])
+
+    def test_insert_into_does_not_change_earlier_snapshots(self):
+        db = Database()
+        table = db.CREATE_TABLE("numbers")
+        db.INSERT_INTO("numbers", [{"n": 0}])
+        snapshot = table.rows
+        self.assertIs(table.rows, snapshot)
+        db.INSERT_INTO("numbers", [{"n": 1}])
+        self.assertEqual(snapshot, ({"n": 0},))
+        self.assertEqual(table.rows, ({"n": 0}, {"n": 1}))
+
+    def test_iterating_a_table_copies_no_rows(self):
+        table = Table("numbers", [{"n": 0}, {"n": 1}])
+        rows = iter(table)
+        table.extend([{"n": 2}])
+        self.assertEqual(list(rows), [{"n": 0}, {"n": 1}])
+        self.assertEqual(list(itertools.islice(table, 2)), [{"n": 0}, {"n": 1}])
+        self.assertIsNone(table._snapshot)
+
     def test_drop_table_removes_table(self):
         db = Database()
         db.CREATE_TABLE("foo")
@@ -215,6 +298,33 @@ class DatabaseTests(unittest.TestCase):
         )
         self.assertEqual(table.rows[0]["salary"], 50000)
 
+    def test_update_by_name_modifies_stored_table(self):
+        db = Database()
+        table = db.CREATE_TABLE("friends")
+        db.INSERT_INTO("friends", FRIENDS.rows)
+        version = table.version
+        count = db.UPDATE("friends", {"city": "Dallas"}, col("city") == "Houston")
+        self.assertEqual(count, 2)
+        self.assertIs(db.tables["friends"], table)
+        self.assertGreater(table.version, version)
+        self.assertEqual(
+            [row["city"] for row in table.rows],
+            [*(row["city"] for row in FRIENDS.rows[:4]), "Dallas"]
+            + [row["city"] for row in FRIENDS.rows[5:7]]
+            + ["Dallas"],
+        )
+        self.assertEqual(FRIENDS.rows[4]["city"], "Houston")
+        self.assertEqual(db.UPDATE("friends", {"id": 0}, col("id") > 100), 0)
+
+    def test_delete_removes_matching_rows(self):
+        db = Database()
+        table = db.CREATE_TABLE("friends")
+        db.INSERT_INTO("friends", FRIENDS.rows)
+        self.assertEqual(db.DELETE("friends", col("state") == "Colorado"), 4)
+        self.assertEqual(table.rows, (*FRIENDS.rows[3:5], *FRIENDS.rows[6:]))
+        self.assertEqual(db.DELETE("friends"), 4)
+        self.assertEqual(table.rows, ())
+
     def test_cross_join_returns_cartesian_product(self):
         db = Database()
         foo = Table("foo", [{"a": 1}, {"a": 2}])
@@ -229,6 +339,29 @@ class DatabaseTests(unittest.TestCase):
             ),
         )
 
+    def test_cross_join_rows_share_one_schema(self):
+        db = Database()
+        foo = Table("foo", [{"a": 1, "b": "x"}, {"a": 2, "b": "y"}])
+        bar = Table("bar", [{"b": 3}])
+        first, second = db.CROSS_JOIN(foo, bar).rows
+        self.assertIsInstance(first, Record)
+        self.assertIs(first.schema, second.schema)
+        self.assertEqual(first["foo.b"], "x")
+        self.assertEqual(first.get("bar.a"), None)
+        self.assertEqual(
+            list(first.items()), [("foo.a", 1), ("foo.b", "x"), ("bar.b", 3)]
+        )
+        self.assertNotEqual(first, second)
+        self.assertEqual({**second, "bar.b": 4}, {"foo.a": 2, "foo.b": "y", "bar.b": 4})
+        with self.assertRaises(KeyError):
+            first["a"]
+
+    def test_record_with_repeated_name_keeps_last_value(self):
+        db = Database()
+        result = db.CROSS_JOIN(Table("", [{"a": 1}]), Table("", [{"a": 2}]))
+        self.assertEqual(result.rows, ({"a": 2},))
+        self.assertEqual(len(result.rows[0]), 1)
+
     def test_inner_join_returns_matching_cross_product(self):
         user = Table("user", [{"id": 1, "name": "Alice"}])
         post = Table(
@@ -434,6 +567,131 @@ class DatabaseTests(unittest.TestCase):
             ),
         )
 
+    def test_inner_join_on_key_matches_predicate_join(self):
+        user = Table("user", [{"id": 1, "name": "Alice"}, {"id": 2, "name": "Bob"}])
+        post = Table(
+            "post",
+            [
+                {"id": 1, "user_id": 1, "title": "Hello"},
+                {"id": 2, "user_id": 2, "title": "Hello world"},
+                {"id": 3, "user_id": 1, "title": "Goodbye world"},
+                {"id": 2, "user_id": 3, "title": "Hello world again"},
+            ],
+        )
+        db = Database()
+        pred = lambda row: row["user.id"] == row["post.user_id"]
+        expected = db.JOIN(user, post, pred).rows
+        for on in [("user.id", "post.user_id"), ("post.user_id", "user.id")]:
+            self.assertEqual(db.JOIN(user, post, on).rows, expected)
+        # Larger left side builds the hash table on the right instead
+        expected = db.JOIN(post, user, pred).rows
+        on = ("user.id", "post.user_id")
+        self.assertEqual(db.JOIN(post, user, on).rows, expected)
+
+    def test_inner_join_on_unknown_key_raises(self):
+        user = Table("user", [{"id": 1, "name": "Alice"}])
+        post = Table("post", [{"id": 1, "user_id": 1}])
+        db = Database()
+        with self.assertRaises(ValueError):
+            db.JOIN(user, post, ("user.id", "post.author_id"))
+
+    def test_left_join_on_key_fills_in_null_for_non_matching_rows(self):
+        employee = Table(
+            "employee",
+            [
+                {"id": 1, "name": "Alice", "department_id": 100},
+                {"id": 2, "name": "Bob", "department_id": 2},
+            ],
+        )
+        department = Table(
+            "department",
+            [
+                {"id": 1, "title": "Accounting"},
+                {"id": 2, "title": "Engineering"},
+                {"id": 3, "title": "Sales"},
+            ],
+        )
+        db = Database()
+        expected = db.LEFT_JOIN(
+            employee,
+            department,
+            lambda row: row["employee.department_id"] == row["department.id"],
+        )
+        result = db.LEFT_JOIN(
+            employee, department, ("employee.department_id", "department.id")
+        )
+        self.assertEqual(result.rows, expected.rows)
+
+    def test_left_join_names_unnamed_tables_alike_on_every_path(self):
+        a = Table("", [{"id": 1}, {"id": 2}])
+        b = Table("b", [{"id": 2, "x": "y"}])
+        db = Database()
+        expected = db.LEFT_JOIN(a, b, lambda row: row[".id"] == row["b.id"])
+        self.assertEqual(
+            expected.rows,
+            (
+                {".id": 1, "b.id": None, "b.x": None},
+                {".id": 2, "b.id": 2, "b.x": "y"},
+            ),
+        )
+        for pred in ((".id", "b.id"), col(".id") == col("b.id")):
+            with self.subTest(pred):
+                self.assertEqual(db.LEFT_JOIN(a, b, pred).rows, expected.rows)
+
+    def test_right_join_on_key_fills_in_null_for_non_matching_rows(self):
+        employee = Table(
+            "employee",
+            [
+                {"id": 1, "name": "Alice", "department_id": 100},
+                {"id": 2, "name": "Bob", "department_id": 2},
+                {"id": 3, "name": "Charles", "department_id": 2},
+            ],
+        )
+        department = Table(
+            "department",
+            [
+                {"id": 1, "title": "Accounting"},
+                {"id": 2, "title": "Engineering"},
+            ],
+        )
+        db = Database()
+        expected = db.RIGHT_JOIN(
+            employee,
+            department,
+            lambda row: row["employee.department_id"] == row["department.id"],
+        )
+        result = db.RIGHT_JOIN(
+            employee, department, ("employee.department_id", "department.id")
+        )
+        self.assertEqual(result.rows, expected.rows)
+
+    def test_operators_over_stream_are_lazy(self):
+        db = Database()
+        seen = []
+
+        def rows():
+            for i in range(1, 100):
+                seen.append(i)
+                yield {"a": i}
+
+        odd = db.WHERE(Stream("foo", rows()), lambda row: row["a"] % 2)
+        result = db.LIMIT(odd, 2)
+        self.assertIsInstance(result, Stream)
+        self.assertEqual(seen, [])
+        self.assertEqual(list(result), [{"a": 1}, {"a": 3}])
+        self.assertEqual(seen, [1, 2, 3])
+
+    def test_join_with_stream_on_left(self):
+        db = Database()
+        user = Table("user", [{"id": 1, "name": "Alice"}, {"id": 2, "name": "Bob"}])
+        post = Table("post", [{"id": 1, "user_id": 2}, {"id": 2, "user_id": 1}])
+        pred = lambda row: row["user.id"] == row["post.user_id"]
+        expected = db.JOIN(user, post, pred).rows
+        result = db.JOIN(Stream("user", user.rows), post, pred)
+        self.assertEqual(tuple(result), expected)
+        result = db.JOIN(Stream("user", user.rows), post, ("user.id", "post.user_id"))
+        self.assertEqual(tuple(result), expected)
+
     def tests_limit_returns_empty_table(self):
         db = Database()
         table = Table("foo", [])
@@ -454,6 +712,12 @@ class DatabaseTests(unittest.TestCase):
             result.rows, ({"a": 1, "b": 2}, {"a": 2, "b": 2}, {"a": 3, "b": 2})
         )
 
+    def test_order_by_with_limit_keeps_stable_order(self):
+        db = Database()
+        by_state = lambda row: row["state"]
+        result = db.ORDER_BY(FRIENDS, by_state, 5)
+        self.assertEqual(result.rows, db.ORDER_BY(FRIENDS, by_state).rows[:5])
+
     def test_having_returns_matching_rows(self):
         db = Database()
         table = Table("foo", [{"a": 1}, {"a": 2}, {"a": 3}, {"a": 4}])
@@ -466,6 +730,18 @@ class DatabaseTests(unittest.TestCase):
         result = db.OFFSET(table, 2)
         self.assertEqual(result.rows, ({"a": 3}, {"a": 4}))
 
+    def test_negative_limit_and_offset_slice(self):
+        db = Database()
+        rows = [{"a": i} for i in range(5)]
+        for table in (lambda: Table("foo", rows), lambda: Stream("foo", rows)):
+            self.assertEqual(list(db.OFFSET(table(), -2)), rows[-2:])
+            self.assertEqual(list(db.LIMIT(table(), -2)), rows[:-2])
+        db.CREATE_TABLE("foo")
+        db.INSERT_INTO("foo", rows)
+        by_a = lambda row: -row["a"]
+        result = query(db, from_=["foo"], order_by=by_a, offset=-3, limit=2)
+        self.assertEqual(result.rows, tuple(sorted(rows, key=by_a)[-3:][:2]))
+
     def test_distinct_unique_on_one_column_name(self):
         db = Database()
         result = db.DISTINCT(FRIENDS, ["city"])
@@ -665,75 +941,2016 @@ class DatabaseTests(unittest.TestCase):
             ),
         )
 
+    def test_min_and_avg_group_by(self):
+        db = Database()
+        grouped = db.GROUP_BY(FRIENDS, ["state"])
+        self.assertEqual(
+            db.MIN(grouped, "id").rows,
+            (
+                {"MIN(id)": 1, "state": "Colorado"},
+                {"MIN(id)": 4, "state": "Texas"},
+                {"MIN(id)": 8, "state": "Elsewhere"},
+            ),
+        )
+        self.assertEqual(
+            db.AVG(grouped, "id").rows,
+            (
+                {"AVG(id)": 3.0, "state": "Colorado"},
+                {"AVG(id)": 16 / 3, "state": "Texas"},
+                {"AVG(id)": 8.0, "state": "Elsewhere"},
+            ),
+        )
 
-class EndToEndTests(unittest.TestCase):
-    def test_query(self):
+    def test_aggregate_computes_all_aggregates_per_group(self):
         db = Database()
-        friend = db.CREATE_TABLE("friend")
-        db.INSERT_INTO(
-            "friend",
+        result = db.AGGREGATE(
+            FRIENDS,
+            ["state"],
             [
-                {"id": 1, "name": "Alice", "city": "Denver", "state": "Colorado"},
+                ("COUNT", "*"),
+                ("SUM", "id"),
+                ("MAX", "city"),
+                ("min", "id"),
+                ("AVG", "id"),
+            ],
+        )
+        self.assertEqual(
+            result.rows,
+            (
                 {
-                    "id": 2,
-                    "name": "Bob",
-                    "city": "Colorado Springs",
                     "state": "Colorado",
+                    "COUNT(*)": 4,
+                    "SUM(id)": 12,
+                    "MAX(city)": "South Park",
+                    "MIN(id)": 1,
+                    "AVG(id)": 3.0,
                 },
-                {"id": 3, "name": "Charles", "city": "South Park", "state": "Colorado"},
-                {"id": 4, "name": "Dave", "city": "Fort Collins", "state": "Colorado"},
-                {"id": 5, "name": "Edna", "city": "Houston", "state": "Texas"},
-                {"id": 6, "name": "Francis", "city": "Denver", "state": "Colorado"},
-                {"id": 7, "name": "Gloria", "city": "Corpus Christi", "state": "Texas"},
-                {"id": 9, "name": "Homer", "city": "Denver", "state": "Colorado"},
-            ],
+                {
+                    "state": "Texas",
+                    "COUNT(*)": 3,
+                    "SUM(id)": 16,
+                    "MAX(city)": "Houston",
+                    "MIN(id)": 4,
+                    "AVG(id)": 16 / 3,
+                },
+                {
+                    "state": "Elsewhere",
+                    "COUNT(*)": 1,
+                    "SUM(id)": 8,
+                    "MAX(city)": "Houston",
+                    "MIN(id)": 8,
+                    "AVG(id)": 8.0,
+                },
+            ),
         )
-        employee = db.CREATE_TABLE("employee")
-        db.INSERT_INTO(
+
+    def test_aggregate_matches_group_by_aggregates(self):
+        db = Database()
+        grouped = db.GROUP_BY(FRIENDS, ["city", "state"])
+        expected = db.COUNT(grouped, "id").rows
+        result = db.AGGREGATE(FRIENDS, ["city", "state"], [("COUNT", "id")])
+        self.assertEqual(result.rows, expected)
+
+    def test_aggregate_without_group_by(self):
+        db = Database()
+        aggregates = [("COUNT", "id"), ("SUM", "id"), ("MAX", "id"), ("AVG", "id")]
+        self.assertEqual(
+            db.AGGREGATE(FRIENDS, [], aggregates).rows,
+            ({"COUNT(id)": 8, "SUM(id)": 36, "MAX(id)": 8, "AVG(id)": 4.5},),
+        )
+        self.assertEqual(
+            db.AGGREGATE(Table("empty", []), [], aggregates).rows,
+            ({"COUNT(id)": 0, "SUM(id)": 0, "MAX(id)": None, "AVG(id)": None},),
+        )
+
+    def test_aggregate_unknown_function_raises(self):
+        with self.assertRaises(ValueError):
+            Database().AGGREGATE(FRIENDS, [], [("MEDIAN", "id")])
+
+
+SCORES = [
+    {"id": 1, "name": "Alice", "test": 0, "score": 80.5},
+    {"id": 4, "name": "Bob", "test": 0, "score": 89.0},
+    {"id": 7, "name": "Charles", "test": 0, "score": 34.0},
+    {"id": 2, "name": "Alice", "test": 1, "score": 85.0},
+    {"id": 5, "name": "Bob", "test": 1, "score": 85.5},
+    {"id": 8, "name": "Charles", "test": 1, "score": 33.0},
+]
+
+
+class ColumnTableTests(unittest.TestCase):
+    def test_numeric_columns_are_packed_into_arrays(self):
+        table = ColumnTable("scores", SCORES)
+        self.assertIsInstance(table.columns["id"], array.array)
+        self.assertIsInstance(table.columns["score"], array.array)
+        self.assertIsInstance(table.columns["name"], list)
+        self.assertEqual(table.rows, tuple(SCORES))
+        self.assertEqual(len(table), 6)
+
+    def test_insert_into_columnar_table(self):
+        db = Database()
+        table = db.CREATE_TABLE("scores", columnar=True)
+        db.INSERT_INTO("scores", SCORES[:3])
+        db.INSERT_INTO("scores", SCORES[3:])
+        self.assertEqual(table.rows, tuple(SCORES))
+        row = {"id": None, "name": "Dan", "test": 2, "score": 1}
+        db.INSERT_INTO("scores", [row])
+        self.assertIsInstance(table.columns["id"], list)
+        self.assertEqual(table.rows[-1], row)
+
+    def test_operators_match_row_tables(self):
+        db = Database()
+        rows, columns = Table("scores", SCORES), ColumnTable("scores", SCORES)
+        for op in (
+            lambda t: db.WHERE(t, lambda row: row["score"] > 80),
+            lambda t: db.SELECT(t, ["name", "score"], {"score": "s"}),
+            lambda t: db.LIMIT(t, 2),
+            lambda t: db.OFFSET(t, 4),
+            lambda t: db.SUM(t, "score"),
+            lambda t: db.MAX(t, "id"),
+            lambda t: db.COUNT(t, "id"),
+            lambda t: db.SUM(db.GROUP_BY(t, ["name"]), "score"),
+            lambda t: db.COUNT(db.GROUP_BY(t, ["test"]), "id"),
+            lambda t: db.AGGREGATE(t, ["name"], [("SUM", "score"), ("COUNT", "id")]),
+            lambda t: db.AGGREGATE(t, [], [("MIN", "score"), ("COUNT", "id")]),
+        ):
+            self.assertEqual(op(columns).rows, op(rows).rows)
+
+    def test_update_and_delete_in_place(self):
+        db = Database()
+        table = db.CREATE_TABLE("scores", columnar=True)
+        db.INSERT_INTO("scores", SCORES)
+        db.UPDATE("scores", {"score": 0.0}, col("name") == "Bob")
+        self.assertEqual(table.columns["score"][1::3], array.array("d", [0.0, 0.0]))
+        db.UPDATE("scores", {"test": None}, col("id") == 1)
+        self.assertEqual(table.columns["test"], [None, 0, 0, 1, 1, 1])
+        db.DELETE("scores", col("test") == 0)
+        self.assertEqual(table.columns["id"], array.array("q", [1, 2, 5, 8]))
+        self.assertEqual(len(table), 4)
+        with self.assertRaises(ValueError):
+            db.UPDATE("scores", {"grade": "A"})
+
+    def test_where_and_select_stay_columnar(self):
+        db = Database()
+        table = ColumnTable("scores", SCORES)
+        result = db.SELECT(db.WHERE(table, lambda row: row["test"] == 1), ["score"])
+        self.assertIsInstance(result, ColumnTable)
+        self.assertEqual(result.columns["score"], array.array("d", [85.0, 85.5, 33.0]))
+
+
+    def test_where_evaluates_exprs_column_by_column(self):
+        db = Database()
+        rows = [*SCORES, {"id": None, "name": "Dan", "test": 2, "score": 1.0}]
+        table, expected = ColumnTable("scores", rows), Table("scores", rows)
+        for pred in (
+            (col("id") != None) & (col("id") > 2),
+            (col("test") == 1) | ~col("name").IN(["Bob", "Dan"]),
+            col("score").BETWEEN(col("test"), 85.0) | (col("id") == None),
+        ):
+            with self.subTest(pred), mock.patch.object(
+                ColumnTable, "__iter__", side_effect=AssertionError
+            ):
+                result = db.WHERE(table, pred)
+            self.assertEqual(result.rows, db.WHERE(expected, pred).rows)
+
+@unittest.skipIf(numpy is None, "needs numpy")
+class NumpyTableTests(unittest.TestCase):
+    def test_numeric_columns_are_numpy_arrays(self):
+        db = Database()
+        table = db.CREATE_TABLE("scores", columnar="numpy")
+        db.INSERT_INTO("scores", SCORES[:3])
+        db.INSERT_INTO("scores", SCORES[3:])
+        self.assertIsInstance(table, NumpyTable)
+        self.assertEqual(table.columns["id"].dtype, numpy.int64)
+        self.assertEqual(table.columns["score"].dtype, numpy.float64)
+        self.assertIsInstance(table.columns["name"], list)
+        self.assertEqual(table.rows, tuple(SCORES))
+        self.assertIs(type(table.rows[0]["id"]), int)
+        row = {"id": None, "name": "Dan", "test": 2, "score": 1}
+        db.INSERT_INTO("scores", [row])
+        self.assertIsInstance(table.columns["id"], list)
+        self.assertEqual(table.rows[-1], row)
+
+    def test_operators_match_row_tables(self):
+        db = Database()
+        rows, arrays = Table("scores", SCORES), NumpyTable("scores", SCORES)
+        for op in (
+            lambda t: db.WHERE(t, col("score") > 80),
+            lambda t: db.WHERE(t, (col("test") == 1) | ~col("id").IN([1, 4])),
+            lambda t: db.WHERE(t, col("score").BETWEEN(34, 85.0)),
+            lambda t: db.WHERE(t, col("name") == "Bob"),
+            lambda t: db.WHERE(t, lambda row: row["score"] > 80),
+            lambda t: db.SELECT(t, ["name", "score"], {"score": "s"}),
+            lambda t: db.LIMIT(t, 2),
+            lambda t: db.OFFSET(t, 4),
+            lambda t: db.ORDER_BY(t, col("score")),
+            lambda t: db.ORDER_BY(t, col("score"), 3),
+            lambda t: db.ORDER_BY(t, col("name")),
+            lambda t: db.DISTINCT(t, ["test"]),
+            lambda t: db.DISTINCT(t, ["name", "test"]),
+            lambda t: db.SUM(t, "score"),
+            lambda t: db.MAX(db.GROUP_BY(t, ["test"]), "score"),
+            lambda t: db.COUNT(db.GROUP_BY(t, ["name"]), "id"),
+            lambda t: db.AGGREGATE(
+                t, ["test"], [("SUM", "id"), ("AVG", "score"), ("COUNT", "name")]
+            ),
+            lambda t: db.AGGREGATE(t, [], [("MIN", "score"), ("MAX", "id")]),
+            lambda t: db.AGGREGATE(t, ["name"], [("SUM", "score")]),
+            lambda t: db.AGGREGATE(t.take([]), [], [("SUM", "id")]),
+        ):
+            self.assertEqual(op(arrays).rows, op(rows).rows)
+
+    def test_aggregates_keep_python_results(self):
+        db = Database()
+        rows = [{"n": 2**62, "b": True}, {"n": 2**62, "b": False}]
+        arrays = NumpyTable("t", rows)
+        self.assertIsInstance(arrays.columns["n"], numpy.ndarray)
+        aggregates = [("SUM", "n"), ("AVG", "n"), ("MAX", "b"), ("MIN", "b")]
+        (result,) = db.AGGREGATE(arrays, [], aggregates).rows
+        self.assertEqual(result, db.AGGREGATE(Table("t", rows), [], aggregates).rows[0])
+        self.assertEqual(result["SUM(n)"], 2**63)
+        self.assertIs(result["MAX(b)"], True)
+        self.assertIs(result["MIN(b)"], False)
+
+    def test_query_filters_with_mask(self):
+        db = Database()
+        db.CREATE_TABLE("scores", columnar="numpy")
+        db.INSERT_INTO("scores", SCORES)
+        mask = NumpyTable._mask
+        with mock.patch.object(NumpyTable, "_mask", autospec=True) as patched:
+            patched.side_effect = mask
+            result = query(db, from_=["scores"], where=[col("test") == 0])
+        patched.assert_called()
+        self.assertEqual(result.rows, tuple(s for s in SCORES if s["test"] == 0))
+
+    def test_vectorized_operators_do_not_scan_rows(self):
+        db = Database()
+        table = NumpyTable("scores", SCORES)
+        with mock.patch.object(NumpyTable, "__iter__", side_effect=AssertionError):
+            where = db.WHERE(table, (col("score") > 80) & (col("test") == 1))
+            ordered = db.ORDER_BY(table, col("id"), 2)
+            aggregated = db.AGGREGATE(table, ["test"], [("MAX", "score")])
+        self.assertEqual(where.columns["id"].tolist(), [2, 5])
+        self.assertEqual(ordered.ordered_by, "id")
+        self.assertEqual(ordered.columns["id"].tolist(), [1, 2])
+        self.assertEqual(
+            aggregated.rows,
+            ({"test": 0, "MAX(score)": 89.0}, {"test": 1, "MAX(score)": 85.5}),
+        )
+
+    def test_update_and_delete_in_place(self):
+        db = Database()
+        table = db.CREATE_TABLE("scores", columnar="numpy")
+        db.INSERT_INTO("scores", SCORES)
+        selected = db.SELECT(table, ["score"])
+        db.UPDATE("scores", {"score": 0.0}, col("test") == 1)
+        db.UPDATE("scores", {"id": 2**70}, col("id") == 1)
+        db.DELETE("scores", col("name") == "Charles")
+        self.assertEqual(selected.columns["score"][3:].tolist(), [85.0, 85.5, 33.0])
+        self.assertEqual(table.columns["score"].tolist(), [80.5, 89.0, 0.0, 0.0])
+        self.assertEqual(table.columns["id"], [2**70, 4, 2, 5])
+        self.assertEqual(table.rows[2], {**SCORES[3], "score": 0.0})
+
+    def test_query_and_persistence(self):
+        with tempfile.TemporaryDirectory() as path:
+            db = Database(path)
+            db.CREATE_TABLE("scores", columnar="numpy")
+            db.INSERT_INTO("scores", SCORES)
+            expected = query(
+                db,
+                from_=["scores"],
+                where=[col("test") == 1],
+                group_by=["name"],
+                aggregate=[("SUM", "score")],
+            )
+            db.close()
+            db = Database(path)
+            self.assertIsInstance(db.tables["scores"], NumpyTable)
+            self.assertEqual(db.tables["scores"].rows, tuple(SCORES))
+            db.CHECKPOINT()
+            db.close()
+            db = Database(path)
+            self.assertIsInstance(db.tables["scores"], NumpyTable)
+            result = db.execute(
+                "SELECT name, SUM(score) FROM scores WHERE test = 1 GROUP BY name"
+            )
+            self.assertEqual(result.rows, expected.rows)
+            db.close()
+
+
+class IndexTests(unittest.TestCase):
+    def setUp(self):
+        self.db = Database()
+        self.db.CREATE_TABLE("friends")
+        self.db.INSERT_INTO("friends", FRIENDS.rows)
+
+    def test_hash_index_equality_lookup(self):
+        self.db.CREATE_INDEX("friends", "city")
+        result = self.db.WHERE(self.db.tables["friends"], ("city", "==", "Houston"))
+        self.assertEqual(result.rows, (FRIENDS.rows[4], FRIENDS.rows[7]))
+
+    def test_sorted_index_range_lookup(self):
+        self.db.CREATE_INDEX("friends", "id", kind="sorted")
+        table = self.db.tables["friends"]
+        self.assertEqual(self.db.WHERE(table, ("id", ">", 6)).rows, FRIENDS.rows[6:])
+        self.assertEqual(self.db.WHERE(table, ("id", "<=", 2)).rows, FRIENDS.rows[:2])
+        self.assertEqual(self.db.WHERE(table, ("id", "==", 3)).rows, FRIENDS.rows[2:3])
+
+    def test_sorted_index_probes_of_another_type(self):
+        self.db.CREATE_INDEX("friends", "id", kind="sorted")
+        table = self.db.tables["friends"]
+        self.assertEqual(self.db.WHERE(table, col("id") == "a").rows, ())
+        self.db.CREATE_TABLE("visits")
+        self.db.INSERT_INTO("visits", [{"friend_id": "a"}, {"friend_id": 2}])
+        result = self.db.JOIN(
+            self.db.tables["visits"], table, ("visits.friend_id", "friends.id")
+        )
+        self.assertEqual([row["friends.id"] for row in result.rows], [2])
+        # Left to the scan, which compares them as a filter would
+        with self.assertRaises(TypeError):
+            self.db.WHERE(table, col("id") > "a")
+
+    def test_index_is_kept_up_to_date_by_insert_into(self):
+        index = self.db.CREATE_INDEX("friends", ["city", "state"], kind="sorted")
+        self.db.INSERT_INTO(
+            "friends", [{"id": 9, "city": "Houston", "state": "Texas"}]
+        )
+        self.assertEqual(index.lookup(("Houston", "Texas")), [4, 8])
+        self.assertEqual(index.lookup(("Houston", "Elsewhere")), [7])
+
+    def test_update_and_delete_in_place_maintain_indexes(self):
+        table = self.db.tables["friends"]
+        self.db.CREATE_INDEX("friends", "state")
+        by_id = self.db.CREATE_INDEX("friends", "id", kind="sorted")
+        self.db.CREATE_INDEX("friends", ["city", "state"], kind="sorted")
+        with mock.patch.object(by_id, "lookup", wraps=by_id.lookup) as lookup:
+            self.db.UPDATE("friends", {"state": "Texas", "id": 0}, col("id") == 8)
+        lookup.assert_called_once_with(8)
+        self.db.UPDATE("friends", {"state": None}, col("state") == "Colorado")
+        self.db.DELETE("friends", col("city") == "Denver")
+        self.db.DELETE("friends", col("id") == 3)
+        fresh = Table("friends", table.rows)
+        for columns, index in table.indexes.items():
+            rebuilt = fresh.create_index(columns, index.kind)
+            # Whether they share their storage with a copy aside
+            self.assertEqual(
+                {**vars(index), "_shared": False}, {**vars(rebuilt), "_shared": False}
+            )
+        self.assertEqual(table.indexes[("state",)].lookup("Texas"), [1, 2, 3, 4])
+        self.assertEqual(table.indexes[("id",)].ordered_positions(), [4, 0, 1, 2, 3])
+
+    def test_comparison_without_index_scans(self):
+        result = self.db.WHERE(self.db.tables["friends"], ("state", "!=", "Colorado"))
+        self.assertEqual(result.rows, (*FRIENDS.rows[3:5], *FRIENDS.rows[6:]))
+
+    def test_unknown_index_kind_raises(self):
+        with self.assertRaises(ValueError):
+            self.db.CREATE_INDEX("friends", "city", kind="btree")
+
+    def test_drop_index(self):
+        self.db.CREATE_INDEX("friends", "city")
+        self.db.DROP_INDEX("friends", "city")
+        self.assertEqual(self.db.tables["friends"].indexes, {})
+
+    def test_update_keeps_indexes(self):
+        self.db.CREATE_INDEX("friends", "state")
+        result = self.db.UPDATE(
+            self.db.tables["friends"], {"state": "Texas"}, ("state", "==", "Elsewhere")
+        )
+        self.assertEqual(result.indexes[("state",)].lookup("Texas"), [3, 4, 6, 7])
+        self.assertEqual(result.indexes[("state",)].lookup("Elsewhere"), [])
+
+    def test_query_where_uses_index(self):
+        self.db.CREATE_INDEX("friends", "city")
+        with mock.patch.object(
+            HashIndex, "lookup", autospec=True, side_effect=HashIndex.lookup
+        ) as lookup:
+            result = query(
+                self.db,
+                select=["id"],
+                from_=["friends"],
+                where=[("state", "==", "Texas"), ("city", "==", "Houston")],
+            )
+        lookup.assert_called_once_with(mock.ANY, "Houston")
+        self.assertEqual(result.rows, ({"id": 5},))
+
+    def test_join_uses_index_on_right_table(self):
+        self.db.CREATE_TABLE("visits")
+        self.db.INSERT_INTO(
+            "visits", [{"friend_id": 8, "day": 1}, {"friend_id": 1, "day": 2}]
+        )
+        index = self.db.CREATE_INDEX("friends", "id")
+        visits, friends = self.db.tables["visits"], self.db.tables["friends"]
+        expected = self.db.JOIN(
+            visits, friends, lambda row: row["visits.friend_id"] == row["friends.id"]
+        )
+        with mock.patch.object(index, "lookup", wraps=index.lookup) as lookup:
+            result = self.db.JOIN(visits, friends, ("visits.friend_id", "friends.id"))
+            self.assertEqual(result.rows, expected.rows)
+        self.assertEqual(lookup.call_count, 2)
+
+    def test_columnar_table_index(self):
+        table = self.db.CREATE_TABLE("scores", columnar=True)
+        self.db.CREATE_INDEX("scores", "score", kind="sorted")
+        self.db.INSERT_INTO("scores", SCORES)
+        result = self.db.WHERE(table, ("score", ">=", 85.5))
+        self.assertIsInstance(result, ColumnTable)
+        self.assertEqual(result.rows, (SCORES[1], SCORES[4]))
+
+
+class ExprTests(unittest.TestCase):
+    ROW = {"a": 1, "b": 2, "c": "x"}
+
+    def test_comparisons(self):
+        self.assertTrue((col("a") == 1)(self.ROW))
+        self.assertTrue((col("a") != col("b"))(self.ROW))
+        self.assertTrue((col("a") < col("b"))(self.ROW))
+        self.assertFalse((col("b") <= 1)(self.ROW))
+        self.assertTrue((col("b") > 1)(self.ROW))
+        self.assertTrue((3 >= col("b"))(self.ROW))
+
+    def test_boolean_operators(self):
+        self.assertTrue(((col("a") == 1) & (col("c") == "x"))(self.ROW))
+        self.assertTrue(((col("a") == 2) | (col("c") == "x"))(self.ROW))
+        self.assertFalse((~(col("a") == 1))(self.ROW))
+        pred = (col("a") == 1) & (col("b") == 2) & (col("c") == "x")
+        self.assertEqual(len(pred.terms), 3)
+
+    def test_in_and_between(self):
+        self.assertTrue(col("c").IN(["x", "y"])(self.ROW))
+        self.assertFalse(col("a").IN([2, 3])(self.ROW))
+        self.assertTrue(col("b").BETWEEN(2, 3)(self.ROW))
+        self.assertFalse(col("b").BETWEEN(col("a"), 1)(self.ROW))
+
+    def test_repr(self):
+        pred = (col("a") == 1) & col("b").BETWEEN(0, 5)
+        self.assertEqual(repr(pred), "((col('a') == 1) & col('b').BETWEEN(0, 5))")
+
+    def test_expressions_cannot_be_used_as_bools(self):
+        with self.assertRaises(TypeError):
+            1 < col("a") < 3
+
+    def test_where_uses_indexes_for_expressions(self):
+        db = Database()
+        table = db.CREATE_TABLE("friends")
+        db.INSERT_INTO("friends", FRIENDS.rows)
+        db.CREATE_INDEX("friends", "id", kind="sorted")
+        db.CREATE_INDEX("friends", ["city", "state"])
+        for pred, expected in [
+            (col("id").BETWEEN(2, 3), FRIENDS.rows[1:3]),
+            (col("id").IN([8, 1]), (FRIENDS.rows[0], FRIENDS.rows[7])),
+            ((col("id") < 2) | (col("id") > 7), (FRIENDS.rows[0], FRIENDS.rows[7])),
+            (
+                (col("state") == "Texas") & (col("city") == "Houston"),
+                FRIENDS.rows[4:5],
+            ),
+            (
+                (col("id") > 2) & (col("state") == "Texas"),
+                (*FRIENDS.rows[3:5], FRIENDS.rows[6]),
+            ),
+        ]:
+            with mock.patch.object(table, "filter", wraps=table.filter) as scan:
+                self.assertEqual(db.WHERE(table, pred).rows, expected)
+            scan.assert_not_called()
+
+    def test_join_on_column_equality_uses_hash_join(self):
+        employee = Table(
             "employee",
             [
-                {"id": 1, "name": "Alice", "department_id": 100, "salary": 100},
-                {"id": 2, "name": "Bob", "department_id": 2, "salary": 150},
-                {"id": 3, "name": "Charles", "department_id": 2, "salary": 200},
-                {"id": 4, "name": "Dave", "department_id": 1, "salary": 180},
+                {"id": 1, "name": "Alice", "department_id": 1},
+                {"id": 2, "name": "Bob", "department_id": 2},
+                {"id": 3, "name": "Charles", "department_id": 2},
             ],
         )
-        department = db.CREATE_TABLE("department")
-        db.INSERT_INTO(
+        department = Table(
             "department",
-            [
-                {"id": 1, "title": "Accounting"},
-                {"id": 2, "title": "Engineering"},
-            ],
+            [{"id": 1, "title": "Accounting"}, {"id": 2, "title": "Engineering"}],
         )
-        result = query(
-            db,
-            select=["employee.name", "department.title", "friend.state"],
-            select_as={
-                "employee.name": "Name",
-                "department.title": "Dept",
-                "friend.state": "From",
-            },
-            from_=["employee"],
-            join=[
-                [
-                    "department",
-                    lambda row: row["employee.department_id"] == row["department.id"],
-                ],
-                ["friend", lambda row: row["friend.name"] == row["employee.name"]],
-            ],
-            where=[
-                lambda row: row["employee.salary"] > 150,
-                lambda row: row["friend.state"] == "Colorado",
-            ],
-            order_by=lambda row: row["Dept"],
+        db = Database()
+        pred = (col("employee.department_id") == col("department.id")) & (
+            col("employee.name") != "Bob"
         )
+        with mock.patch.object(db, "CROSS_JOIN") as cross_join:
+            inner = db.JOIN(employee, department, pred)
+            left = db.LEFT_JOIN(employee, department, pred)
+        cross_join.assert_not_called()
+        expected = db.CROSS_JOIN(employee, department).filter(pred)
+        self.assertEqual(inner.rows, expected.rows)
         self.assertEqual(
-            result.rows,
-            (
-                {"Name": "Dave", "Dept": "Accounting", "From": "Colorado"},
-                {"Name": "Charles", "Dept": "Engineering", "From": "Colorado"},
-            ),
+            left.rows, db.LEFT_JOIN(employee, department, lambda row: pred(row)).rows
+        )
+
+    def test_join_inputs_ordered_on_key_use_merge_join(self):
+        db = Database()
+        a = db.ORDER_BY(
+            Table("a", [{"k": k, "x": i} for i, k in enumerate([3, 1, 2, 1, 5, 3])]),
+            col("k"),
+        )
+        b = db.ORDER_BY(
+            Table("b", [{"k": k, "y": i} for i, k in enumerate([1, 3, 4, 1, 3, 0])]),
+            col("k"),
+        )
+        self.assertEqual(a.ordered_by, "k")
+        pred = col("a.k") == col("b.k")
+        with mock.patch("db._hash_matches") as hash_matches:
+            inner = db.JOIN(a, b, pred)
+            left = db.LEFT_JOIN(a, b, pred & (col("b.y") > 0))
+        hash_matches.assert_not_called()
+        self.assertEqual(inner.rows, db.CROSS_JOIN(a, b).filter(pred).rows)
+        self.assertEqual(
+            left.rows,
+            db.LEFT_JOIN(
+                a, b, lambda row: row["a.k"] == row["b.k"] and row["b.y"] > 0
+            ).rows,
+        )
+
+    def test_merge_join_matches_keys_that_dont_compare(self):
+        db = Database()
+        b = db.ORDER_BY(Table("b", [{"k": k} for k in [2, 1]]), col("k"))
+        on = ("a.k", "b.k")
+        for keys in ([None], [1, None], ["x", None]):
+            with self.subTest(keys):
+                a = Table("a", [{"k": k} for k in keys])
+                a.ordered_by = "k"
+                merged = db.LEFT_JOIN(a, b, on)
+                a.ordered_by = None
+                self.assertEqual(merged.rows, db.LEFT_JOIN(a, b, on).rows)
+
+    def test_merge_join_reads_sorted_index_in_key_order(self):
+        db = Database()
+        db.CREATE_TABLE("b")
+        db.INSERT_INTO("b", [{"k": k, "y": i} for i, k in enumerate([2, 1, 2, 0])])
+        db.CREATE_INDEX("b", ["k"], kind="sorted")
+        b = db.tables["b"]
+        a = db.ORDER_BY(Table("a", [{"k": k} for k in [2, 0, 1, 2]]), col("k"))
+        pred = col("a.k") == col("b.k")
+        with mock.patch("db._hash_matches") as hash_matches:
+            result = db.JOIN(a, b, pred)
+        hash_matches.assert_not_called()
+        self.assertEqual(result.rows, db.CROSS_JOIN(a, b).filter(pred).rows)
+        # Appending rows forgets the order
+        a.extend([{"k": 1}])
+        self.assertIsNone(a.ordered_by)
+
+    def test_query_merge_joins_tables_with_sorted_indexes(self):
+        db = Database()
+        for name, keys in (("a", [2, 0, 1, 2]), ("b", [2, 1, 2, 0, 3])):
+            db.CREATE_TABLE(name)
+            db.INSERT_INTO(name, [{"k": k, name: i} for i, k in enumerate(keys)])
+            db.CREATE_INDEX(name, "k", kind="sorted")
+        pred = col("a.k") == col("b.k")
+        expected = db.CROSS_JOIN(db.tables["a"], db.tables["b"]).filter(pred)
+        with mock.patch("db._merge_matches", wraps=db_module._merge_matches) as merge:
+            result = query(db, from_=["a"], join=[("b", ("a.k", "b.k"))])
+        merge.assert_called_once()
+        # In key order rather than a's
+        self.assertCountEqual(result.rows, expected.rows)
+        self.assertEqual([row["a.k"] for row in result.rows], [0, 1, 2, 2, 2, 2])
+
+class ParallelTests(unittest.TestCase):
+    def setUp(self):
+        self.serial = Database()
+        self.parallel = Database(workers=3)
+        self.parallel.parallel_min_rows = 0
+        rows = [
+            {"id": i, "group": i % 7, "score": (i * 37) % 101, "name": f"n{i % 5}"}
+            for i in range(200)
+        ]
+        for db in self.serial, self.parallel:
+            db.CREATE_TABLE("rows")
+            db.INSERT_INTO("rows", rows)
+            db.CREATE_TABLE("columns", columnar=True)
+            db.INSERT_INTO("columns", rows)
+
+    def assertSameResult(self, op, *args):
+        with mock.patch("db._run_partitions", wraps=db_module._run_partitions) as run:
+            result = op(self.parallel, *args)
+        run.assert_called()
+        self.assertEqual(result.rows, op(self.serial, *args).rows)
+
+    def test_operators_match_serial_results(self):
+        for name in ["rows", "columns"]:
+            with self.subTest(name):
+                table = lambda db: db.tables[name]
+                pred = lambda row: row["score"] > 50 and row["name"] != "n3"
+                aggregates = [("COUNT", "id"), ("sum", "score"), ("MAX", "score")]
+                self.assertSameResult(lambda db: db.WHERE(table(db), pred))
+                self.assertSameResult(
+                    lambda db: db.SUM(db.GROUP_BY(table(db), ["group"]), "score")
+                )
+                self.assertSameResult(
+                    lambda db: db.AGGREGATE(table(db), ["name"], aggregates)
+                )
+                self.assertSameResult(
+                    lambda db: db.AGGREGATE(table(db), [], aggregates)
+                )
+
+    def test_select_matches_serial_result(self):
+        # Column tables are projected by copying whole columns instead
+        self.assertSameResult(
+            lambda db: db.SELECT(db.tables["rows"], ["id", "name"], {"id": "key"})
+        )
+
+    def test_query_matches_serial_results(self):
+        kwargs = dict(
+            from_=["rows"],
+            where=[col("group") != 3],
+            group_by=["name"],
+            aggregate=[("AVG", "score"), ("MIN", "id")],
+            order_by=lambda row: row["name"],
+        )
+        self.assertSameResult(lambda db: query(db, **kwargs))
+
+    def test_small_tables_stay_serial(self):
+        self.parallel.parallel_min_rows = 1000
+        with mock.patch("db._run_partitions") as run:
+            self.parallel.WHERE(self.parallel.tables["rows"], col("id") < 3)
+        run.assert_not_called()
+
+    def test_other_threads_keep_operators_serial(self):
+        release = threading.Event()
+        thread = threading.Thread(target=release.wait)
+        thread.start()
+        try:
+            with mock.patch("db._run_partitions") as run:
+                rows = self.parallel.tables["rows"]
+                result = self.parallel.WHERE(rows, col("id") < 3)
+        finally:
+            release.set()
+            thread.join()
+        run.assert_not_called()
+        self.assertEqual(len(result), 3)
+
+
+class SqlTests(unittest.TestCase):
+    def setUp(self):
+        self.db = Database()
+        self.db.CREATE_TABLE("friends")
+        self.db.INSERT_INTO("friends", FRIENDS.rows)
+        self.db.CREATE_TABLE("states")
+        self.db.INSERT_INTO(
+            "states",
+            [
+                {"name": "Colorado", "abbreviation": "CO"},
+                {"name": "Texas", "abbreviation": "TX"},
+            ],
+        )
+
+    def test_parse_returns_plan_of_query_arguments(self):
+        plan = parse(
+            "select city as c, count(*) from friends "
+            "where friends.state = 'Texas' and id >= 4 "
+            "group by city having COUNT(*) > 1 order by c desc limit 5;"
+        )
+        self.assertEqual(
+            repr(plan),
+            "Plan(from_=['friends'], select=['city', 'COUNT(*)'], "
+            "select_as={'city': 'c'}, where=[((col('state') == 'Texas') & "
+            "(col('id') >= 4))], group_by=['city'], aggregate=[('COUNT', '*')], "
+            "having=(col('COUNT(*)') > 1), order_by=SortKey([('c', True)]), "
+            "limit=5)",
+        )
+
+    def test_execute_matches_query(self):
+        for sql, kwargs in [
+            (
+                "SELECT * FROM friends WHERE state IN ('Texas', 'Elsewhere') "
+                "AND NOT id BETWEEN 5 AND 7 ORDER BY id DESC LIMIT 2 OFFSET 1",
+                dict(
+                    where=[
+                        lambda row: row["state"] != "Colorado"
+                        and not 5 <= row["id"] <= 7
+                    ],
+                    order_by=lambda row: -row["id"],
+                    limit=2,
+                    offset=1,
+                ),
+            ),
+            (
+                "SELECT friends.city, states.abbreviation FROM friends "
+                "JOIN states ON friends.state = states.name "
+                "WHERE friends.id < 3 OR (friends.id > 6 AND friends.id <> 8)",
+                dict(
+                    select=["friends.city", "states.abbreviation"],
+                    join=[("states", ("friends.state", "states.name"))],
+                    where=[lambda row: row["friends.id"] in (1, 2, 7)],
+                ),
+            ),
+            (
+                "SELECT state, COUNT(id), MAX(id) FROM friends GROUP BY state "
+                "HAVING COUNT(id) >= 2 ORDER BY state",
+                dict(
+                    select=["state", "COUNT(id)", "MAX(id)"],
+                    group_by=["state"],
+                    aggregate=[("COUNT", "id"), ("MAX", "id")],
+                    having=lambda row: row["COUNT(id)"] >= 2,
+                    order_by=lambda row: row["state"],
+                ),
+            ),
+            (
+                "SELECT DISTINCT state AS s FROM friends WHERE city IS NOT NULL",
+                dict(select=["state"], select_as={"state": "s"}, distinct=["s"]),
+            ),
+        ]:
+            with self.subTest(sql):
+                expected = query(self.db, from_=["friends"], **kwargs)
+                self.assertEqual(self.db.execute(sql).rows, expected.rows)
+
+    def test_quoted_names_can_be_keywords(self):
+        self.db.CREATE_TABLE("k")
+        self.db.INSERT_INTO("k", [{"from": 2, "order": "b"}, {"from": 1, "order": "a"}])
+        result = self.db.execute('SELECT "from", "order" FROM k ORDER BY "order"')
+        self.assertEqual(
+            result.rows, ({"from": 1, "order": "a"}, {"from": 2, "order": "b"})
+        )
+        result = self.db.execute('SELECT "order" FROM k WHERE "from" = 2')
+        self.assertEqual(result.rows, ({"order": "b"},))
+        with self.assertRaisesRegex(ValueError, "found 'x' at 23"):
+            parse('SELECT id FROM friends "x"')
+
+    def test_execute_uses_indexes_for_where(self):
+        self.db.CREATE_INDEX("friends", "state")
+        table = self.db.tables["friends"]
+        with mock.patch.object(table, "filter", wraps=table.filter) as scan:
+            result = self.db.execute("SELECT id FROM friends WHERE state = 'Texas'")
+        scan.assert_not_called()
+        self.assertEqual(result.rows, ({"id": 4}, {"id": 5}, {"id": 7}))
+
+    def test_repeated_statements_are_parsed_once(self):
+        sql = "SELECT id FROM friends WHERE id = 3"
+        with mock.patch("db._Parser", wraps=db_module._Parser) as parser:
+            first = self.db.execute(sql)
+            second = self.db.execute(sql)
+        self.assertLessEqual(parser.call_count, 1)
+        self.assertEqual(first.rows, second.rows)
+
+    def test_invalid_statements_raise(self):
+        for sql in [
+            "SELECT FROM friends",
+            "SELECT id FROM friends WHERE",
+            "SELECT id FROM friends LIMIT -1",
+            "SELECT id FROM friends WHERE id = 1 extra",
+            "SELECT id FROM friends WHERE id ~ 1",
+            "UPDATE friends SET id = 1",
+        ]:
+            with self.subTest(sql), self.assertRaises(ValueError):
+                parse(sql)
+
+
+class ExplainTests(unittest.TestCase):
+    def setUp(self):
+        self.db = Database()
+        self.db.CREATE_TABLE("employee")
+        self.db.INSERT_INTO(
+            "employee",
+            [{"id": i, "department_id": i % 3, "salary": i * 10} for i in range(20)],
+        )
+        self.db.CREATE_TABLE("department")
+        self.db.INSERT_INTO(
+            "department", [{"id": i, "title": f"Dept {i}"} for i in range(3)]
+        )
+
+        def not_first_department(row):
+            return row["department.title"] != "Dept 0"
+
+        self.kwargs = dict(
+            from_=["employee", "department"],
+            where=[
+                col("employee.department_id") == col("department.id"),
+                col("employee.salary") >= 50,
+                not_first_department,
+            ],
+            group_by=["department.title"],
+            aggregate=[("COUNT", "employee.id")],
+            order_by=col("department.title"),
+            limit=1,
+        )
+
+    def test_explain_returns_operator_tree_without_running_it(self):
+        with mock.patch.object(self.db, "JOIN") as join:
+            plan = explain(self.db, **self.kwargs)
+        join.assert_not_called()
+        self.assertEqual(
+            str(plan),
+            "LIMIT 1\n"
+            "  ORDER_BY col('department.title') top 1\n"
+            "    AGGREGATE ['department.title'] [('COUNT', 'employee.id')]\n"
+            "      WHERE not_first_department\n"
+            "        JOIN (col('employee.department_id') == col('department.id'))\n"
+            "          SCAN employee (col('salary') >= 50)\n"
+            "          SCAN department",
+        )
+        self.assertIsNone(plan.stats)
+
+    def test_analyze_records_stats_for_every_operator(self):
+        seen = []
+        plan = explain(self.db, analyze=True, hook=seen.append, **self.kwargs)
+        self.assertEqual(seen, list(plan.walk()))
+        self.assertEqual(
+            [(node.op, node.stats["rows_in"], node.stats["rows_out"]) for node in seen],
+            [
+                ("SCAN", 0, 15),
+                ("SCAN", 0, 3),
+                ("JOIN", 18, 15),
+                ("WHERE", 15, 10),
+                ("AGGREGATE", 10, 2),
+                ("ORDER_BY", 2, 1),
+                ("LIMIT", 1, 1),
+            ],
+        )
+        for node in seen:
+            self.assertGreaterEqual(node.stats["seconds"], 0)
+            self.assertGreaterEqual(node.stats["peak_bytes"], 0)
+        self.assertIn("(rows in=10 out=2, ", str(plan))
+        self.assertEqual(
+            query(self.db, **self.kwargs).rows,
+            ({"department.title": "Dept 1", "COUNT(employee.id)": 5},),
+        )
+
+
+class CompiledQueryTests(unittest.TestCase):
+    def setUp(self):
+        self.db = Database()
+        self.db.CREATE_TABLE("friends")
+        self.db.INSERT_INTO("friends", FRIENDS.rows)
+        self.db.CREATE_TABLE("numbers", columnar=True)
+        self.db.INSERT_INTO("numbers", [{"n": n, "half": n / 2} for n in range(50)])
+
+    def assertCompiledMatches(self, **kwargs):
+        expected = query(self.db, **kwargs)
+        with mock.patch("db._plan_from") as plan:
+            result = query(self.db, compiled=True, **kwargs)
+        plan.assert_not_called()
+        self.assertEqual(result.rows, expected.rows)
+        return result
+
+    def test_compiled_queries_match_operators(self):
+        for kwargs in [
+            dict(from_=["friends"]),
+            dict(
+                from_=["friends"],
+                where=[
+                    (col("state") == "Texas") | col("id").IN([1, 2]),
+                    lambda row: row["city"] != "Houston",
+                ],
+                select=["id", "city"],
+                select_as={"city": "town"},
+                offset=1,
+                limit=2,
+            ),
+            dict(
+                from_=["friends"],
+                where=[~col("id").BETWEEN(3, 6), ("state", "!=", "Elsewhere")],
+            ),
+            dict(from_=["numbers"], where=[col("half") >= 20], select=["n"]),
+            dict(from_=["numbers"], where=[col("n") > 100], select=["n"]),
+        ]:
+            with self.subTest(kwargs):
+                self.assertCompiledMatches(**kwargs)
+
+    def test_queries_of_same_shape_share_compiled_code(self):
+        with mock.patch(
+            "db._compile_fused", wraps=db_module._compile_fused
+        ) as compile_fused:
+            for n in range(3):
+                self.assertCompiledMatches(
+                    from_=["numbers"], where=[col("n") < n], limit=n + 1
+                )
+        (source, count), _ = compile_fused.call_args
+        self.assertEqual(count, 2)
+        self.assertEqual(len({c.args for c in compile_fused.call_args_list}), 1)
+
+    def test_compiled_query_uses_indexes(self):
+        self.db.CREATE_INDEX("numbers", "n", kind="sorted")
+        with mock.patch.object(
+            ColumnTable, "_row", autospec=True, side_effect=ColumnTable._row
+        ) as read:
+            result = query(
+                self.db,
+                from_=["numbers"],
+                where=[col("n") >= 47],
+                select=["n"],
+                compiled=True,
+            )
+        self.assertEqual(read.call_count, 3)
+        self.assertEqual(result.rows, ({"n": 47}, {"n": 48}, {"n": 49}))
+
+    def test_other_queries_fall_back_to_operators(self):
+        result = query(
+            self.db,
+            from_=["friends"],
+            group_by=["state"],
+            aggregate=[("COUNT", "id")],
+            compiled=True,
+        )
+        self.assertEqual(len(result), 3)
+
+
+class SnapshotTests(unittest.TestCase):
+    def setUp(self):
+        self.db = Database()
+        self.db.CREATE_TABLE("friends")
+        self.db.INSERT_INTO("friends", FRIENDS.rows)
+        self.db.CREATE_INDEX("friends", "state")
+        self.db.CREATE_TABLE("scores", columnar=True)
+        self.db.INSERT_INTO("scores", SCORES)
+        self.db.CREATE_INDEX("scores", "id", kind="sorted")
+
+    def test_snapshot_is_unaffected_by_later_writes(self):
+        snapshot = self.db.snapshot()
+        self.db.INSERT_INTO("friends", [{"id": 9, "city": "Waco", "state": "Texas"}])
+        self.db.UPDATE("friends", {"state": "Texas"}, col("id") == 1)
+        self.db.DELETE("friends", col("city") == "Houston")
+        self.db.INSERT_INTO("scores", [{**SCORES[0], "id": 0}])
+        self.db.UPDATE("scores", {"score": 0.0})
+        self.db.DROP_TABLE("scores")
+        self.db.CREATE_TABLE("other")
+        self.assertEqual(list(snapshot.tables), ["friends", "scores"])
+        self.assertEqual(snapshot.tables["friends"].rows, FRIENDS.rows)
+        self.assertEqual(snapshot.tables["scores"].rows, tuple(SCORES))
+        texas = query(snapshot, from_=["friends"], where=[col("state") == "Texas"])
+        self.assertEqual(
+            texas.rows, (FRIENDS.rows[3], FRIENDS.rows[4], FRIENDS.rows[6])
+        )
+        index = snapshot.tables["scores"].indexes[("id",)]
+        self.assertEqual(index.ordered_positions(), [0, 3, 1, 4, 2, 5])
+        texas = query(self.db, from_=["friends"], where=[col("state") == "Texas"])
+        self.assertEqual([row["id"] for row in texas.rows], [1, 4, 7, 9])
+
+    def test_writes_copy_only_what_they_change(self):
+        friends = self.db.tables["friends"]
+        scores = self.db.tables["scores"]
+        rows, state = friends._rows, friends.indexes[("state",)]
+        ids = scores.columns["id"]
+        snapshot = self.db.snapshot()
+        self.db.INSERT_INTO("friends", [{"id": 9, "city": "Waco", "state": "Texas"}])
+        self.db.UPDATE("friends", {"city": "Waco"}, col("id") == 1)
+        self.db.UPDATE("scores", {"score": 0.0})
+        self.assertIs(friends.indexes[("state",)], state)
+        self.assertIs(scores.columns["id"], ids)
+        self.assertEqual(snapshot.tables["friends"].rows, FRIENDS.rows)
+        self.assertEqual(snapshot.tables["scores"].rows, tuple(SCORES))
+        texas = query(snapshot, from_=["friends"], where=[col("state") == "Texas"])
+        self.assertEqual([row["id"] for row in texas], [4, 5, 7])
+
+    def test_writes_nobody_reads_copy_nothing(self):
+        friends = self.db.tables["friends"]
+        query(self.db, from_=["scores"])
+        rows, state = friends._rows, friends.indexes[("state",)]
+        positions = state._positions
+        self.db.UPDATE("friends", {"state": "Ohio"}, col("id") == 1)
+        self.db.DELETE("friends", col("id") == 2)
+        self.assertIs(friends._rows, rows)
+        self.assertIs(state._positions, positions)
+        texas = query(self.db, from_=["friends"], where=[col("state") == "Ohio"])
+        self.assertEqual([row["id"] for row in texas], [1])
+
+    def test_snapshot_waits_for_a_write_changing_its_copy_in_place(self):
+        table = self.db.tables["friends"]
+        snapshots = []
+        with self.db._write_lock:
+            table._committed._changing = True
+            thread = threading.Thread(
+                target=lambda: snapshots.append(self.db.snapshot(["friends"]))
+            )
+            thread.start()
+            thread.join(0.05)
+            self.assertTrue(thread.is_alive())
+            table._publish()
+        thread.join()
+        self.assertIs(snapshots[0].tables["friends"], table._committed)
+
+    def test_queries_snapshot_only_the_tables_they_read(self):
+        snapshots = []
+        take = Database.snapshot
+
+        def snapshot(db, names=None):
+            snapshots.append(take(db, names))
+            return snapshots[-1]
+
+        with mock.patch.object(Database, "snapshot", snapshot):
+            query(self.db, from_=["friends"], where=[col("state") == "Texas"])
+            explain(self.db, from_=["scores"], join=[("friends", ("id", "id"))])
+        self.assertEqual(
+            [list(s.tables) for s in snapshots], [["friends"], ["scores", "friends"]]
+        )
+        self.assertEqual(list(self.db.snapshot(["scores", "other"]).tables), ["scores"])
+
+    def test_lazy_query_reads_the_database_as_it_was(self):
+        result = query(self.db, from_=["friends"], select=["id"], lazy=True)
+        self.db.DELETE("friends", col("id") > 1)
+        self.db.INSERT_INTO("friends", [{"id": 9, "city": "Waco", "state": "Texas"}])
+        self.assertEqual([row["id"] for row in result], list(range(1, 9)))
+
+    def test_snapshot_taken_during_a_write_sees_the_table_before_it(self):
+        snapshots = []
+
+        def rows():
+            yield {"id": 9, "city": "Waco", "state": "Texas"}
+            snapshots.append(self.db.snapshot())
+            yield {"id": 10, "city": "Waco", "state": "Texas"}
+
+        with mock.patch.object(db_module.time, "sleep") as sleep:
+            self.db.INSERT_INTO("friends", rows())
+        sleep.assert_not_called()
+        (snapshot,) = snapshots
+        self.assertEqual(snapshot.tables["friends"].rows, FRIENDS.rows)
+        texas = query(snapshot, from_=["friends"], where=[col("state") == "Texas"])
+        self.assertEqual([row["id"] for row in texas], [4, 5, 7])
+        self.assertEqual(len(self.db.tables["friends"]), 10)
+
+    def test_concurrent_readers_see_whole_writes(self):
+        batches, size = 30, 20
+
+        def batch(n):
+            for i in range(size):
+                # Give the readers a chance to run in the middle of the write
+                if i % 5 == 0:
+                    time.sleep(0)
+                yield {"batch": n, "i": i}
+
+        def write():
+            for n in range(batches):
+                self.db.INSERT_INTO("log", batch(n))
+                self.db.UPDATE("log", {"i": -1}, col("batch") == n)
+                if n % 3 == 0:
+                    self.db.DELETE("log", col("batch") == n)
+
+        def read():
+            while writer.is_alive():
+                result = query(
+                    self.db,
+                    from_=["log"],
+                    group_by=["batch"],
+                    aggregate=[("COUNT", "i"), ("MIN", "i"), ("MAX", "i")],
+                )
+                # Each batch is whole, and updated either all or not at all
+                counts.extend(
+                    (row["COUNT(i)"], row["MIN(i)"] == -1, row["MAX(i)"] == -1)
+                    for row in result
+                )
+                # Readers never wait, so leave the writer some time
+                time.sleep(0.001)
+
+        self.db.CREATE_TABLE("log", ["batch", "i"])
+        self.db.CREATE_INDEX("log", "batch")
+        counts = []
+        writer = threading.Thread(target=write)
+        readers = [threading.Thread(target=read) for _ in range(3)]
+        writer.start()
+        for reader in readers:
+            reader.start()
+        for thread in (writer, *readers):
+            thread.join()
+        self.assertTrue(counts)
+        whole = {(size, False, False), (size, True, True)}
+        self.assertEqual(set(counts) - whole, set())
+        self.assertEqual(len(self.db.tables["log"]), (batches - 10) * size)
+
+
+class AsyncQueryTests(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.db = Database()
+        self.db.CREATE_TABLE("friends")
+        self.db.INSERT_INTO("friends", FRIENDS.rows)
+        self.db.CREATE_INDEX("friends", "state")
+        self.db.CREATE_TABLE("numbers")
+        self.db.INSERT_INTO("numbers", ({"n": n, "mod": n % 7} for n in range(20_000)))
+
+    async def test_results_match_query(self):
+        for kwargs in (
+            dict(from_=["friends"], where=[col("state") == "Texas"], select=["id"]),
+            dict(from_=["friends"], where=[lambda row: row["id"] > 2], limit=3),
+            dict(from_=["friends"], group_by=["state"], aggregate=[("COUNT", "id")]),
+            dict(from_=["friends"], distinct=["city"], order_by=col("city")),
+            dict(
+                from_=["friends", "numbers"],
+                where=[col("friends.id") == col("numbers.n")],
+                select=["friends.city", "numbers.mod"],
+                offset=2,
+            ),
+            dict(from_=["numbers"], where=[col("mod") == 3], having=col("n") < 50),
+        ):
+            with self.subTest(kwargs):
+                expected = query(self.db, **kwargs)
+                result = await aquery(self.db, batch_size=7, **kwargs)
+                self.assertEqual(result.rows, expected.rows)
+                with concurrent.futures.ThreadPoolExecutor(1) as executor:
+                    result = await aquery(self.db, executor=executor, **kwargs)
+                self.assertEqual(result.rows, expected.rows)
+        result = await self.db.aexecute("SELECT id FROM friends WHERE id > 6")
+        self.assertEqual(result.rows, ({"id": 7}, {"id": 8}))
+
+    async def test_small_queries_are_not_held_up_by_a_large_one(self):
+        finished = []
+
+        async def run(name, **kwargs):
+            await aquery(self.db, batch_size=100, **kwargs)
+            finished.append(name)
+
+        await asyncio.gather(
+            run("large", from_=["numbers"], where=[lambda row: row["mod"] != 1]),
+            *(
+                run(f"small {i}", from_=["friends"], where=[col("state") == "Texas"])
+                for i in range(3)
+            ),
+        )
+        self.assertEqual(finished, ["small 0", "small 1", "small 2", "large"])
+
+    async def test_limit_stops_the_query_early(self):
+        where = mock.Mock(side_effect=lambda row: True)
+        result = await aquery(
+            self.db, batch_size=100, from_=["numbers"], where=[where], limit=10
+        )
+        self.assertEqual(len(result), 10)
+        self.assertEqual(where.call_count, 10)
+
+    async def test_cancellation_and_timeout_stop_the_query(self):
+        where = mock.Mock(side_effect=lambda row: True)
+        task = asyncio.create_task(
+            aquery(self.db, batch_size=100, from_=["numbers"], where=[where])
+        )
+        while where.call_count < 1000:
+            await asyncio.sleep(0)
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+        self.assertLess(where.call_count, 2000)
+
+        started = threading.Event()
+
+        def slow(row):
+            started.set()
+            time.sleep(0.001)
+            return True
+
+        with concurrent.futures.ThreadPoolExecutor(1) as executor:
+            with self.assertRaises(TimeoutError):
+                await aquery(
+                    self.db,
+                    batch_size=10,
+                    executor=executor,
+                    timeout=0.05,
+                    from_=["numbers"],
+                    where=[slow],
+                )
+            # The executor's only thread is free again once the query stops
+            result = await aquery(self.db, executor=executor, from_=["friends"])
+        self.assertTrue(started.is_set())
+        self.assertEqual(len(result), 8)
+
+
+class QueryCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.db = Database(cache_size=2)
+        self.db.CREATE_TABLE("friends")
+        self.db.INSERT_INTO("friends", FRIENDS.rows)
+        self.db.CREATE_TABLE("other", ["a"])
+
+    def query(self, **kwargs):
+        with mock.patch("db._plan_from", wraps=db_module._plan_from) as plan:
+            result = query(self.db, from_=["friends"], **kwargs)
+        return result, plan.called
+
+    def test_repeated_query_is_served_from_cache(self):
+        texas = [col("state") == "Texas"]
+        first, ran = self.query(where=texas, select=["id"])
+        self.assertTrue(ran)
+        second, ran = self.query(where=[col("state") == "Texas"], select=["id"])
+        self.assertFalse(ran)
+        self.assertEqual(second.rows, first.rows)
+        self.assertEqual((self.db.cache.hits, self.db.cache.misses), (1, 1))
+        # Results are copies
+        second.extend([{"id": 99}])
+        third, _ = self.query(where=texas, select=["id"])
+        self.assertEqual(third.rows, first.rows)
+
+    def test_queries_calling_functions_are_not_cached(self):
+        cutoff = {"id": 5}
+        where = [lambda row: row["id"] < cutoff["id"]]
+        result, ran = self.query(where=where)
+        self.assertEqual(len(result), 4)
+        cutoff["id"] = 2
+        result, ran = self.query(where=where)
+        self.assertTrue(ran)
+        self.assertEqual(len(result), 1)
+        self.query(order_by=lambda row: row["id"])
+        self.assertEqual(len(self.db.cache), 0)
+        # SQL ORDER BY keys are plain data
+        self.db.execute("SELECT id FROM friends ORDER BY id DESC")
+        self.db.execute("SELECT id FROM friends ORDER BY id DESC")
+        self.assertEqual(self.db.cache.hits, 1)
+
+    def test_writes_invalidate_results(self):
+        self.query(select=["id"])
+        query(self.db, from_=["other"])
+        self.db.INSERT_INTO("friends", [{"id": 9, "city": "Austin", "state": "Texas"}])
+        self.assertEqual(len(self.db.cache), 1)
+        result, ran = self.query(select=["id"])
+        self.assertTrue(ran)
+        self.assertEqual(len(result), 9)
+        # Writes that bypass the Database are caught by the table's version
+        self.db.tables["friends"].extend([{"id": 10, "city": "Waco", "state": "Texas"}])
+        result, ran = self.query(select=["id"])
+        self.assertTrue(ran)
+        self.assertEqual(len(result), 10)
+        self.db.UPDATE("friends", {"state": "Ohio"}, col("id") == 10)
+        result, ran = self.query(select=["state"])
+        self.assertTrue(ran)
+        self.assertEqual(result.rows[-1], {"state": "Ohio"})
+        self.db.DELETE("friends", col("id") == 10)
+        result, ran = self.query(select=["id"])
+        self.assertTrue(ran)
+        self.assertEqual(len(result), 9)
+        self.db.DROP_TABLE("friends")
+        self.db.CREATE_TABLE("friends", ["id"])
+        result, ran = self.query(select=["id"])
+        self.assertTrue(ran)
+        self.assertEqual(result.rows, ())
+
+    def test_least_recently_used_result_is_evicted(self):
+        for n in [1, 2, 1, 3]:
+            self.query(limit=n)
+        self.assertEqual(len(self.db.cache), 2)
+        _, ran = self.query(limit=1)
+        self.assertFalse(ran)
+        _, ran = self.query(limit=2)
+        self.assertTrue(ran)
+
+    def test_cache_is_safe_across_threads(self):
+        cache = db_module.QueryCache(8)
+        errors = []
+
+        def use(n):
+            try:
+                for i in range(2000):
+                    key = ((("t", i % 3),), n, i % 16)
+                    cache.put(key, i)
+                    cache.get(key)
+                    if i % 50 == 0:
+                        cache.invalidate("t")
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=use, args=(n,)) for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertLessEqual(len(cache), 8)
+
+    def test_lazy_and_unhashable_queries_are_not_cached(self):
+        self.query(lazy=True)
+        self.query(where=[lambda row, seen=set(): row["id"] not in seen])
+        self.query(where=[lambda row, seen=set(): row["id"] not in seen])
+        self.assertEqual(len(self.db.cache), 0)
+
+
+class StatisticsTests(unittest.TestCase):
+    def setUp(self):
+        self.db = Database()
+        self.db.CREATE_TABLE("facts")
+        self.db.INSERT_INTO("facts", db_bench.generate_rows(5000, skew=1.0))
+        self.facts = self.db.tables["facts"]
+
+    def test_analyze_collects_column_statistics(self):
+        self.db.CREATE_TABLE("friends")
+        self.db.INSERT_INTO(
+            "friends",
+            [{**row, "state": None} if row["id"] == 8 else row for row in FRIENDS],
+        )
+        stats = self.db.ANALYZE("friends")
+        self.assertIs(self.db.tables["friends"].statistics, stats)
+        self.assertEqual(stats.row_count, 8)
+        ids, cities, states = (stats.columns[c] for c in ("id", "city", "state"))
+        self.assertEqual((ids.ndv, ids.min, ids.max, ids.mcv), (8, 1, 8, {}))
+        self.assertEqual(ids.histogram, list(range(1, 9)))
+        self.assertEqual(cities.ndv, 5)
+        self.assertEqual(
+            cities.mcv,
+            {
+                "Denver": 2 / 8,
+                "Corpus Christi": 2 / 8,
+                "Houston": 2 / 8,
+                "Colorado Springs": 1 / 8,
+                "South Park": 1 / 8,
+            },
+        )
+        self.assertEqual((states.ndv, states.null_fraction), (2, 1 / 8))
+        self.assertEqual(states.mcv, {"Colorado": 4 / 8, "Texas": 3 / 8})
+        self.assertIsNone(states.histogram)
+
+    def test_distinct_values_are_estimated_closely(self):
+        stats = self.db.ANALYZE("facts")
+        for column, distinct in [("id", 5000), ("key", 100), ("name", 100)]:
+            with self.subTest(column):
+                self.assertAlmostEqual(
+                    stats.columns[column].ndv / distinct, 1, delta=0.05
+                )
+
+    def test_selectivity_estimates_match_the_data(self):
+        stats = self.db.ANALYZE("facts")
+        for pred in [
+            col("key") == 0,
+            col("key") == 50,
+            col("key") != 0,
+            col("value") < 1000,
+            col("score").BETWEEN(20, 30),
+            col("name") >= "name50",
+            col("key").IN([0, 1, 2]),
+            (col("key") == 0) & (col("score") > 50),
+            (col("key") == 0) | (col("key") == 1),
+            ~(col("score") < 90),
+            ("value", ">", 4000),
+        ]:
+            with self.subTest(pred):
+                actual = len(self.db.WHERE(self.facts, pred)) / len(self.facts)
+                self.assertAlmostEqual(stats.selectivity(pred), actual, delta=0.02)
+
+    def test_estimates_without_statistics_fall_back_to_defaults(self):
+        stats = self.db.ANALYZE("facts")
+        self.assertEqual(stats.selectivity(col("missing") == 1), 0.005)
+        self.assertAlmostEqual(stats.selectivity(col("missing") > 1), 1 / 3)
+        self.assertAlmostEqual(stats.selectivity(lambda row: True), 1 / 3)
+        self.assertAlmostEqual(stats.selectivity(col("name") < 3), 1 / 3)
+        self.db.CREATE_TABLE("mixed")
+        self.db.INSERT_INTO("mixed", [{"a": 1}, {"a": "one"}, {"a": None}])
+        mixed = self.db.ANALYZE("mixed").columns["a"]
+        self.assertEqual((mixed.min, mixed.max, mixed.histogram), (None, None, None))
+        self.assertEqual((mixed.ndv, mixed.null_fraction), (2, 1 / 3))
+
+    def test_join_selectivity(self):
+        self.db.CREATE_TABLE("keys")
+        self.db.INSERT_INTO("keys", [{"key": k} for k in range(100)])
+        keys = self.db.ANALYZE("keys")
+        facts = self.db.ANALYZE("facts")
+        joined = self.db.JOIN(
+            self.facts, self.db.tables["keys"], col("facts.key") == col("keys.key")
+        )
+        estimate = facts.join_selectivity("key", keys, "key")
+        estimate *= facts.row_count * keys.row_count
+        self.assertAlmostEqual(estimate / len(joined), 1, delta=0.05)
+        # Without statistics, a column is taken to be unique
+        self.assertEqual(facts.join_selectivity("missing", keys, "key"), 1 / 5000)
+
+    def test_statistics_follow_writes(self):
+        stats = self.db.ANALYZE("facts")
+        self.db.INSERT_INTO(
+            "facts",
+            [
+                {"id": 5000 + i, "key": 1000, "value": 0, "score": 0.0, "name": "x"}
+                for i in range(100)
+            ],
+        )
+        # Taken in rather than collected again
+        stats = self.facts.statistics
+        self.assertEqual((stats.row_count, stats.changed), (5100, 100))
+        self.assertEqual(stats.columns["key"].max, 1000)
+        self.assertAlmostEqual(stats.columns["key"].ndv / 101, 1, delta=0.05)
+        self.db.UPDATE("facts", {"key": 0}, col("key") == 1000)
+        self.db.DELETE("facts", col("id") >= 5050)
+        stats = self.facts.statistics
+        self.assertEqual((stats.row_count, stats.changed), (5050, 250))
+        # Enough changes to call for collecting them again
+        self.db.DELETE("facts", col("value") < 1000)
+        self.assertIsNot(self.facts.statistics, stats)
+        self.assertEqual(self.facts.statistics.row_count, len(self.facts))
+        self.assertEqual(self.facts.statistics.changed, 0)
+
+    def test_every_kind_of_table_is_analyzed_alike(self):
+        expected = self.db.ANALYZE("facts")
+        kinds = [True] + (["numpy"] if numpy is not None else [])
+        for columnar in kinds:
+            with self.subTest(columnar):
+                self.db.CREATE_TABLE("copy", columnar=columnar)
+                self.db.INSERT_INTO("copy", self.facts)
+                stats = self.db.ANALYZE("copy")
+                for column, expected_stats in expected.columns.items():
+                    self.assertEqual(
+                        vars(stats.columns[column]).keys(), vars(expected_stats).keys()
+                    )
+                    for attr in ("ndv", "min", "max", "mcv", "histogram"):
+                        self.assertEqual(
+                            getattr(stats.columns[column], attr),
+                            getattr(expected_stats, attr),
+                        )
+
+    def test_snapshots_keep_their_statistics(self):
+        self.db.ANALYZE()
+        snapshot = self.db.snapshot()
+        self.db.INSERT_INTO("facts", [{"id": -1, "key": -1}])
+        self.assertEqual(snapshot.tables["facts"].statistics.row_count, 5000)
+        self.assertEqual(snapshot.tables["facts"].statistics.columns["key"].min, 0)
+        self.assertEqual(self.facts.statistics.columns["key"].min, -1)
+
+
+class JoinOrderTests(unittest.TestCase):
+    def setUp(self):
+        self.db = Database()
+        self.db.CREATE_TABLE("facts")
+        self.db.INSERT_INTO(
+            "facts",
+            [
+                {"id": i, "key": i % 30, "tag": i % 20, "flag": i % 10 != 0}
+                for i in range(600)
+            ],
+        )
+        # Only a third of the facts have keys
+        self.db.CREATE_TABLE("keys")
+        self.db.INSERT_INTO("keys", [{"key": k, "label": f"k{k}"} for k in range(10)])
+        self.db.CREATE_TABLE("tags")
+        self.db.INSERT_INTO("tags", [{"tag": t, "name": f"t{t}"} for t in range(20)])
+        self.where = [
+            col("facts.key") == col("keys.key"),
+            col("facts.tag") == col("tags.tag"),
+        ]
+
+    def scans(self, **kwargs):
+        plan = explain(self.db, **kwargs)
+        return [node.args[0] for node in plan.walk() if node.op == "SCAN"]
+
+    def test_order_does_not_depend_on_how_tables_are_listed(self):
+        expected = None
+        for from_ in itertools.permutations(["keys", "tags", "facts"]):
+            with self.subTest(from_):
+                self.assertEqual(
+                    self.scans(from_=list(from_), where=self.where),
+                    ["facts", "keys", "tags"],
+                )
+                with mock.patch.object(self.db, "_cross_product") as cross_product:
+                    result = query(self.db, from_=list(from_), where=self.where)
+                cross_product.assert_not_called()
+                rows = sorted(result, key=lambda row: row["facts.id"])
+                self.assertEqual(len(rows), 200)
+                if expected is None:
+                    expected = rows
+                self.assertEqual(rows, expected)
+
+    def test_join_clauses_are_ordered_with_the_from_tables(self):
+        join = [
+            ("facts", col("facts.key") == col("keys.key")),
+            ("tags", ("facts.tag", "tags.tag")),
+        ]
+        self.assertEqual(
+            self.scans(from_=["keys"], join=join), ["facts", "keys", "tags"]
+        )
+        result = query(self.db, from_=["keys"], join=join, where=[col("tags.tag") == 1])
+        self.assertEqual(len(result), 10)
+        # Functions can't be looked into, so those joins stay where they are
+        join = [
+            ("facts", lambda row: row["facts.key"] == row["keys.key"]),
+            ("tags", col("facts.tag") == col("tags.tag")),
+        ]
+        self.assertEqual(
+            self.scans(from_=["keys"], join=join), ["keys", "facts", "tags"]
+        )
+        self.assertEqual(len(query(self.db, from_=["keys"], join=join)), 200)
+
+    def test_statistics_inform_the_order(self):
+        kwargs = dict(
+            from_=["keys", "facts"],
+            where=[col("facts.key") == col("keys.key"), col("facts.flag") == True],
+        )
+        # By default an equality is taken to keep few rows, so the filtered
+        # facts look small enough to build the hash table from
+        self.assertEqual(self.scans(**kwargs), ["keys", "facts"])
+        self.db.ANALYZE()
+        self.assertEqual(self.scans(**kwargs), ["facts", "keys"])
+        self.assertEqual(len(query(self.db, **kwargs)), 180)
+
+    def test_many_tables_are_ordered_greedily(self):
+        for i in range(5):
+            self.db.CREATE_TABLE(f"chain{i}")
+            self.db.INSERT_INTO(f"chain{i}", [{"id": j} for j in range(10 + i)])
+        from_ = ["chain3", "chain0", "chain4", "chain1", "chain2"]
+        where = [col(f"chain{i}.id") == col(f"chain{i + 1}.id") for i in range(4)]
+        with mock.patch("db._EXHAUSTIVE_JOIN_LIMIT", 2):
+            plan = explain(self.db, from_=from_, where=where)
+            result = query(self.db, from_=from_, where=where)
+        self.assertNotIn("CROSS_JOIN", str(plan))
+        self.assertEqual(len(plan.inputs[0].inputs), 2)
+        self.assertEqual(sorted(row["chain0.id"] for row in result), list(range(10)))
+
+
+class PersistenceTests(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = tmp.name
+
+    def open(self):
+        db = Database(self.path)
+        self.addCleanup(db.close)
+        return db
+
+    def test_reopen_replays_log(self):
+        db = self.open()
+        db.CREATE_TABLE("friends")
+        db.INSERT_INTO("friends", iter(FRIENDS.rows[:3]))
+        db.INSERT_INTO("friends", FRIENDS.rows[3:])
+        db.CREATE_INDEX("friends", ["state"])
+        db.CREATE_TABLE("gone", ["a"])
+        db.DROP_TABLE("gone")
+        db.close()
+        reopened = self.open()
+        self.assertEqual(list(reopened.tables), ["friends"])
+        self.assertEqual(reopened.tables["friends"].rows, FRIENDS.rows)
+        index = reopened.tables["friends"].indexes[("state",)]
+        self.assertEqual(index.lookup("Texas"), [3, 4, 6])
+
+    def test_rejected_insert_is_neither_kept_nor_logged(self):
+        db = self.open()
+        for columnar in (False, True):
+            name = f"t{int(columnar)}"
+            db.CREATE_TABLE(name, columnar=columnar)
+            db.INSERT_INTO(name, [{"a": 1, "b": 1}])
+            db.CREATE_INDEX(name, "b", kind="sorted")
+            db.CREATE_INDEX(name, "a")
+            with self.assertRaises((KeyError, TypeError)):
+                db.INSERT_INTO(name, [{"a": 2, "b": 2}, {"a": 3, "b": "x"}])
+            table = db.tables[name]
+            self.assertEqual(table.rows, ({"a": 1, "b": 1},))
+            self.assertEqual(table.indexes[("a",)].lookup(2), [])
+            self.assertEqual(table.indexes[("b",)].range(0, 5), [0])
+        db.close()
+        reopened = self.open()
+        self.assertEqual(reopened.tables["t0"].rows, ({"a": 1, "b": 1},))
+        self.assertEqual(reopened.tables["t1"].rows, ({"a": 1, "b": 1},))
+
+    def test_checkpoint_loads_snapshot_and_replays_only_new_log(self):
+        db = self.open()
+        db.CREATE_TABLE("friends")
+        db.INSERT_INTO("friends", FRIENDS.rows[:5])
+        db.CREATE_TABLE("numbers", columnar=True)
+        db.INSERT_INTO("numbers", [{"n": 1, "x": 0.5}, {"n": 2, "x": 1.5}])
+        db.CREATE_INDEX("numbers", "n", kind="sorted")
+        db.CHECKPOINT()
+        db.INSERT_INTO("friends", FRIENDS.rows[5:])
+        db.close()
+        self.assertEqual(sorted(os.listdir(self.path)), ["log.1", "snapshot"])
+        with mock.patch.object(Database, "CREATE_TABLE") as create_table:
+            reopened = self.open()
+        create_table.assert_not_called()
+        self.assertEqual(reopened.tables["friends"].rows, FRIENDS.rows)
+        numbers = reopened.tables["numbers"]
+        self.assertIsInstance(numbers, ColumnTable)
+        self.assertEqual(numbers.columns["n"], array.array("q", [1, 2]))
+        self.assertEqual(numbers.indexes[("n",)].range(2), [1])
+
+    def test_update_and_delete_are_replayed(self):
+        db = self.open()
+        db.CREATE_TABLE("friends")
+        db.INSERT_INTO("friends", FRIENDS.rows)
+        db.CREATE_INDEX("friends", ["state"])
+        db.UPDATE("friends", {"city": "Austin"}, lambda row: row["id"] % 2 == 0)
+        db.DELETE("friends", col("state") == "Colorado")
+        expected = db.tables["friends"].rows
+        db.close()
+        reopened = self.open()
+        self.assertEqual(reopened.tables["friends"].rows, expected)
+        index = reopened.tables["friends"].indexes[("state",)]
+        self.assertEqual(index.lookup("Texas"), [0, 1, 2])
+
+    def test_half_written_record_is_dropped(self):
+        db = self.open()
+        db.CREATE_TABLE("numbers")
+        db.INSERT_INTO("numbers", [{"n": 1}])
+        db.close()
+        with open(os.path.join(self.path, "log.0"), "ab") as f:
+            f.write(b"\x80\x05\x95")
+        db = self.open()
+        self.assertEqual(db.tables["numbers"].rows, ({"n": 1},))
+        db.INSERT_INTO("numbers", [{"n": 2}])
+        db.close()
+        self.assertEqual(self.open().tables["numbers"].rows, ({"n": 1}, {"n": 2}))
+
+    def test_checkpoint_needs_path(self):
+        with self.assertRaises(ValueError):
+            Database().CHECKPOINT()
+
+
+class BulkIOTests(unittest.TestCase):
+    def test_csv_prints_values_in_colnames_order(self):
+        table = Table("t", [{"b": 1, "a": 2}, {"a": 3, "b": 4}])
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            csv(table)
+        self.assertEqual(out.getvalue(), "a,b\n2,1\n3,4\n")
+
+    def test_load_csv_infers_types_in_batches(self):
+        db = Database()
+        data = io.StringIO("id,name,score\n1,Alice,2.5\n2,nan,\n3,\"Smith, J\",1e3\n")
+        with mock.patch.object(db, "INSERT_INTO", wraps=db.INSERT_INTO) as insert:
+            self.assertEqual(load_csv(db, "people", data, batch_size=2), 3)
+        self.assertEqual(insert.call_count, 2)
+        self.assertEqual(
+            db.tables["people"].rows,
+            (
+                {"id": 1, "name": "Alice", "score": 2.5},
+                {"id": 2, "name": "nan", "score": None},
+                {"id": 3, "name": "Smith, J", "score": 1000.0},
+            ),
+        )
+
+    def test_load_csv_gives_each_column_one_type(self):
+        db = Database()
+        data = io.StringIO(
+            "zip,code,n,x\n02134,12,1,1\n10001,12A,2,\n-0,7,3.5,2\n"
+        )
+        load_csv(db, "places", data)
+        self.assertEqual(
+            db.tables["places"].rows,
+            (
+                {"zip": "02134", "code": "12", "n": 1.0, "x": 1},
+                {"zip": "10001", "code": "12A", "n": 2.0, "x": None},
+                {"zip": "-0", "code": "7", "n": 3.5, "x": 2},
+            ),
+        )
+        self.assertIs(type(db.tables["places"].rows[0]["n"]), float)
+        out = io.StringIO()
+        write_csv(db.tables["places"], out)
+        self.assertIn("02134", out.getvalue())
+        # Later batches widen the type for the rows they hold
+        load_csv(db, "widened", io.StringIO("n\n1\n2\nx\n"), batch_size=2)
+        self.assertEqual(
+            [row["n"] for row in db.tables["widened"].rows], [1, 2, "x"]
+        )
+
+    def test_load_csv_checks_record_lengths(self):
+        db = Database()
+        load_csv(db, "short", io.StringIO("a,b,c\n1,x\n\n2,y,1_000\n"))
+        self.assertEqual(
+            db.tables["short"].rows,
+            (
+                {"a": 1, "b": "x", "c": None},
+                {"a": 2, "b": "y", "c": "1_000"},
+            ),
+        )
+        with self.assertRaisesRegex(ValueError, "more fields than the header"):
+            load_csv(db, "long", io.StringIO("a,b\n1,2,3\n"))
+
+    def test_load_csv_appends_to_existing_columnar_table(self):
+        db = Database()
+        db.CREATE_TABLE("numbers", columnar=True)
+        load_csv(db, "numbers", io.StringIO("n\n1\n2\n"))
+        load_csv(db, "numbers", io.StringIO("n\n3\n"))
+        self.assertEqual(db.tables["numbers"].columns["n"], array.array("q", [1, 2, 3]))
+        self.assertEqual(load_csv(db, "empty", io.StringIO("")), 0)
+
+    def test_write_csv_streams_lazy_query_and_round_trips(self):
+        db = Database()
+        db.CREATE_TABLE("friends")
+        db.INSERT_INTO("friends", FRIENDS.rows)
+        where = [col("state") == "Texas"]
+        result = query(db, from_=["friends"], where=where, lazy=True)
+        out = io.StringIO()
+        write_csv(result, out, batch_size=2)
+        self.assertEqual(
+            out.getvalue().splitlines(),
+            [
+                "city,id,state",
+                "Corpus Christi,4,Texas",
+                "Houston,5,Texas",
+                "Corpus Christi,7,Texas",
+            ],
+        )
+        out.seek(0)
+        load_csv(db, "texas", out)
+        self.assertEqual(
+            db.tables["texas"].rows, (FRIENDS.rows[3], FRIENDS.rows[4], FRIENDS.rows[6])
+        )
+
+    def test_jsonl_round_trip(self):
+        db = Database()
+        table = Table("t", [{"a": 1, "b": None}, {"a": 2.5, "b": "x"}])
+        out = io.StringIO()
+        write_jsonl(db.CROSS_JOIN(table, Table("u", [{"c": True}])), out)
+        out.seek(0)
+        self.assertEqual(load_jsonl(db, "t", out, batch_size=1), 2)
+        self.assertEqual(
+            db.tables["t"].rows,
+            (
+                {"t.a": 1, "t.b": None, "u.c": True},
+                {"t.a": 2.5, "t.b": "x", "u.c": True},
+            ),
+        )
+
+
+class BenchTests(unittest.TestCase):
+    def test_generate_rows_is_reproducible_and_skewed(self):
+        rows = db_bench.generate_rows(2000, cardinality=10, skew=1.5, seed=3)
+        self.assertEqual(rows, db_bench.generate_rows(2000, 10, 1.5, seed=3))
+        counts = [sum(row["key"] == k for row in rows) for k in range(10)]
+        self.assertEqual(max(counts), counts[0])
+        self.assertGreater(counts[0], 10 * counts[-1])
+        self.assertEqual(sum(counts), 2000)
+
+    def test_every_benchmark_runs(self):
+        results = db_bench.run([50], repeat=1, cardinality=5)
+        self.assertEqual([r["name"] for r in results], list(db_bench.BENCHMARKS))
+        for result in results:
+            self.assertEqual(result["rows"], 50)
+            self.assertGreater(result["seconds"], 0)
+
+    def test_benchmarks_run_on_the_generated_rows(self):
+        with mock.patch(
+            "db_bench.generate_rows", wraps=db_bench.generate_rows
+        ) as generate_rows, mock.patch("sys.stdout", io.StringIO()):
+            db_bench.main(["--rows", "20", "--repeat", "1", "--columnar", "numpy"])
+        generate_rows.assert_called_once()
+        db = db_bench.make_database(db_bench.generate_rows(5), columnar=True)
+        self.assertIsInstance(db.tables["facts"], ColumnTable)
+
+    def test_compare_flags_regressions(self):
+        old = [
+            {"name": "JOIN", "rows": 10, "seconds": 1.0, "peak_bytes": 100},
+            {"name": "WHERE", "rows": 10, "seconds": 1.0, "peak_bytes": 100},
+        ]
+        new = [
+            {"name": "JOIN", "rows": 10, "seconds": 1.5, "peak_bytes": 100},
+            {"name": "WHERE", "rows": 10, "seconds": 0.5, "peak_bytes": 105},
+            {"name": "DISTINCT", "rows": 10, "seconds": 1.0, "peak_bytes": 1},
+        ]
+        lines, regressions = db_bench.compare(old, new, threshold=0.1)
+        self.assertEqual(regressions, 1)
+        self.assertEqual(
+            lines,
+            [
+                "JOIN @ 10: seconds +50.0% REGRESSION, peak_bytes +0.0%",
+                "WHERE @ 10: seconds -50.0%, peak_bytes +5.0%",
+            ],
+        )
+
+
+class EndToEndTests(unittest.TestCase):
+    def test_query(self):
+        db = Database()
+        friend = db.CREATE_TABLE("friend")
+        db.INSERT_INTO(
+            "friend",
+            [
+                {"id": 1, "name": "Alice", "city": "Denver", "state": "Colorado"},
+                {
+                    "id": 2,
+                    "name": "Bob",
+                    "city": "Colorado Springs",
+                    "state": "Colorado",
+                },
+                {"id": 3, "name": "Charles", "city": "South Park", "state": "Colorado"},
+                {"id": 4, "name": "Dave", "city": "Fort Collins", "state": "Colorado"},
+                {"id": 5, "name": "Edna", "city": "Houston", "state": "Texas"},
+                {"id": 6, "name": "Francis", "city": "Denver", "state": "Colorado"},
+                {"id": 7, "name": "Gloria", "city": "Corpus Christi", "state": "Texas"},
+                {"id": 9, "name": "Homer", "city": "Denver", "state": "Colorado"},
+            ],
+        )
+        employee = db.CREATE_TABLE("employee")
+        db.INSERT_INTO(
+            "employee",
+            [
+                {"id": 1, "name": "Alice", "department_id": 100, "salary": 100},
+                {"id": 2, "name": "Bob", "department_id": 2, "salary": 150},
+                {"id": 3, "name": "Charles", "department_id": 2, "salary": 200},
+                {"id": 4, "name": "Dave", "department_id": 1, "salary": 180},
+            ],
+        )
+        department = db.CREATE_TABLE("department")
+        db.INSERT_INTO(
+            "department",
+            [
+                {"id": 1, "title": "Accounting"},
+                {"id": 2, "title": "Engineering"},
+            ],
+        )
+        result = query(
+            db,
+            select=["employee.name", "department.title", "friend.state"],
+            select_as={
+                "employee.name": "Name",
+                "department.title": "Dept",
+                "friend.state": "From",
+            },
+            from_=["employee"],
+            join=[
+                [
+                    "department",
+                    lambda row: row["employee.department_id"] == row["department.id"],
+                ],
+                ["friend", lambda row: row["friend.name"] == row["employee.name"]],
+            ],
+            where=[
+                lambda row: row["employee.salary"] > 150,
+                lambda row: row["friend.state"] == "Colorado",
+            ],
+            order_by=lambda row: row["Dept"],
+        )
+        self.assertEqual(
+            result.rows,
+            (
+                {"Name": "Dave", "Dept": "Accounting", "From": "Colorado"},
+                {"Name": "Charles", "Dept": "Engineering", "From": "Colorado"},
+            ),
+        )
+
+    def test_query_with_join_keys(self):
+        db = Database()
+        db.CREATE_TABLE("employee")
+        db.INSERT_INTO(
+            "employee",
+            [
+                {"id": 1, "name": "Alice", "department_id": 100},
+                {"id": 2, "name": "Bob", "department_id": 2},
+                {"id": 3, "name": "Charles", "department_id": 1},
+            ],
+        )
+        db.CREATE_TABLE("department")
+        db.INSERT_INTO(
+            "department",
+            [{"id": 1, "title": "Accounting"}, {"id": 2, "title": "Engineering"}],
+        )
+        result = query(
+            db,
+            select=["employee.name", "department.title"],
+            from_=["employee"],
+            join=[["department", ("employee.department_id", "department.id")]],
+            order_by=lambda row: row["employee.name"],
+        )
+        self.assertEqual(
+            result.rows,
+            (
+                {"employee.name": "Bob", "department.title": "Engineering"},
+                {"employee.name": "Charles", "department.title": "Accounting"},
+            ),
+        )
+
+    def test_query_stops_pulling_rows_at_limit(self):
+        db = Database()
+        db.CREATE_TABLE("numbers")
+        db.INSERT_INTO("numbers", [{"n": n} for n in range(1000)])
+        calls = []
+
+        def is_even(row):
+            calls.append(row["n"])
+            return row["n"] % 2 == 0
+
+        result = query(db, select=["n"], from_=["numbers"], where=[is_even], limit=3)
+        self.assertEqual(result.rows, ({"n": 0}, {"n": 2}, {"n": 4}))
+        self.assertEqual(calls, [0, 1, 2, 3, 4])
+
+    def test_lazy_query_returns_stream(self):
+        db = Database()
+        db.CREATE_TABLE("foo")
+        db.INSERT_INTO("foo", [{"a": 1}, {"a": 2}])
+        db.CREATE_TABLE("bar")
+        db.INSERT_INTO("bar", [{"b": 1}, {"b": 2}])
+        result = query(db, from_=["foo", "bar"], offset=1, lazy=True)
+        self.assertIsInstance(result, Stream)
+        self.assertEqual(list(result), list(db.FROM("foo", "bar").rows[1:]))
+
+    def test_query_over_columnar_table(self):
+        db = Database()
+        db.CREATE_TABLE("scores", columnar=True)
+        db.INSERT_INTO("scores", SCORES)
+        result = query(
+            db,
+            select=["name"],
+            from_=["scores"],
+            where=[lambda row: row["score"] > 85],
+            order_by=lambda row: row["name"],
+        )
+        self.assertEqual(result.rows, ({"name": "Bob"}, {"name": "Bob"}))
+
+    def test_query_with_expressions(self):
+        db = Database()
+        db.CREATE_TABLE("employee")
+        db.INSERT_INTO(
+            "employee",
+            [
+                {"id": 1, "name": "Alice", "department_id": 1, "salary": 100},
+                {"id": 2, "name": "Bob", "department_id": 2, "salary": 150},
+                {"id": 3, "name": "Charles", "department_id": 2, "salary": 200},
+            ],
+        )
+        db.CREATE_TABLE("department")
+        db.INSERT_INTO(
+            "department",
+            [{"id": 1, "title": "Accounting"}, {"id": 2, "title": "Engineering"}],
+        )
+        result = query(
+            db,
+            select=["department.title"],
+            from_=["employee"],
+            join=[
+                ["department", col("employee.department_id") == col("department.id")]
+            ],
+            where=[col("employee.salary") >= 150],
+            group_by=["department.title"],
+            having=col("department.title") != "Accounting",
+        )
+        self.assertEqual(result.rows, ({"department.title": "Engineering"},))
+
+    def test_query_pushes_filters_below_cross_join(self):
+        db = Database()
+        for name, key in (("a", "x"), ("b", "y"), ("c", "z")):
+            db.CREATE_TABLE(name)
+            db.INSERT_INTO(name, [{"id": i, key: i % 7} for i in range(30)])
+        where = [
+            (col("a.x") == col("b.y")) & (col("b.id") == col("c.id")),
+            col("a.id") < 10,
+            ("c.z", ">", 2),
+            lambda row: row["a.id"] != row["b.id"],
+        ]
+        expected = db.FROM("a", "b", "c").filter(
+            lambda row: row["a.x"] == row["b.y"]
+            and row["b.id"] == row["c.id"]
+            and row["a.id"] < 10
+            and row["c.z"] > 2
+            and row["a.id"] != row["b.id"]
+        )
+        with mock.patch.object(db, "_cross_product") as cross_product:
+            result = query(db, from_=["a", "b", "c"], where=where)
+        cross_product.assert_not_called()
+        # The joins may run in another order, so the rows may come in one
+        self.assertCountEqual(result.rows, expected.rows)
+
+    def test_query_keeps_filters_behind_opaque_ones(self):
+        db = Database()
+        db.CREATE_TABLE("t")
+        db.INSERT_INTO("t", [{"x": None}, {"x": 1}, {"x": 2}])
+        where = [lambda row: row["x"] is not None, col("x") > 1]
+        self.assertEqual(query(db, from_=["t"], where=where).rows, ({"x": 2},))
+
+    def test_query_joins_a_table_named_twice(self):
+        db = Database()
+        db.CREATE_TABLE("t")
+        db.INSERT_INTO("t", [{"x": i} for i in range(5)])
+        db.CREATE_TABLE("u")
+        db.INSERT_INTO("u", [{"y": i} for i in range(2)])
+        expected = db.JOIN(db.FROM("t", "u"), db.tables["t"], lambda row: True)
+        result = query(db, from_=["t", "u"], join=[("t", lambda row: True)])
+        self.assertEqual(len(result.rows), 50)
+        self.assertEqual(result.rows, expected.rows)
+
+    def test_query_pushes_filters_into_joined_tables(self):
+        db = Database()
+        db.CREATE_TABLE("employee")
+        db.INSERT_INTO(
+            "employee",
+            [
+                {"id": 1, "name": "Alice", "department_id": 1},
+                {"id": 2, "name": "Bob", "department_id": 2},
+            ],
+        )
+        db.CREATE_TABLE("department")
+        db.INSERT_INTO(
+            "department",
+            [{"id": 1, "title": "Accounting"}, {"id": 2, "title": "Engineering"}],
+        )
+        db.CREATE_INDEX("department", "title")
+        with mock.patch.object(
+            HashIndex, "lookup", autospec=True, side_effect=HashIndex.lookup
+        ) as lookup:
+            result = query(
+                db,
+                select=["employee.name"],
+                from_=["employee"],
+                join=[["department", ("employee.department_id", "department.id")]],
+                where=[col("department.title") == "Engineering"],
+            )
+        lookup.assert_called_once_with(mock.ANY, "Engineering")
+        self.assertEqual(result.rows, ({"employee.name": "Bob"},))
+
+    def test_query_order_by_limit_offset_uses_top_k(self):
+        db = Database()
+        db.CREATE_TABLE("numbers")
+        db.INSERT_INTO("numbers", [{"id": i, "n": (i * 37) % 10} for i in range(100)])
+        order_by = lambda row: -row["n"]
+        expected = db.ORDER_BY(db.tables["numbers"], order_by).rows[15:25]
+        with mock.patch("db.heapq.nsmallest", wraps=heapq.nsmallest) as nsmallest:
+            result = query(
+                db, from_=["numbers"], order_by=order_by, offset=15, limit=10
+            )
+        self.assertEqual(nsmallest.call_args.args[0], 25)
+        self.assertEqual(result.rows, expected)
+
+    def test_query_with_aggregates(self):
+        db = Database()
+        db.CREATE_TABLE("friends")
+        db.INSERT_INTO("friends", FRIENDS.rows)
+        result = query(
+            db,
+            select=["state", "COUNT(id)"],
+            select_as={"COUNT(id)": "friends"},
+            from_=["friends"],
+            group_by=["state"],
+            aggregate=[("COUNT", "id")],
+            having=col("COUNT(id)") > 1,
+            order_by=lambda row: row["state"],
+        )
+        self.assertEqual(
+            result.rows,
+            ({"state": "Colorado", "friends": 4}, {"state": "Texas", "friends": 3}),
         )
 
 